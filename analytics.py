@@ -0,0 +1,142 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from sqlalchemy import select, union_all
+from typing import Optional
+
+from config import Config
+from database import Session
+from models import Request, ArchivedRequest
+
+import heapq
+import math
+
+
+# Скользящая статистика поломок по автоматам. Счетчики затухают экспоненциально:
+# при каждой заявке значение умножается на 2^(-прошло/период полураспада) и увеличивается,
+# поэтому обновление занимает O(1) и не требует хранить историю заявок
+
+
+@dataclass(slots=True)
+class MachineStats:
+    updated_at: datetime
+    recent: float = 0.0  # заявки с коротким периодом полураспада
+    baseline: float = 0.0  # заявки с длинным периодом полураспада — обычный уровень автомата
+    refunds: float = 0.0  # сумма возвратов с коротким периодом полураспада
+    alerted_at: Optional[datetime] = None
+
+
+@dataclass(frozen=True, slots=True)
+class Hotspot:
+    machine_number: str
+    recent_rate: float  # заявок в сутки за последнее время
+    baseline_rate: float  # заявок в сутки обычно
+    refunds: float
+    spiking: bool
+
+
+def decay_factor(elapsed: timedelta, half_life: timedelta) -> float:
+    return 2 ** (-elapsed / half_life)
+
+
+def daily_rate(value: float, half_life: timedelta) -> float:
+    # Сумма затухающего счетчика при постоянном потоке равна поток * период полураспада / ln 2
+    return value * math.log(2) / (half_life / timedelta(days=1))
+
+
+class HotspotTracker:
+    # Автомат считается проблемным, если заявок за последнее время хотя бы min_count
+    # и их частота в factor раз выше обычной. Повторное оповещение — не раньше чем через cooldown
+    def __init__(self, half_life: timedelta, baseline_half_life: timedelta, factor: float, min_count: float,
+                 cooldown: timedelta):
+        self.half_life = half_life
+        self.baseline_half_life = baseline_half_life
+        self.factor = factor
+        self.min_count = min_count
+        self.cooldown = cooldown
+        self._stats = {}  # machine_number -> MachineStats
+        # Заявки, созданные раньше этого времени, учитываются из истории (history), а не через record
+        self.history_until: Optional[datetime] = None
+
+    def _decayed(self, stats: MachineStats, at: datetime):
+        elapsed = max(at - stats.updated_at, timedelta())
+        fast = decay_factor(elapsed, self.half_life)
+        return stats.recent * fast, stats.baseline * decay_factor(elapsed, self.baseline_half_life), stats.refunds * fast
+
+    def _spiking(self, recent: float, baseline: float) -> bool:
+        return recent >= self.min_count and \
+            daily_rate(recent, self.half_life) > self.factor * daily_rate(baseline, self.baseline_half_life)
+
+    def record(self, machine_number: str, created_at: datetime, refund: float = None) -> bool:
+        # Учитывает новую заявку; True, если по автомату нужно оповестить руководство
+        if self.history_until and created_at < self.history_until:
+            return False
+        stats = self._stats.get(machine_number)
+        if stats is None:
+            stats = self._stats[machine_number] = MachineStats(created_at)
+        recent, baseline, refunds = self._decayed(stats, created_at)
+        stats.recent = recent + 1
+        stats.baseline = baseline + 1
+        stats.refunds = refunds + (refund or 0)
+        stats.updated_at = max(stats.updated_at, created_at)
+
+        if not self._spiking(stats.recent, stats.baseline):
+            return False
+        if stats.alerted_at and created_at - stats.alerted_at < self.cooldown:
+            return False
+        stats.alerted_at = created_at
+        return True
+
+    def hotspot(self, machine_number: str, now: datetime) -> Optional[Hotspot]:
+        stats = self._stats.get(machine_number)
+        if stats is None:
+            return None
+        recent, baseline, refunds = self._decayed(stats, now)
+        return Hotspot(machine_number, daily_rate(recent, self.half_life),
+                       daily_rate(baseline, self.baseline_half_life), refunds, self._spiking(recent, baseline))
+
+    def top(self, limit: int, now: datetime) -> list:
+        # Автоматы с наибольшей частотой заявок за последнее время
+        machines = heapq.nlargest(limit, self._stats,
+                                  key=lambda number: self._decayed(self._stats[number], now)[0])
+        return [self.hotspot(number, now) for number in machines]
+
+    def history(self, since: datetime, until: datetime) -> 'HotspotTracker':
+        # Счетчики по заявкам, созданным с since до until, включая архив, в отдельном трекере:
+        # история читается в потоке, пока текущие заявки учитываются в основном.
+        # Строки читаются порциями, чтобы не держать всю историю в памяти
+        tracker = HotspotTracker(self.half_life, self.baseline_half_life, self.factor, self.min_count, self.cooldown)
+        query = union_all(*(
+            select(table.c.machine_number, table.c.created_at, table.c.expense_amount)
+            .where(table.c.created_at >= since, table.c.created_at < until)
+            for table in (Request.__table__, ArchivedRequest)
+        )).subquery()
+        with Session() as session:
+            rows = session.execute(
+                select(query).order_by(query.c.created_at).execution_options(yield_per=1000)
+            )
+            for machine_number, created_at, expense_amount in rows:
+                tracker.record(machine_number, created_at, expense_amount)
+        return tracker
+
+    def merge(self, other: 'HotspotTracker'):
+        # Затухающие счетчики складываются: вклад каждой заявки затухает независимо от остальных
+        for machine_number, theirs in other._stats.items():
+            ours = self._stats.get(machine_number)
+            if ours is None:
+                self._stats[machine_number] = theirs
+                continue
+            at = max(ours.updated_at, theirs.updated_at)
+            ours.recent, ours.baseline, ours.refunds = (
+                value + their_value for value, their_value in zip(self._decayed(ours, at), self._decayed(theirs, at))
+            )
+            ours.updated_at = at
+            ours.alerted_at = max(filter(None, (ours.alerted_at, theirs.alerted_at)), default=None)
+
+
+hotspots = HotspotTracker(
+    half_life=timedelta(hours=Config.HOTSPOT_HALF_LIFE_HOURS),
+    baseline_half_life=timedelta(days=Config.HOTSPOT_BASELINE_DAYS),
+    factor=Config.HOTSPOT_FACTOR,
+    min_count=Config.HOTSPOT_MIN_COUNT,
+    cooldown=timedelta(hours=Config.HOTSPOT_COOLDOWN_HOURS),
+)
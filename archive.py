@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta
+from sqlalchemy import and_, delete, insert, select
+
+from config import Config
+from database import archive_lock, engine, prune_processed_updates
+from models import Request, Comment, Photo, CardMessage, Timer, OutboxMessage, RequestEvent, ArchivedRequest, \
+    ArchivedComment, ArchivedPhoto, ArchivedRequestEvent, utcnow
+
+import asyncio
+import logging
+
+
+BATCH_SIZE = 1000
+ARCHIVED = ((Request, ArchivedRequest), (Comment, ArchivedComment), (Photo, ArchivedPhoto),
+            (RequestEvent, ArchivedRequestEvent))
+
+
+# В режиме WAL транзакция, которая пишет в две базы, атомарна в каждой из них, но не в обеих сразу:
+# после сбоя удаление из рабочей базы могло сохраниться, а вставка в архив — нет. Поэтому перенос
+# идет двумя транзакциями: копирование в архив, затем удаление из рабочей базы только тех заявок,
+# которые скопированы полностью и с тех пор не менялись. Копии заявок, оставшихся в рабочей базе,
+# считаются недописанными и удаляются из архива
+
+
+def archivable(older_than: datetime):
+    return and_(
+        Request.engineer_status == 'closed',
+        Request.accountant_status == 'closed',
+        Request.engineer_closed_at < older_than,
+        Request.accountant_closed_at < older_than
+    )
+
+
+def discard_archived_copies(connection, ids=None):
+    # Удаляет из архива копии заявок, которые есть в рабочей базе (все такие заявки или из ids)
+    live = select(Request.id) if ids is None else select(Request.id).where(Request.id.in_(ids))
+    for source, target in ARCHIVED:
+        key = target.c.id if source is Request else target.c.request_id
+        connection.execute(delete(target).where(key.in_(live)))
+
+
+def copy_to_archive(ids: list):
+    with engine.begin() as connection:
+        discard_archived_copies(connection, ids)
+        for source, target in ARCHIVED:
+            key = source.id if source is Request else source.request_id
+            columns = [column.name for column in target.columns]
+            connection.execute(insert(target).from_select(columns, select(source.__table__).where(key.in_(ids))))
+
+
+def delete_archived(ids: list, older_than: datetime) -> list:
+    # Удаляет из рабочей базы заявки, которые по-прежнему подлежат переносу и скопированы вместе
+    # со всеми комментариями, фото и событиями. Возвращает номера удаленных заявок
+
+    # Псевдоним нужен, чтобы архивная таблица не совпала по имени с рабочей в подзапросе
+    archived = ArchivedRequest.alias('archived')
+    copied = select(archived.c.id).where(
+        archived.c.id == Request.id,
+        archived.c.engineer_closed_at == Request.engineer_closed_at,
+        archived.c.accountant_closed_at == Request.accountant_closed_at
+    ).exists()
+    conditions = [Request.id.in_(ids), archivable(older_than), copied]
+    for source, target in ARCHIVED[1:]:
+        conditions.append(~select(source.id).where(
+            source.request_id == Request.id, source.id.not_in(select(target.c.id))
+        ).exists())
+
+    with engine.begin() as connection:
+        ids = connection.execute(select(Request.id).where(*conditions)).scalars().all()
+        if ids:
+            for model in (Comment, Photo, CardMessage, Timer, OutboxMessage, RequestEvent):
+                connection.execute(delete(model).where(model.request_id.in_(ids)))
+            connection.execute(delete(Request).where(Request.id.in_(ids)))
+        return ids
+
+
+def archive_closed_requests(older_than: datetime) -> int:
+    # Переносит полностью закрытые заявки вместе с комментариями, фото и историей в архив пачками.
+    # Пачка переносится под archive_lock, поэтому снимок для отчетов видит ее целиком в одной из баз
+    moved = 0
+    skipped = []  # изменились во время переноса, остаются до следующего запуска
+    with archive_lock, engine.begin() as connection:
+        discard_archived_copies(connection)
+    while True:
+        with engine.connect() as connection:
+            ids = connection.execute(
+                select(Request.id).where(archivable(older_than), Request.id.not_in(skipped)).limit(BATCH_SIZE)
+            ).scalars().all()
+        if not ids:
+            return moved
+
+        with archive_lock:
+            copy_to_archive(ids)
+            deleted = delete_archived(ids, older_than)
+            if len(deleted) < len(ids):
+                with engine.begin() as connection:
+                    discard_archived_copies(connection, ids)
+                skipped.extend(set(ids) - set(deleted))
+        moved += len(deleted)
+
+
+async def run_archiver():
+    while True:
+        try:
+            older_than = utcnow() - timedelta(days=Config.ARCHIVE_AFTER_DAYS)
+            moved = await asyncio.to_thread(archive_closed_requests, older_than)
+            if moved:
+                logging.info(f"Archived {moved} requests")
+            await asyncio.to_thread(prune_processed_updates, utcnow() - timedelta(hours=Config.DEDUP_RETENTION_HOURS))
+        except Exception as e:
+            logging.exception(f"Error archiving requests: {e}")
+        await asyncio.sleep(Config.ARCHIVE_INTERVAL_HOURS * 3600)
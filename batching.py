@@ -0,0 +1,49 @@
+import asyncio
+import logging
+
+
+class Debouncer:
+    # Копит элементы по ключу и передает их в flush одной пачкой,
+    # когда в течение delay секунд по этому ключу не пришло новых.
+    # Если flush не удался, пачка передается в on_error, чтобы о потере узнал отправитель
+    def __init__(self, delay: float, flush, on_error=None):
+        self._delay = delay
+        self._flush = flush
+        self._on_error = on_error
+        self._items = {}
+        self._timers = {}
+        self._tasks = set()
+
+    def add(self, key, item):
+        self._items.setdefault(key, []).append(item)
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        self._timers[key] = asyncio.get_running_loop().call_later(self._delay, self._schedule_flush, key)
+
+    def _schedule_flush(self, key):
+        task = asyncio.create_task(self.flush(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def drain(self):
+        # Сохраняет все накопленное, не дожидаясь паузы, например при остановке бота
+        await asyncio.gather(*(self.flush(key) for key in list(self._items)), *self._tasks)
+
+    async def flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        items = self._items.pop(key, None)
+        if not items:
+            return
+        try:
+            await self._flush(key, items)
+        except Exception as e:
+            logging.exception(f"Error flushing batch: {e}")
+            if self._on_error is None:
+                return
+            try:
+                await self._on_error(key, items)
+            except Exception as e:
+                logging.exception(f"Error reporting failed batch: {e}")
@@ -0,0 +1,54 @@
+from datetime import timedelta
+
+from benchmarks.common import measure, report
+
+from sqlalchemy import insert, or_
+
+from cards import get_request_cards
+from database import engine, migrate, Session
+from models import Machine, Request, ArchivedRequest, utcnow
+
+
+# Выборка открытых заявок работает только с рабочей таблицей, поэтому ее время
+# не должно зависеть от объема архива. Рабочих заявок всегда LIVE, архив растет
+LIVE = 500
+HISTORY = (0, 20_000, 100_000, 300_000)
+
+
+def request_row(request_id, status):
+    return {
+        'id': request_id, 'created_at': utcnow() - timedelta(days=1), 'full_name': 'Клиент', 'phone': '79000000000',
+        'machine_number': '0001', 'engineer_status': status, 'accountant_status': status,
+    }
+
+
+def main():
+    migrate()
+    with Session() as session:
+        session.add(Machine(number='0001', address='ул. Тестовая, 1'))
+        session.commit()
+
+    open_requests = lambda table: or_(table.c.engineer_status == 'open', table.c.accountant_status == 'open')
+    rows = []
+    archived = 0
+    for history in HISTORY:
+        with engine.begin() as connection:
+            if history > archived:
+                connection.execute(insert(ArchivedRequest), [
+                    request_row(request_id, 'closed') for request_id in range(archived + 1, history + 1)
+                ])
+                archived = history
+            connection.execute(Request.__table__.delete())
+            connection.execute(insert(Request), [
+                request_row(request_id, 'open') for request_id in range(history + 1, history + LIVE + 1)
+            ])
+        hot = measure(lambda: get_request_cards(open_requests))
+        full = measure(lambda: get_request_cards(open_requests, archive=True), repeat=3)
+        rows.append((history, LIVE, f"{hot * 1000:.1f}", f"{full * 1000:.1f}"))
+
+    report("Открытые заявки: рабочая таблица против рабочей таблицы с архивом (мс)",
+           rows, ['в архиве', 'рабочих', 'рабочие', 'с архивом'])
+
+
+if __name__ == '__main__':
+    main()
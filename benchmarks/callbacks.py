@@ -0,0 +1,81 @@
+from benchmarks.common import report
+
+from aiogram import Bot, Dispatcher
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+from callbacks import CallbackRouter
+
+import asyncio
+import datetime
+import time
+
+
+# Накладные расходы диспетчеризации нажатия кнопки в aiogram: цепочка обработчиков
+# с фильтрами-лямбдами по префиксу (как было) против одного обработчика с CallbackRouter.
+# Нажимается кнопка последнего зарегистрированного обработчика — худший случай для цепочки
+HANDLERS = (10, 100, 1000)
+UPDATES = 200
+
+
+def factories(count: int):
+    return [
+        type(f'Action{index}', (CallbackData,), {'__annotations__': {'request_id': int}}, prefix=f'action{index}')
+        for index in range(count)
+    ]
+
+
+def linear_dispatcher(count: int):
+    dp = Dispatcher()
+    for index in range(count):
+        async def handler(callback: CallbackQuery):
+            return int(callback.data.split(":")[1])
+        dp.callback_query.register(handler, lambda callback, prefix=f'action{index}:': callback.data.startswith(prefix))
+    return dp
+
+
+def router_dispatcher(classes: list):
+    dp = Dispatcher()
+    router = CallbackRouter()
+    for factory in classes:
+        async def handler(callback: CallbackQuery, callback_data: CallbackData):
+            return callback_data.request_id
+        router.register(factory)(handler)
+    dp.callback_query.register(router.dispatch, router.filter)
+    return dp
+
+
+def updates(data: str):
+    user = User(id=1, is_bot=False, first_name='Сотрудник')
+    message = Message(message_id=1, date=datetime.datetime.now(), chat=Chat(id=1, type='private'), text='карточка')
+    return [
+        Update(update_id=index, callback_query=CallbackQuery(
+            id=str(index), from_user=user, chat_instance='bench', message=message, data=data
+        ))
+        for index in range(UPDATES)
+    ]
+
+
+async def per_update(dp: Dispatcher, bot: Bot, batch: list) -> float:
+    started = time.perf_counter()
+    for update in batch:
+        await dp.feed_update(bot, update)
+    return (time.perf_counter() - started) / len(batch)
+
+
+async def main():
+    bot = Bot(token='123456:bench')
+    rows = []
+    for count in HANDLERS:
+        classes = factories(count)
+        batch = updates(classes[-1](request_id=42).pack())
+        linear = await per_update(linear_dispatcher(count), bot, batch)
+        routed = await per_update(router_dispatcher(classes), bot, batch)
+        rows.append((count, f"{linear * 1e6:.0f}", f"{routed * 1e6:.0f}"))
+    await bot.session.close()
+
+    report("Обработка одного нажатия (мкс)", rows, ['обработчиков', 'цепочка', 'CallbackRouter'])
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
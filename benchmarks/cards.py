@@ -0,0 +1,71 @@
+from datetime import timedelta
+
+from benchmarks.common import measure, report
+
+from sqlalchemy import insert, true
+from sqlalchemy.orm import joinedload, selectinload
+
+from cards import get_request_cards
+from database import engine, migrate, Session
+from models import Comment, Machine, Photo, Request, utcnow
+
+import tracemalloc
+
+
+# Загрузка карточек заявок одним запросом в неизменяемые RequestCard против ORM-объектов
+# Request с автоматом, комментариями и фото: время и память на CARDS заявок
+CARDS = 10_000
+
+
+def load_orm():
+    with Session() as session:
+        requests = session.query(Request).options(
+            joinedload(Request.machine), selectinload(Request.comments), selectinload(Request.photos)
+        ).order_by(Request.id).all()
+        # Карточке нужны комментарии по группам и число фото
+        return [(request, [comment.text for comment in request.comments if comment.added_by == 'engineer'],
+                 [comment.text for comment in request.comments if comment.added_by == 'accountant'],
+                 len(request.photos)) for request in requests]
+
+
+def load_cards():
+    return get_request_cards(lambda table: true())
+
+
+def peak_memory(function) -> float:
+    # Пик выделенной памяти за вызов, МБ
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2 ** 20
+
+
+def main():
+    migrate()
+    created_at = utcnow() - timedelta(days=1)
+    with engine.begin() as connection:
+        connection.execute(insert(Machine), [{'number': '0001', 'address': 'ул. Тестовая, 1', 'model': 'M'}])
+        connection.execute(insert(Request), [
+            {'id': request_id, 'created_at': created_at, 'full_name': 'Клиент', 'phone': '79000000000',
+             'machine_number': '0001', 'issue_description': 'Не выдал товар', 'engineer_status': 'open',
+             'accountant_status': 'open'}
+            for request_id in range(1, CARDS + 1)
+        ])
+        connection.execute(insert(Comment), [
+            {'request_id': request_id, 'text': f"Комментарий {index}", 'added_by': role, 'created_at': created_at}
+            for request_id in range(1, CARDS + 1)
+            for index, role in enumerate(('engineer', 'engineer', 'accountant'))
+        ])
+        connection.execute(insert(Photo), [
+            {'request_id': request_id, 'file_id': f"photo-{request_id}"} for request_id in range(1, CARDS + 1)
+        ])
+
+    assert len(load_cards()) == CARDS
+    rows = [(title, f"{measure(function, repeat=3) * 1000:.0f}", f"{peak_memory(function):.1f}")
+            for title, function in (("ORM", load_orm), ("RequestCard", load_cards))]
+    report(f"Загрузка {CARDS} карточек с комментариями и фото", rows, ['', 'мс', 'пик МБ'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+from pathlib import Path
+
+import os
+import sys
+import tempfile
+import time
+
+
+# Замеры запускаются как модули из корня репозитория: python -m benchmarks.archive.
+# Базы создаются во временном каталоге, рабочие vending.db и archive.db не затрагиваются
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.chdir(tempfile.mkdtemp(prefix='bot-bench-'))
+os.environ.setdefault('BOT_TOKEN', '123456:bench')
+
+
+def measure(function, repeat: int = 5, number: int = 1) -> float:
+    # Лучшее из repeat время одного вызова, в секундах
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, (time.perf_counter() - started) / number)
+    return best
+
+
+def report(title: str, rows: list, columns: list):
+    print(title)
+    widths = [max(len(str(value)) for value in [column, *(row[index] for row in rows)])
+              for index, column in enumerate(columns)]
+    for row in [columns, *rows]:
+        print("  ".join(str(value).rjust(width) for value, width in zip(row, widths)))
+    print()
@@ -0,0 +1,71 @@
+from datetime import timedelta
+
+from benchmarks.common import report
+
+from sqlalchemy import insert
+
+from database import EXPORT_FORMATS, engine, migrate, snapshot_session
+from models import Machine, Request, ArchivedRequest, utcnow
+
+import os
+import time
+import tracemalloc
+
+
+# Выгрузка отчета по всей истории: скорость (строк в секунду), размер файла на строку
+# и пик памяти для каждого формата. Большая часть заявок — в архиве, как в рабочей базе
+ARCHIVED = 90_000
+LIVE = 10_000
+
+
+def request_row(request_id, status):
+    closed_at = utcnow() - timedelta(days=100) if status == 'closed' else None
+    return {
+        'id': request_id, 'created_at': utcnow() - timedelta(days=101), 'full_name': f"Клиент {request_id}",
+        'phone': f"79{request_id:09d}", 'machine_number': f"{request_id % 200:04d}",
+        'issue_description': 'Не выдал товар, деньги списаны', 'payment_method': 'безналичные',
+        'payment_type': 'карта', 'expense_amount': 150.0, 'item_name': 'Капучино', 'expense_time': '12:30',
+        'engineer_status': status, 'engineer_closed_at': closed_at, 'engineer_closed_by': 'Инженер',
+        'accountant_status': status, 'accountant_closed_at': closed_at, 'accountant_closed_by': 'Диспетчер',
+    }
+
+
+def main():
+    migrate()
+    with engine.begin() as connection:
+        connection.execute(insert(Machine), [
+            {'number': f"{number:04d}", 'address': f"ул. Тестовая, {number}", 'priority': number % 3 + 1,
+             'pump': True, 'saturday': True, 'sunday': False, 'ip': 'ИП Иванов'}
+            for number in range(200)
+        ])
+        connection.execute(insert(ArchivedRequest), [request_row(request_id, 'closed')
+                                                     for request_id in range(1, ARCHIVED + 1)])
+        connection.execute(insert(Request), [request_row(request_id, 'open')
+                                             for request_id in range(ARCHIVED + 1, ARCHIVED + LIVE + 1)])
+
+    rows = []
+    total = ARCHIVED + LIVE
+    for name, export in EXPORT_FORMATS.items():
+        with snapshot_session() as session:
+            started = time.perf_counter()
+            path = export(session=session)
+            elapsed = time.perf_counter() - started
+        if path is None:
+            rows.append((name, '—', '—', '—', '—'))
+            continue
+        size = os.path.getsize(path)
+        os.remove(path)
+
+        with snapshot_session() as session:
+            tracemalloc.start()
+            os.remove(export(session=session))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        rows.append((name, f"{elapsed:.1f}", f"{total / elapsed:.0f}", f"{size / total:.1f}", f"{peak / 2 ** 20:.1f}"))
+
+    report(f"Выгрузка {total} заявок ({ARCHIVED} в архиве); parquet — при установленном pyarrow",
+           rows, ['формат', 'с', 'строк/с', 'байт/строку', 'пик МБ'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+from benchmarks.common import measure, report
+
+from aiogram import types
+from aiogram.types import ReplyKeyboardMarkup
+from datetime import timedelta
+
+from cards import get_request_card
+from database import migrate, Session, update_request
+from models import Machine, utcnow
+from presentation import format_datetime
+
+import bot
+import pytz
+
+
+# Стоимость отрисовки карточки заявки до и после кэширования: прежний форматтер даты
+# (словарь месяцев и pytz на каждый вызов) и сборка меню заново против готовых объектов
+CARDS = 2000
+
+
+def old_format_datetime(date_time):
+    months = {
+        1: 'января', 2: 'февраля', 3: 'марта', 4: 'апреля', 5: 'мая', 6: 'июня',
+        7: 'июля', 8: 'августа', 9: 'сентября', 10: 'октября', 11: 'ноября', 12: 'декабря'
+    }
+    moscow_tz = pytz.timezone("Europe/Moscow")
+    target_datetime = date_time.astimezone(moscow_tz)
+    month = months[target_datetime.month]
+    return target_datetime.strftime('%d month %Y, %H:%M').lower().replace('month', month)
+
+
+def old_main_menu():
+    return ReplyKeyboardMarkup(
+        keyboard=[[types.KeyboardButton(text="Открытые заявки")], [types.KeyboardButton(text="Закрытые заявки")],
+                  [types.KeyboardButton(text="Скачать отчет в Excel")]],
+        resize_keyboard=True
+    )
+
+
+def main():
+    migrate()
+    with Session() as session:
+        session.add(Machine(number='0001', address='ул. Тестовая, 1', model='M', name='Кофе'))
+        session.commit()
+    from database import save_to_db
+    request_id = save_to_db({'machine': '0001', 'full_name': 'Клиент', 'phone': '79000000000', 'client_id': 1})
+    update_request(request_id, engineer_status='closed', engineer_closed_at=utcnow() - timedelta(hours=3),
+                   engineer_closed_by='Инженер')
+    card = get_request_card(request_id)
+
+    def render_all():
+        for _ in range(CARDS):
+            bot.render_card(card, 'accountant')
+
+    moment = utcnow()
+    old_date = measure(lambda: [old_format_datetime(moment) for _ in range(CARDS)])
+    new_date = measure(lambda: [format_datetime(moment) for _ in range(CARDS)])
+    old_menu = measure(lambda: [old_main_menu() for _ in range(CARDS)])
+    new_menu = measure(lambda: [bot.MAIN_MENU_KEYBOARDS['accountant'] for _ in range(CARDS)])
+    bot.format_datetime = old_format_datetime
+    old_card = measure(render_all)
+    bot.format_datetime = format_datetime
+    new_card = measure(render_all)
+
+    rows = [
+        ('дата', f"{old_date / CARDS * 1e6:.2f}", f"{new_date / CARDS * 1e6:.2f}"),
+        ('меню', f"{old_menu / CARDS * 1e6:.2f}", f"{new_menu / CARDS * 1e6:.2f}"),
+        ('карточка', f"{old_card / CARDS * 1e6:.2f}", f"{new_card / CARDS * 1e6:.2f}"),
+    ]
+    report("Отрисовка (мкс на вызов)", rows, ['', 'до', 'после'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+from benchmarks.common import ROOT, report
+
+from tests.fake_api import FakeBotAPI, message_update
+
+import asyncio
+import os
+import signal
+import statistics
+import sys
+import time
+
+
+# Холодный старт: от запуска процесса бота до ответа на первый апдейт. Бот работает против
+# локального сервера Bot API, апдейт /start ждет его в первом getUpdates. Для сравнения —
+# запуск с предварительным импортом pandas, как было до ленивого импорта в database.py
+LAUNCHES = 5
+
+
+def child(url: str, preload: str):
+    # Процесс бота: каждый запуск — в новом временном каталоге, с созданием схемы
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    if preload:
+        __import__(preload)
+    import bot
+    bot.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(url))
+    asyncio.run(bot.main())
+
+
+async def launch(preload: str) -> float:
+    async with FakeBotAPI() as api:
+        api.updates = [message_update(1, 1000, '/start')]
+        environment = dict(os.environ, PYTHONPATH=str(ROOT), LOG_FILE=os.devnull)
+        started = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'benchmarks.startup', '--child', api.url, preload, env=environment
+        )
+        await asyncio.wait_for(api.sent.wait(), 60)
+        elapsed = time.perf_counter() - started
+        process.send_signal(signal.SIGTERM)
+        await process.wait()
+        return elapsed
+
+
+def main():
+    rows = []
+    for title, preload in (("pandas по требованию", ''), ("pandas при запуске", 'pandas')):
+        times = [asyncio.run(launch(preload)) for _ in range(LAUNCHES)]
+        rows.append((title, f"{min(times) * 1000:.0f}", f"{statistics.median(times) * 1000:.0f}"))
+    report(f"От запуска процесса до ответа на первый апдейт, {LAUNCHES} запусков (мс)",
+           rows, ['', 'лучшее', 'медиана'])
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else '')
+    else:
+        main()
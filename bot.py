@@ -1,28 +1,58 @@
 ﻿from aiogram import F, Bot, Dispatcher, types
-from aiogram.filters import Command, StateFilter
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import ContentType, CallbackQuery, Message, ReplyKeyboardMarkup, InlineKeyboardMarkup, FSInputFile
-from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
-from datetime import datetime
-from sqlalchemy import or_
+from aiogram.fsm.storage.memory import SimpleEventIsolation
+from aiogram.types import ContentType, CallbackQuery, Message, FSInputFile
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from datetime import timedelta
+from sqlalchemy import and_, or_
 from typing import Any, Dict
 
+from analytics import hotspots
+from archive import run_archiver
+from batching import Debouncer
+from callbacks import CallbackRouter, TakeRequest, ReopenRequest, ViewReport, ConfirmClose, CancelClose, \
+    ConfirmApplication, CancelApplication
+from cards import RequestCard, get_request_card, get_request_cards
 from config import Config
-from database import save_to_db, get_request_by_id, update_request, get_employees_by_groups, machine_exists, add_photo, \
-    add_comment, get_photos, get_comments, get_db_session, get_active_request, export_to_excel
-from middleware import EmployeeMiddleware
-from models import Request, Employee
-
+from database import engine, migrate, save_to_db, get_request_by_id, update_request, machine_exists, add_photos, \
+    add_comments, get_photos, get_active_request, count_in_work, claim_request, export_to_excel, add_card_messages, \
+    get_card_messages, delete_card_messages, request_event, get_request_events, get_turnaround_stats, \
+    unban_user, snapshot_session, bulk_transition, get_employee, get_digest_subscribers, set_digest_subscription, \
+    BULK_ACTIONS, EXPORT_FORMATS
+from digest import Digest, digest_builder, run_digest
+from flood import FloodLimiter
+from lifecycle import InflightMiddleware, install_stop_signals, handover
+from logs import CorrelationMiddleware, HandlerContextMiddleware, bind_request, setup_logging
+from middleware import EmployeeMiddleware, IdempotencyMiddleware, UnitOfWorkMiddleware
+from models import Employee, utcnow
+from outbox import Outbox
+from profiling import profiler
+from presentation import CLIENT_MENU_KEYBOARD, MAIN_MENU_KEYBOARDS, WORK_MENU_KEYBOARDS, DONE_KEYBOARD, \
+    CLOSE_CONFIRMATION_KEYBOARD, CANCEL_KEYBOARD, SKIP_KEYBOARD, PAYMENT_METHOD_KEYBOARD, PAYMENT_TYPE_KEYBOARD, \
+    QR_CONTINUE_KEYBOARD, APPLICATION_CONFIRMATION_KEYBOARD, format_datetime, format_duration
+from routing import routing_table
+from scheduler import scheduler, sla_deadline
+from throttling import ThrottlingMiddleware
+from wizard import FormWizard, InvalidInput, Step
+from workqueue import work_queue
+
+import argparse
 import asyncio
 import logging
 import os
-import pytz
 import re
 
-logging.basicConfig(filename='errors.log', level=logging.ERROR)
 bot = Bot(token=Config.BOT_TOKEN)
-dp = Dispatcher()
+# Апдейты одного пользователя в чате обрабатываются по очереди: двойное нажатие кнопки
+# не выполнит обработчик дважды в одном и том же состоянии
+dp = Dispatcher(events_isolation=SimpleEventIsolation())
+flood_limiter = FloodLimiter(Config.SEND_RATE, Config.SEND_CONCURRENCY)
+callback_router = CallbackRouter()
 
 
 # States для клиента
@@ -32,6 +62,7 @@ class ClientStates(StatesGroup):
     waiting_for_issue = State()
     waiting_for_payment_method = State()
     waiting_for_payment_type = State()
+    waiting_for_qr_refund = State()
     waiting_for_expense_amount = State()
     waiting_for_item_name = State()
     waiting_for_expense_time = State()
@@ -43,11 +74,11 @@ class ClientStates(StatesGroup):
 # Обработчик команды /start для клиентов
 @dp.message(Command("start"))
 async def start_command(message: types.Message, state: FSMContext, **kwargs):
-    await state.clear()
+    await reset_state(state)
     employee = kwargs.get('employee')
     text = kwargs.get('text')
     if employee:
-        request = get_active_request(employee)
+        request = await active_request(employee, state, kwargs.get('session'))
         if request:
             await show_work_menu(message, employee.group == 'engineer', text=f"Работа с заявкой №{request.id}:")
         else:
@@ -62,237 +93,107 @@ async def show_client_menu(message: types.Message, text: str = None):
         "Вас приветствует система обратной связи по работе автоматов и аппаратов.\n"
         "Пожалуйста, заранее найдите номер автомата/аппарата рядом с купюроприемником."
     ) if not text else text
-    menu = ReplyKeyboardMarkup(
-        keyboard=[
-            [types.KeyboardButton(text="Создать заявку")]
-        ],
-        resize_keyboard=True
-    )
-    await message.answer(text, reply_markup=menu)
+    await message.answer(text, reply_markup=CLIENT_MENU_KEYBOARD)
 
 
-# Обработчик кнопки "Создать заявку"
-@dp.message(lambda message: message.text == "Создать заявку")
-async def start_application(message: types.Message, state: FSMContext):
-    await message.answer(
-        "Введите номер автомата/аппарата:\n\nЧетырехзначный номер на прямоугольной шильде.\nПример: 0078",
-        reply_markup=cancel_keyboard())
-    await state.set_state(ClientStates.waiting_for_machine)
+# Заявка, с которой работает сотрудник, хранится в данных FSM: при MAX_IN_WORK > 1
+# отказ, закрытие, фото и комментарии относятся к заявке, взятой последней
+ACTIVE_REQUEST = 'active_request_id'
+
 
+async def select_request(state: FSMContext, request_id: int):
+    await state.update_data({ACTIVE_REQUEST: request_id})
 
-# Клавиатура с кнопкой "Отменить заявку"
-def cancel_keyboard():
-    builder = ReplyKeyboardBuilder()
-    builder.add(types.KeyboardButton(text="Отменить заявку"))
-    return builder.as_markup(resize_keyboard=True)
+
+async def active_request(employee, state: FSMContext, session=None):
+    data = await state.get_data()
+    return get_active_request(employee, data.get(ACTIVE_REQUEST), session=session)
+
+
+async def reset_state(state: FSMContext):
+    # Сбрасывает шаг диалога и его данные, кроме выбранной заявки сотрудника
+    data = await state.get_data()
+    await state.set_state(None)
+    await state.set_data({ACTIVE_REQUEST: data[ACTIVE_REQUEST]} if ACTIVE_REQUEST in data else {})
 
 
 # Обработчик отмены на любом этапе
-@dp.message(lambda message: message.text == "Отменить заявку")
 async def cancel_application(message: types.Message, state: FSMContext, **kwargs):
     employee = kwargs.get('employee')
     await start_command(message, state, text="Заявка отменена", employee=employee)
 
 
-# Обработчик ввода номера автомата
-@dp.message(ClientStates.waiting_for_machine)
-async def process_machine_number(message: types.Message, state: FSMContext):
-    machine_number = message.text.strip() if message.text else ""
+def validate_phone_number(phone_number):
+    # Регулярное выражение для проверки номера
+    pattern = r"^\+7\d{10}$|^8\d{10}$"
+    # Убираем лишние символы (пробелы, дефисы, скобки)
+    cleaned_number = re.sub(r"[^\d+]", "", phone_number)
+    # Проверяем соответствие шаблону
+    return bool(re.match(pattern, cleaned_number))
+
+
+def parse_text(message: Message):
+    return message.text
 
+
+def parse_machine_number(message: Message):
+    machine_number = message.text.strip() if message.text else ""
     if not machine_exists(machine_number):
-        await message.answer(
+        raise InvalidInput(
             f"🚨 Автомат/аппарат с номером {machine_number} не найден.\n"
             "Проверьте номер — он находится над купюроприемником — "
-            "и введите еще раз:",
-            reply_markup=cancel_keyboard()
+            "и введите еще раз:"
         )
-        return
-
-    await state.update_data(machine=machine_number)
-    await message.answer("Приложите фотографию неисправности:", reply_markup=skip_keyboard())
-    await state.set_state(ClientStates.waiting_for_photo)
-
-
-# Клавиатура с кнопкой "Пропустить"
-def skip_keyboard():
-    builder = ReplyKeyboardBuilder()
-    builder.add(types.KeyboardButton(text="Пропустить"))
-    return builder.as_markup(resize_keyboard=True)
-
-
-# Обработчик пропуска на этапе фото
-@dp.message(lambda message: message.text == "Пропустить")
-async def skip_photo(message: types.Message, state: FSMContext):
-    await message.answer("Введите описание неисправности:", reply_markup=cancel_keyboard())
-    await state.set_state(ClientStates.waiting_for_issue)
-
-
-@dp.message(ClientStates.waiting_for_photo)
-async def process_photo(message: Message, state: FSMContext):
-    photo_id = message.photo[-1].file_id if message.photo else None
-    await state.update_data(photo=photo_id)
-
-    await message.answer("Введите описание неисправности:", reply_markup=cancel_keyboard())
-    await state.set_state(ClientStates.waiting_for_issue)
-
-
-# Создаем клавиатуру для выбора способа оплаты
-def get_payment_methods():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [types.KeyboardButton(text="Наличные")],
-            [types.KeyboardButton(text="Безналичные")]
-        ],
-        resize_keyboard=True
-    )
-
-
-@dp.message(ClientStates.waiting_for_issue)
-async def process_issue_description(message: Message, state: FSMContext):
-    await state.update_data(issue_description=message.text)
-
-    await message.answer("Укажите способ оплаты:", reply_markup=get_payment_methods())
-    await state.set_state(ClientStates.waiting_for_payment_method)
-
-
-# Клавиатура для выбора типа безналичной оплаты
-def get_payment_type():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [types.KeyboardButton(text="QR код")],
-            [types.KeyboardButton(text="Карта")]
-        ],
-        resize_keyboard=True
-    )
-
-
-@dp.message(ClientStates.waiting_for_payment_method)
-async def process_payment_method(message: Message, state: FSMContext):
-    payment_method = message.text.lower()
-    if payment_method not in ["безналичные", "наличные"]:
-        await message.answer("Пожалуйста, выберите Наличные или Безналичные:", reply_markup=get_payment_methods())
-        return
+    return machine_number
 
-    await state.update_data(payment_method=payment_method)
 
-    if payment_method == "безналичные":
-        await message.answer("Выберите тип оплаты:", reply_markup=get_payment_type())
-        await state.set_state(ClientStates.waiting_for_payment_type)
-    else:
-        # Пропускаем шаг выбора типа оплаты
-        await message.answer("Укажите сумму затрат:", reply_markup=cancel_keyboard())
-        await state.set_state(ClientStates.waiting_for_expense_amount)
+def parse_photo(message: Message):
+    return message.photo[-1].file_id if message.photo else None
 
 
-@dp.message(ClientStates.waiting_for_payment_type)
-async def process_payment_type(message: Message, state: FSMContext):
-    payment_type = message.text.lower()
-    if payment_type not in ["qr код", "карта", "продолжить оформление"]:
-        await message.answer("Пожалуйста, выберите QR код или Карта:", reply_markup=get_payment_type())
-        return
+def parse_choice(options: list, error: str):
+    def parse(message: Message):
+        choice = (message.text or "").lower()
+        if choice not in options:
+            raise InvalidInput(error)
+        return choice
+    return parse
 
-    if payment_type != "продолжить оформление":
-        await state.update_data(payment_type=payment_type)
-
-    if payment_type == "qr код":
-        # Добавляем кнопку "Продолжить оформление"
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [types.KeyboardButton(text="Продолжить оформление")],
-                [types.KeyboardButton(text="Отменить заявку")]
-            ],
-            resize_keyboard=True
-        )
-        await message.answer(
-            "Пожалуйста, проверьте возврат денег в приложении банка через 3 минуты после покупки.",
-            reply_markup=keyboard
-        )
-    else:
-        await message.answer("Укажите сумму затрат:", reply_markup=cancel_keyboard())
-        await state.set_state(ClientStates.waiting_for_expense_amount)
 
+def parse_qr_continue(message: Message):
+    if message.text != "Продолжить оформление":
+        raise InvalidInput("Пожалуйста, проверьте возврат денег в приложении банка через 3 минуты после покупки.")
 
-@dp.message(F.text == "Продолжить оформление")
-async def continue_after_qr(message: Message, state: FSMContext):
-    await message.answer("Укажите сумму затрат:", reply_markup=cancel_keyboard())
-    await state.set_state(ClientStates.waiting_for_expense_amount)
 
-
-@dp.message(ClientStates.waiting_for_expense_amount)
-async def process_expense_amount(message: Message, state: FSMContext):
+def parse_expense_amount(message: Message):
     try:
         amount = float(message.text)
         if amount < 0:
             raise ValueError
-        await state.update_data(expense_amount=amount)
-        await message.answer("Укажите наименование приобретаемого товара:", reply_markup=cancel_keyboard())
-        await state.set_state(ClientStates.waiting_for_item_name)
+        return amount
     except (ValueError, TypeError):
-        await message.answer("🚨 Пожалуйста, введите корректную сумму (положительное число):",
-                             reply_markup=cancel_keyboard())
-
-
-@dp.message(ClientStates.waiting_for_item_name)
-async def process_item_name(message: Message, state: FSMContext):
-    await state.update_data(item_name=message.text)
-    user_data = await state.get_data()
-    text = "Укажите время списания средств:\n\nМожно посмотреть в приложении банка" if user_data.get(
-        'payment_method') == "безналичные" else "Укажите время покупки:"
-    await message.answer(text, reply_markup=cancel_keyboard())
-    await state.set_state(ClientStates.waiting_for_expense_time)
-
-
-@dp.message(ClientStates.waiting_for_expense_time)
-async def process_expense_time(message: Message, state: FSMContext):
-    await state.update_data(expense_time=message.text)
-    await message.answer("Введите Ваше имя:", reply_markup=cancel_keyboard())
-    await state.set_state(ClientStates.waiting_for_full_name)
+        raise InvalidInput("🚨 Пожалуйста, введите корректную сумму (положительное число):")
 
 
-# Обработчик ввода ФИО
-@dp.message(ClientStates.waiting_for_full_name)
-async def process_full_name(message: types.Message, state: FSMContext):
-    await state.update_data(full_name=message.text.strip())
-    await message.answer("Введите Ваш номер телефона:\n\nНачинайте с 8 или +7, пожалуйста.",
-                         reply_markup=cancel_keyboard())
-    await state.set_state(ClientStates.waiting_for_phone)
+def parse_full_name(message: Message):
+    return (message.text or "").strip()
 
 
-def validate_phone_number(phone_number):
-    # Регулярное выражение для проверки номера
-    pattern = r"^\+7\d{10}$|^8\d{10}$"
-    # Убираем лишние символы (пробелы, дефисы, скобки)
-    cleaned_number = re.sub(r"[^\d+]", "", phone_number)
-    # Проверяем соответствие шаблону
-    return bool(re.match(pattern, cleaned_number))
-
-
-# Обработчик ввода телефона
-@dp.message(ClientStates.waiting_for_phone)
-async def process_phone(message: types.Message, state: FSMContext):
-    phone = message.text.strip()
-
+def parse_phone(message: Message):
+    phone = (message.text or "").strip()
     if not validate_phone_number(phone):
-        await message.answer(
-            "🚨 Проверьте введенный номер — у телефонного номера неверный формат.",
-            reply_markup=cancel_keyboard()
-        )
-        return
+        raise InvalidInput("🚨 Проверьте введенный номер — у телефонного номера неверный формат.")
+    return phone
 
-    user_data = await state.update_data(phone=phone)
 
-    # Создаем клавиатуру подтверждения
-    builder = InlineKeyboardBuilder()
-    builder.add(types.InlineKeyboardButton(
-        text="Подтвердить заявку",
-        callback_data="confirm_application")
-    )
-    builder.add(types.InlineKeyboardButton(
-        text="Отменить заявку",
-        callback_data="cancel_application")
-    )
+def expense_time_prompt(user_data: dict):
+    if user_data.get('payment_method') == "безналичные":
+        return "Укажите время списания средств:\n\nМожно посмотреть в приложении банка"
+    return "Укажите время покупки:"
+
 
-    confirmation_text = (
+def confirmation_prompt(user_data: dict):
+    return (
         "Подтвердите корректность данных:\n\n"
         f"Ваше имя: {user_data['full_name']}\n"
         f"Ваш телефон: {user_data['phone']}\n"
@@ -304,26 +205,133 @@ async def process_phone(message: types.Message, state: FSMContext):
         f"Время покупки/списания средств: {user_data['expense_time']}"
     )
 
-    await message.answer(confirmation_text, reply_markup=builder.as_markup())
-    await state.set_state(ClientStates.confirmation)
+
+CLIENT_STEPS = {
+    ClientStates.waiting_for_machine: Step(
+        prompt="Введите номер автомата/аппарата:\n\nЧетырехзначный номер на прямоугольной шильде.\nПример: 0078",
+        keyboard=CANCEL_KEYBOARD,
+        field='machine',
+        parse=parse_machine_number,
+        next=ClientStates.waiting_for_photo
+    ),
+    ClientStates.waiting_for_photo: Step(
+        prompt="Приложите фотографию неисправности:",
+        keyboard=SKIP_KEYBOARD,
+        field='photo',
+        parse=parse_photo,
+        next=ClientStates.waiting_for_issue,
+        skip="Пропустить"
+    ),
+    ClientStates.waiting_for_issue: Step(
+        prompt="Введите описание неисправности:",
+        keyboard=CANCEL_KEYBOARD,
+        field='issue_description',
+        parse=parse_text,
+        next=ClientStates.waiting_for_payment_method
+    ),
+    ClientStates.waiting_for_payment_method: Step(
+        prompt="Укажите способ оплаты:",
+        keyboard=PAYMENT_METHOD_KEYBOARD,
+        field='payment_method',
+        parse=parse_choice(["безналичные", "наличные"], "Пожалуйста, выберите Наличные или Безналичные:"),
+        # Для наличных пропускаем шаг выбора типа оплаты
+        next=lambda method: ClientStates.waiting_for_payment_type if method == "безналичные"
+        else ClientStates.waiting_for_expense_amount
+    ),
+    ClientStates.waiting_for_payment_type: Step(
+        prompt="Выберите тип оплаты:",
+        keyboard=PAYMENT_TYPE_KEYBOARD,
+        field='payment_type',
+        parse=parse_choice(["qr код", "карта"], "Пожалуйста, выберите QR код или Карта:"),
+        next=lambda payment_type: ClientStates.waiting_for_qr_refund if payment_type == "qr код"
+        else ClientStates.waiting_for_expense_amount
+    ),
+    ClientStates.waiting_for_qr_refund: Step(
+        prompt="Пожалуйста, проверьте возврат денег в приложении банка через 3 минуты после покупки.",
+        keyboard=QR_CONTINUE_KEYBOARD,
+        parse=parse_qr_continue,
+        next=ClientStates.waiting_for_expense_amount
+    ),
+    ClientStates.waiting_for_expense_amount: Step(
+        prompt="Укажите сумму затрат:",
+        keyboard=CANCEL_KEYBOARD,
+        field='expense_amount',
+        parse=parse_expense_amount,
+        next=ClientStates.waiting_for_item_name
+    ),
+    ClientStates.waiting_for_item_name: Step(
+        prompt="Укажите наименование приобретаемого товара:",
+        keyboard=CANCEL_KEYBOARD,
+        field='item_name',
+        parse=parse_text,
+        next=ClientStates.waiting_for_expense_time
+    ),
+    ClientStates.waiting_for_expense_time: Step(
+        prompt=expense_time_prompt,
+        keyboard=CANCEL_KEYBOARD,
+        field='expense_time',
+        parse=parse_text,
+        next=ClientStates.waiting_for_full_name
+    ),
+    ClientStates.waiting_for_full_name: Step(
+        prompt="Введите Ваше имя:",
+        keyboard=CANCEL_KEYBOARD,
+        field='full_name',
+        parse=parse_full_name,
+        next=ClientStates.waiting_for_phone
+    ),
+    ClientStates.waiting_for_phone: Step(
+        prompt="Введите Ваш номер телефона:\n\nНачинайте с 8 или +7, пожалуйста.",
+        keyboard=CANCEL_KEYBOARD,
+        field='phone',
+        parse=parse_phone,
+        next=ClientStates.confirmation
+    ),
+    # Подтверждение — инлайн-кнопками, текстовые сообщения на этом шаге не обрабатываются
+    ClientStates.confirmation: Step(
+        prompt=confirmation_prompt,
+        keyboard=APPLICATION_CONFIRMATION_KEYBOARD
+    ),
+}
+
+client_wizard = FormWizard(CLIENT_STEPS, cancel_text="Отменить заявку", on_cancel=cancel_application)
+
+
+# Обработчик кнопки "Создать заявку"
+@dp.message(F.text == "Создать заявку")
+async def start_application(message: types.Message, state: FSMContext):
+    await client_wizard.enter(message, state, ClientStates.waiting_for_machine)
+
+
+# Все шаги анкеты клиента обрабатываются одним обработчиком
+@dp.message(client_wizard.filter)
+async def process_client_step(message: Message, state: FSMContext, raw_state: str, **kwargs):
+    await client_wizard.handle(message, state, raw_state, **kwargs)
 
 
 # Обработчик подтверждения заявки
-@dp.callback_query(lambda c: c.data == "confirm_application", ClientStates.confirmation)
+@callback_router.register(ConfirmApplication, ClientStates.confirmation)
 async def confirm_application(callback: types.CallbackQuery, state: FSMContext, **kwargs):
-    user_data = await state.get_data()
+    user_data = await state.update_data(client_id=callback.from_user.id)
     employee = kwargs.get('employee')
+    session = kwargs.get('session')
 
-    # Сохраняем данные в БД
+    # Сохраняем данные в БД. Заявка записывается своей транзакцией сразу,
+    # до рассылки: иначе блокировка записи держалась бы, пока идет рассылка
     request_id = save_to_db(user_data)
     if request_id:
+        bind_request(request_id)
         await callback.message.edit_reply_markup(reply_markup=None)
         await start_command(callback.message, state,
                             text="Благодарим за заявку. Наш инженер в ближайшее время устранит неисправность, а деньги за неполученный продукт будут зачислены на указанный Вами мобильный телефон в течение двух рабочих дней.",
                             employee=employee)
-        request = get_request_by_id(request_id)
-        employees = get_employees_by_groups(['engineer', 'accountant', 'manager'])
-        await send_notification(bot, request, employees, callback.from_user.id)
+        request = get_request_card(request_id, session=session)
+        work_queue.sync(request)
+        await send_notification(bot, request, routing_table.recipients(request.machine_number), session=session)
+        if hotspots.record(request.machine_number, request.created_at, request.expense_amount):
+            await alert_hotspot(bot, request)
+        scheduler.schedule(request_id, 'escalation', utcnow() + timedelta(minutes=Config.ESCALATION_MINUTES))
+        scheduler.schedule(request_id, 'sla', sla_deadline(request.created_at, request.machine))
     else:
         await start_command(callback.message, state,
                             text="Ошибка при сохранении заявки. Пожалуйста, попробуйте позже или позвоните на горячую линию.",
@@ -331,26 +339,14 @@ async def confirm_application(callback: types.CallbackQuery, state: FSMContext,
 
 
 # Обработчик отмены через инлайн-кнопку
-@dp.callback_query(lambda c: c.data == "cancel_application", ClientStates.confirmation)
+@callback_router.register(CancelApplication, ClientStates.confirmation)
 async def cancel_confirmation(callback: types.CallbackQuery, state: FSMContext, **kwargs):
     await callback.message.edit_reply_markup(reply_markup=None)
     employee = kwargs.get('employee')
     await start_command(callback.message, state, text="Заявка отменена", employee=employee)
 
 
-def format_datetime(date_time):
-    # Форматирование даты по русской локали
-    MONTHS = {
-        1: 'января', 2: 'февраля', 3: 'марта', 4: 'апреля', 5: 'мая', 6: 'июня',
-        7: 'июля', 8: 'августа', 9: 'сентября', 10: 'октября', 11: 'ноября', 12: 'декабря'
-    }
-    moscow_tz = pytz.timezone("Europe/Moscow")
-    target_datetime = date_time.astimezone(moscow_tz)
-    month = MONTHS[target_datetime.month]
-    return target_datetime.strftime('%d month %Y, %H:%M').lower().replace('month', month)
-
-
-def get_base_info(request: Request, title_appendix: str = ""):
+def get_base_info(request: RequestCard, title_appendix: str = ""):
     created_at = format_datetime(request.created_at)
     district = f"Район: {request.machine.engineer}\n" if request.machine and request.machine.engineer else ""
     return (
@@ -386,10 +382,10 @@ def append_info(message_text, request):
     return message_text
 
 
-def append_engineer_info(report_text, request, comments, photos_count):
-    photo_text = f"Фото от сотрудника: {photos_count} шт."
-    comments_engineers = "Код/комментарии:\n" + "\n".join(
-        [f"{c.text}" for c in comments if c.added_by == 'engineer']) if comments else "Коды/комментарии отсутствуют"
+def append_engineer_info(report_text, request: RequestCard):
+    photo_text = f"Фото от сотрудника: {request.photos_count} шт."
+    comments_engineers = "Код/комментарии:\n" + "\n".join(request.engineer_comments) \
+        if request.engineer_comments else "Коды/комментарии отсутствуют"
     report_text += (
         f"\nИнженер закрыл: {request.engineer_closed_by or 'Не закрыта'}\n"
         f"Когда закрыл инженер: {format_datetime(request.engineer_closed_at) if request.engineer_closed_at else 'Не закрыта'}\n"
@@ -399,9 +395,9 @@ def append_engineer_info(report_text, request, comments, photos_count):
     return report_text
 
 
-def append_accountant_info(report_text, request, comments):
-    comments_accountants = "Код/комментарии:\n" + "\n".join(
-        [f"{c.text}" for c in comments if c.added_by == 'accountant']) if comments else "Коды/комментарии отсутствуют"
+def append_accountant_info(report_text, request: RequestCard):
+    comments_accountants = "Код/комментарии:\n" + "\n".join(request.accountant_comments) \
+        if request.accountant_comments else "Коды/комментарии отсутствуют"
     report_text += (
         f"\nДиспетчер закрыл: {request.accountant_closed_by or 'Не закрыта'}\n"
         f"Когда закрыл диспетчер: {format_datetime(request.accountant_closed_at) if request.accountant_closed_at else 'Не закрыта'}\n"
@@ -410,136 +406,363 @@ def append_accountant_info(report_text, request, comments):
     return report_text
 
 
-async def send_notification(bot: Bot, request: Request, employees: list, user_id: int = None, title_appendix: str = ""):
-    for employee in employees:
-        message_text = get_base_info(request, title_appendix=title_appendix)
-        message_text = append_info(message_text, request)
-        builder = InlineKeyboardBuilder()
-
-        # Кнопки для руководства
-        if employee.group == 'manager':
-            builder.row(
-                types.InlineKeyboardButton(
-                    text="Просмотреть отчет",
-                    callback_data=f"view_report:{request.id}"
-                )
-            )
-            if user_id:
-                message_text += f"\nTelegram ID пользователя: {user_id}"
-        else:  # Кнопки для инженеров и диспетчеров
+STATUS_TITLES = {'open': 'открыта', 'in_work': 'в работе', 'closed': 'закрыта'}
+
+
+def append_status(message_text, request):
+    message_text += (
+        f"\nСтатус у инженера: {STATUS_TITLES.get(request.engineer_status, request.engineer_status)}\n"
+        f"Статус у диспетчера: {STATUS_TITLES.get(request.accountant_status, request.accountant_status)}\n"
+    )
+    return message_text
+
+
+def get_card_keyboard(request: RequestCard, group: str):
+    # Кнопки для руководства
+    if group == 'manager':
+        button = types.InlineKeyboardButton(
+            text="Просмотреть отчет",
+            callback_data=ViewReport(request_id=request.id).pack()
+        )
+    else:  # Кнопки для инженеров и диспетчеров
+        status = request.engineer_status if group == 'engineer' else request.accountant_status
+        if status == 'open':
             button = types.InlineKeyboardButton(
                 text="Взять в работу",
-                callback_data=f"take_request:{request.id}"
+                callback_data=TakeRequest(request_id=request.id).pack()
+            )
+        elif status == 'closed':
+            button = types.InlineKeyboardButton(
+                text="Переоткрыть заявку",
+                callback_data=ReopenRequest(request_id=request.id).pack()
             )
-            if request.accountant_status == 'closed' and employee.group == 'accountant' or request.engineer_status == 'closed' and employee.group == 'engineer':
-                button = types.InlineKeyboardButton(
-                    text="Переоткрыть заявку",
-                    callback_data=f"reopen:{request.id}"
-                )
-            builder.row(button)
-            if employee.group == 'accountant':
-                photos = get_photos(request.id)
-                comments = get_comments(request.id)
-                message_text = append_engineer_info(message_text, request, comments, len(photos))
-
-        keyboard = builder.as_markup()
+        else:
+            # Заявка уже в работе, взять ее больше нельзя
+            return None
+    builder = InlineKeyboardBuilder()
+    builder.row(button)
+    return builder.as_markup()
+
+
+def render_card(request: RequestCard, group: str, title_appendix: str = ""):
+    message_text = get_base_info(request, title_appendix=title_appendix)
+    message_text = append_info(message_text, request)
+    if group == 'accountant':
+        message_text = append_engineer_info(message_text, request)
+    message_text = append_status(message_text, request)
+    if group == 'manager' and request.client_id:
+        message_text += f"\nTelegram ID пользователя: {request.client_id}"
+    return message_text, get_card_keyboard(request, group)
+
+
+async def send_card(chat_id: int, request: RequestCard, message_text: str, keyboard):
+    if request.photo:
+        return await bot.send_photo(
+            chat_id=chat_id,
+            photo=request.photo,
+            caption=message_text,
+            reply_markup=keyboard,
+            parse_mode='HTML'
+        )
+    return await bot.send_message(
+        chat_id=chat_id,
+        text=message_text,
+        reply_markup=keyboard,
+        parse_mode='HTML'
+    )
+
+
+async def edit_card(chat_id: int, message_id: int, has_photo: bool, message_text: str, keyboard):
+    if has_photo:
+        await bot.edit_message_caption(
+            chat_id=chat_id,
+            message_id=message_id,
+            caption=message_text,
+            reply_markup=keyboard,
+            parse_mode='HTML'
+        )
+    else:
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=message_id,
+            text=message_text,
+            reply_markup=keyboard,
+            parse_mode='HTML'
+        )
+
+
+async def deliver_card(message):
+    # Повторная отправка из очереди: карточка рисуется по текущему состоянию заявки
+    request = get_request_card(message.request_id)
+    if request is None:
+        return
+    message_text, keyboard = render_card(request, message.group, title_appendix=message.title_appendix)
+    message_id, has_photo = message.message_id, message.has_photo
+    if message_id is None:
+        # Карточку могли отправить, пока запись ждала в очереди: тогда только обновляем ее
+        card = next((card for card in get_card_messages([request.id]) if card.chat_id == message.chat_id), None)
+        if card:
+            message_id, has_photo = card.message_id, card.has_photo
+
+    if message_id is None:
+        sent = await send_card(message.chat_id, request, message_text, keyboard)
+        add_card_messages(request.id, [(sent.chat.id, sent.message_id, message.group, bool(request.photo))])
+        return
+    try:
+        await edit_card(message.chat_id, message_id, has_photo, message_text, keyboard)
+    except TelegramBadRequest as e:
+        if 'message is not modified' not in e.message:
+            raise
+
+
+outbox = Outbox(deliver_card, flood_limiter, Config.OUTBOX_RETRY_BASE, Config.OUTBOX_RETRY_MAX)
+
+
+async def send_notification(bot: Bot, request: RequestCard, employees: list, title_appendix: str = "",
+                            session=None):
+    renders = {}
+    for employee in employees:
+        if employee.group not in renders:
+            renders[employee.group] = render_card(request, employee.group, title_appendix=title_appendix)
 
+    async def send(employee):
+        message_text, keyboard = renders[employee.group]
         try:
-            if request.photo:
-                await bot.send_photo(
-                    chat_id=employee.telegram_id,
-                    photo=request.photo,
-                    caption=message_text,
-                    reply_markup=keyboard,
-                    parse_mode='HTML'
-                )
-            else:
-                await bot.send_message(
-                    chat_id=employee.telegram_id,
-                    text=message_text,
-                    reply_markup=keyboard,
-                    parse_mode='HTML'
-                )
+            async with flood_limiter:
+                message = await send_card(employee.telegram_id, request, message_text, keyboard)
+            return message.chat.id, message.message_id, employee.group, bool(request.photo)
         except Exception as e:
+            # При временной ошибке карточка будет отправлена из очереди
+            if outbox.postpone(e, request.id, employee.telegram_id, employee.group, title_appendix=title_appendix):
+                return None
             logging.exception(f"Error sending notification: {e}")
-            print(f"Error sending notification: {e}")
+            return None
+
+    cards = await asyncio.gather(*(send(employee) for employee in employees))
+    # Запоминаем отправленные карточки, чтобы обновлять их при смене статуса
+    cards = [card for card in cards if card]
+    if cards:
+        add_card_messages(request.id, cards, session=session)
+
+
+async def refresh_cards(bot: Bot, request_id: int, notify: list = None, title_appendix: str = "", session=None):
+    # Обновляет все ранее отправленные карточки заявки вместо рассылки новых сообщений.
+    # С сессией апдейта карточки рисуются с учетом еще не записанных изменений
+    request = get_request_card(request_id, session=session)
+    await refresh_request_cards(bot, [request], notify=notify, title_appendix=title_appendix, session=session)
+
+
+async def refresh_request_cards(bot: Bot, requests: list, notify: list = None, title_appendix: str = "",
+                                session=None):
+    # Обновление карточек нескольких заявок одной рассылкой: записи о карточках читаются одним запросом,
+    # каждая карточка рисуется один раз на заявку и группу, правки идут через общий flood_limiter
+    # Вызывается при каждой смене статуса, поэтому здесь же обновляем таймеры и очередь заявок
+    sync_timers(requests)
+    for request in requests:
+        work_queue.sync(request)
+    requests = {request.id: request for request in requests}
+    cards = get_card_messages(list(requests), session=session)
+    renders = {
+        key: render_card(requests[key[0]], key[1]) for key in {(card.request_id, card.group) for card in cards}
+    }
+    missing = []
+
+    async def edit(card):
+        message_text, keyboard = renders[card.request_id, card.group]
+        try:
+            async with flood_limiter:
+                await edit_card(card.chat_id, card.message_id, card.has_photo, message_text, keyboard)
+        except TelegramBadRequest as e:
+            if 'message is not modified' in e.message:
+                return
+            if 'message to edit not found' in e.message:
+                missing.append(card.id)
+                return
+            logging.exception(f"Error editing card: {e}")
+        except Exception as e:
+            if outbox.postpone(e, card.request_id, card.chat_id, card.group, message_id=card.message_id,
+                               has_photo=card.has_photo):
+                return
+            logging.exception(f"Error editing card: {e}")
+
+    # Тем, у кого карточки заявки еще нет, отправляем новую
+    sends = []
+    if notify:
+        known = {(card.request_id, card.chat_id) for card in cards} | outbox.pending_chats(list(requests))
+        for request in requests.values():
+            employees = [employee for employee in notify if (request.id, employee.telegram_id) not in known]
+            if employees:
+                sends.append(send_notification(bot, request, employees, title_appendix=title_appendix,
+                                               session=session))
+
+    await asyncio.gather(*(edit(card) for card in cards), *sends)
+    if missing:
+        delete_card_messages(missing, session=session)
+
+
+def open_groups(request: RequestCard):
+    # Группы, в которых заявку еще никто не взял в работу
+    return [
+        group for group, status in (('engineer', request.engineer_status), ('accountant', request.accountant_status))
+        if status == 'open'
+    ]
+
+
+def sync_timers(requests: list):
+    # Таймеры нужны, пока заявку не взяли в работу и инженер, и диспетчер
+    scheduler.cancel([request.id for request in requests if not open_groups(request)])
+    for request in requests:
+        if open_groups(request) and not scheduler.pending(request.id, 'sla'):
+            scheduler.schedule(request.id, 'sla', sla_deadline(utcnow(), request.machine))
+
+
+async def escalate_request(request_id: int):
+    # Если заявку никто не взял, рассылаем ее всей группе и руководству
+    request = get_request_card(request_id)
+    groups = open_groups(request)
+    if not groups:
+        return
+    employees = routing_table.employees(groups + ['manager'])
+    await refresh_cards(bot, request_id, notify=employees, title_appendix="не взята в работу")
+
+
+async def sla_expired(request_id: int):
+    # Срок взятия в работу истек: напоминаем ответственным и сообщаем руководству
+    request = get_request_card(request_id)
+    groups = open_groups(request)
+    if not groups:
+        return
+
+    text = f"⏰ Заявка №{request.id} не взята в работу в срок!\nНомер автомата/аппарата: {request.machine_number}"
+
+    async def remind(employee):
+        try:
+            async with flood_limiter:
+                await bot.send_message(chat_id=employee.telegram_id, text=text)
+        except Exception as e:
+            logging.exception(f"Error sending reminder: {e}")
+
+    await asyncio.gather(*(remind(employee) for employee in routing_table.recipients(request.machine_number, groups)))
+    # Пока заявку не возьмут, напоминание повторяется через такой же срок
+    await refresh_cards(bot, request_id, notify=routing_table.employees(['manager']), title_appendix="просрочена")
+
+
+def format_hotspot(hotspot):
+    return (f"Автомат №{hotspot.machine_number}: {hotspot.recent_rate:.1f} заявок/сутки "
+            f"(обычно {hotspot.baseline_rate:.1f}), возвраты {hotspot.refunds:.0f} руб.")
 
 
-@dp.callback_query(lambda c: c.data.startswith("take_request:"))
-async def take_request_handler(callback: types.CallbackQuery, **kwargs):
+async def alert_hotspot(bot: Bot, request: RequestCard):
+    # Частота заявок по автомату резко выросла — сообщаем руководству
+    hotspot = hotspots.hotspot(request.machine_number, utcnow())
+    text = f"⚠️ Автомат часто ломается!\n{format_hotspot(hotspot)}"
+    if request.machine:
+        text += f"\nАдрес: {request.machine.address}"
+
+    async def alert(employee):
+        try:
+            async with flood_limiter:
+                await bot.send_message(chat_id=employee.telegram_id, text=text)
+        except Exception as e:
+            logging.exception(f"Error sending hotspot alert: {e}")
+
+    await asyncio.gather(*(alert(employee) for employee in routing_table.employees(['manager'])))
+
+
+scheduler.register('escalation', escalate_request)
+scheduler.register('sla', sla_expired)
+
+
+@callback_router.register(TakeRequest)
+async def take_request_handler(callback: types.CallbackQuery, callback_data: TakeRequest, state: FSMContext,
+                               **kwargs):
     await callback.answer()
     employee = kwargs.get('employee')
-    if not employee:
+    session = kwargs.get('session')
+    if not employee or employee.group not in ['engineer', 'accountant']:
         await callback.answer("Доступ запрещен!")
         return
 
-    if get_active_request(employee):
+    if count_in_work(employee, session=session) >= Config.MAX_IN_WORK:
         await callback.answer("У вас уже есть заявка в работе!")
         return
 
-    request_id = int(callback.data.split(":")[1])
-    request = get_request_by_id(request_id)
+    request_id = callback_data.request_id
+    request = get_request_by_id(request_id, session=session)
 
-    data = {}
-    if employee.group == 'engineer':
-        # Проверки
-        if request.engineer_status == 'closed':
-            await callback.answer("Заявка уже закрыта!")
-            return
+    # Проверки
+    status = request.engineer_status if employee.group == 'engineer' else request.accountant_status
+    if status == 'closed':
+        await callback.answer("Заявка уже закрыта!")
+        return
 
-        if request.engineer_status == 'in_work':
-            await callback.answer("Заявка уже обрабатывается!")
-            return
+    if status == 'in_work':
+        await callback.answer("Заявка уже обрабатывается!")
+        return
 
-        # Назначаем заявку
-        data['engineer_id'] = employee.id
-        data['engineer_status'] = 'in_work'
+    # Назначаем заявку. Если ее успели взять после проверки, условный UPDATE ничего не изменит
+    if claim_request(request_id, employee, Config.MAX_IN_WORK):
+        await select_request(state, request_id)
+        # Обновляем меню сотрудника
+        await show_work_menu(callback.message, employee.group == 'engineer', text=f"Работа с заявкой №{request.id}:")
+        await refresh_cards(bot, request_id, session=session)
+    else:
+        await callback.answer("Заявка уже обрабатывается!")
 
-    if employee.group == 'accountant':
-        # Проверки
-        if request.accountant_status == 'closed':
-            await callback.answer("Заявка уже закрыта!")
-            return
 
-        if request.accountant_status == 'in_work':
-            await callback.answer("Заявка уже обрабатывается!")
-            return
+def can_take(employee):
+    # Заявки автомата может взять тот, кому они направляются по району
+    def eligible(machine_number):
+        return any(recipient.id == employee.id
+                   for recipient in routing_table.recipients(machine_number, [employee.group]))
+    return eligible
 
-        # Назначаем заявку
-        data['accountant_id'] = employee.id
-        data['accountant_status'] = 'in_work'
 
-    if update_request(request_id, **data):
-        # Обновляем меню сотрудника
-        await show_work_menu(callback.message, employee.group == 'engineer', text=f"Работа с заявкой №{request.id}:")
-    else:
-        await callback.message.answer("Ошибка при взятии заявки в работу!")
+@dp.message(F.text == "Взять следующую")
+async def take_next_handler(message: Message, state: FSMContext, **kwargs):
+    employee = kwargs.get('employee')
+    session = kwargs.get('session')
+    if not employee or employee.group not in ['engineer', 'accountant']:
+        await message.answer("Доступ запрещен!")
+        return
+
+    if count_in_work(employee, session=session) >= Config.MAX_IN_WORK:
+        await message.answer("У вас уже есть заявка в работе!")
+        return
+
+    while True:
+        request_id = work_queue.pop(employee.group, can_take(employee))
+        if request_id is None:
+            await message.answer("Нет открытых заявок")
+            return
+        if claim_request(request_id, employee, Config.MAX_IN_WORK):
+            break
+        # Заявку уже взяли или сотрудник успел взять другую: возвращаем ее в очередь, если она еще открыта
+        request = get_request_card(request_id)
+        if request:
+            work_queue.sync(request)
+        if count_in_work(employee) >= Config.MAX_IN_WORK:
+            await message.answer("У вас уже есть заявка в работе!")
+            return
+
+    await select_request(state, request_id)
+    await show_work_menu(message, employee.group == 'engineer', text=f"Работа с заявкой №{request_id}:")
+    # Карточку получает и сотрудник, у которого ее еще не было
+    await refresh_cards(bot, request_id, notify=[employee], session=session)
 
 
 async def show_work_menu(message: types.Message, engineer: bool = False, text: str = None):
-    buttons = [
-        [types.KeyboardButton(text="Добавить код/комментарий")]
-    ]
-    if engineer:
-        buttons.append([types.KeyboardButton(text="Добавить фото")])
-    buttons.extend([
-        [types.KeyboardButton(text="Закрыть заявку")],
-        [types.KeyboardButton(text="Отказаться от заявки")]
-    ])
-    menu = ReplyKeyboardMarkup(
-        keyboard=buttons,
-        resize_keyboard=True
-    )
-    await message.answer("Рабочее меню:" if not text else text, reply_markup=menu)
+    await message.answer("Рабочее меню:" if not text else text, reply_markup=WORK_MENU_KEYBOARDS[engineer])
 
 
 @dp.message(F.text == "Отказаться от заявки")
-async def cancel_request_handler(message: Message, **kwargs):
+async def cancel_request_handler(message: Message, state: FSMContext, **kwargs):
     employee = kwargs.get('employee')
+    session = kwargs.get('session')
     if not employee or employee.group not in ['engineer', 'accountant']:
         await callback.answer("Доступ запрещен!")
         return
-    request = get_active_request(employee)
+    request = await active_request(employee, state, session)
     if not request:
         await message.answer("У вас нет активных заявок!")
         return
@@ -553,11 +776,12 @@ async def cancel_request_handler(message: Message, **kwargs):
         data['accountant_id'] = None
         data['accountant_status'] = 'open'
 
-    if update_request(request.id, **data):
+    if update_request(request.id, event=request_event('refuse', employee), session=session, **data):
         await message.answer(
             "Вы отказались от заявки!",
             reply_markup=types.ReplyKeyboardRemove()
         )
+        await refresh_cards(bot, request.id, session=session)
     else:
         await message.answer("Ошибка при отказе от заявки!")
     await show_main_menu(message, employee.group)
@@ -570,24 +794,12 @@ class EmployeeStates(StatesGroup):
 
 
 async def show_main_menu(message: types.Message, group: str, text: str = None):
-    buttons = [
-        [types.KeyboardButton(text="Открытые заявки")],
-        [types.KeyboardButton(text="Закрытые заявки")]
-    ]
-    if group in ['manager', 'accountant']:
-        buttons.extend([
-            [types.KeyboardButton(text="Скачать отчет в Excel")]
-        ])
-    if group in ['manager']:
-        buttons.extend([
-            [types.KeyboardButton(text="Создать заявку")]
-        ])
-
-    menu = ReplyKeyboardMarkup(
-        keyboard=buttons,
-        resize_keyboard=True
-    )
-    await message.answer("Главное меню:" if not text else text, reply_markup=menu)
+    await message.answer("Главное меню:" if not text else text, reply_markup=MAIN_MENU_KEYBOARDS[group])
+
+
+def export_snapshot(export=export_to_excel):
+    with snapshot_session() as session:
+        return export(session=session)
 
 
 # Обработчик для списка активных заявок
@@ -598,7 +810,8 @@ async def download_report(message: Message, **kwargs):
         await message.answer("Доступ запрещен!")
         return
 
-    file_path = export_to_excel()
+    # Отчет строится по снимку базы в отдельном потоке и не задерживает обработку других апдейтов
+    file_path = await asyncio.to_thread(export_snapshot)
     file = FSInputFile(file_path)
     await bot.send_document(message.from_user.id, file, caption="Ваш отчет готов!")
     os.remove(file_path)
@@ -607,6 +820,70 @@ async def download_report(message: Message, **kwargs):
     await show_main_menu(message, employee.group)
 
 
+async def send_digest_file(chat_id: int, digest: Digest):
+    # Файл загружается в Telegram один раз, дальше отправляется по file_id
+    async with flood_limiter:
+        message = await bot.send_document(chat_id, digest.file_id or FSInputFile(digest.path), caption=digest.caption)
+    digest.file_id = message.document.file_id
+
+
+async def send_digest(digest: Digest):
+    async def send(employee):
+        try:
+            await send_digest_file(employee.telegram_id, digest)
+        except Exception as e:
+            logging.exception(f"Error sending digest: {e}")
+
+    subscribers = get_digest_subscribers()
+    if subscribers:
+        await send(subscribers[0])
+        await asyncio.gather(*(send(employee) for employee in subscribers[1:]))
+
+
+# Ежедневная сводка: /digest — последняя сводка, /digest on|off — подписка на рассылку
+@dp.message(Command("digest"))
+async def digest_command(message: Message, command: CommandObject, **kwargs):
+    employee = kwargs.get('employee')
+    if not employee or employee.group not in ['accountant', 'manager']:
+        await message.answer("Доступ запрещен!")
+        return
+
+    args = (command.args or "").strip()
+    if args in ('on', 'off'):
+        set_digest_subscription(employee, args == 'on')
+        await message.answer(
+            f"Сводка будет приходить ежедневно в {Config.DIGEST_TIME.strftime('%H:%M')}" if args == 'on'
+            else "Рассылка сводки отключена"
+        )
+        return
+
+    # Обычно сводка уже построена по расписанию; после перезапуска строим ее один раз здесь
+    digest = digest_builder.latest or await asyncio.to_thread(digest_builder.build, utcnow())
+    await send_digest_file(message.chat.id, digest)
+
+
+# Полная выгрузка в другом формате: /export csv — сжатый CSV, /export parquet — Parquet.
+# Оба пишутся потоком и намного меньше XLSX, что важно при ограничении Telegram на размер файла
+@dp.message(Command("export"))
+async def export_command(message: Message, command: CommandObject, **kwargs):
+    employee = kwargs.get('employee')
+    if not employee or employee.group not in ['accountant', 'manager']:
+        await message.answer("Доступ запрещен!")
+        return
+
+    export = EXPORT_FORMATS.get((command.args or "csv").strip().lower())
+    if not export:
+        await message.answer(f"Формат: /export {'|'.join(EXPORT_FORMATS)}")
+        return
+
+    file_path = await asyncio.to_thread(export_snapshot, export)
+    if not file_path:
+        await message.answer("Этот формат недоступен на сервере")
+        return
+    await bot.send_document(message.from_user.id, FSInputFile(file_path), caption="Ваш отчет готов!")
+    os.remove(file_path)
+
+
 # Обработчик для списка активных заявок
 @dp.message(F.text == "Открытые заявки")
 async def show_open_requests(message: Message, **kwargs):
@@ -615,38 +892,28 @@ async def show_open_requests(message: Message, **kwargs):
         await message.answer("Доступ запрещен!")
         return
 
-    session = get_db_session()
+    session = kwargs.get('session')
     try:
-        open_requests = None
         if employee.group == 'engineer':
-            open_requests = session.query(Request).filter(
-                Request.engineer_status == 'open'
-            ).all()
+            condition = lambda table: table.c.engineer_status == 'open'
         elif employee.group == 'accountant':
-            open_requests = session.query(Request).filter(
-                Request.accountant_status == 'open'
-            ).all()
-        elif employee.group == 'manager':
-            open_requests = session.query(Request).filter(
-                or_(
-                    Request.accountant_status != 'closed',
-                    Request.engineer_status != 'closed'
-                )
-            ).all()
+            condition = lambda table: table.c.accountant_status == 'open'
+        else:
+            condition = lambda table: or_(
+                table.c.accountant_status != 'closed',
+                table.c.engineer_status != 'closed'
+            )
+        open_requests = get_request_cards(condition, session=session)
 
         if not open_requests:
             await message.answer("Нет открытых заявок")
             return
 
         for request in open_requests:
-            request = get_request_by_id(request.id)
-            await send_notification(bot, request, [employee])
+            await send_notification(bot, request, [employee], session=session)
     except Exception as e:
         await message.answer("Ошибка при получении заявок")
         logging.exception(f"Error getting requests: {e}")
-        print(f"Error getting requests: {e}")
-    finally:
-        session.close()
 
 
 # Обработчик для списка закрытых заявок
@@ -657,54 +924,51 @@ async def show_closed_requests(message: Message, **kwargs):
         await message.answer("Доступ запрещен!")
         return
 
-    session = get_db_session()
+    session = kwargs.get('session')
     try:
-        closed_requests = None
         if employee.group == 'engineer':
-            closed_requests = session.query(Request).filter(
-                Request.engineer_id == employee.id,
-                Request.engineer_status == 'closed'
-            ).all()
+            condition = lambda table: and_(
+                table.c.engineer_id == employee.id,
+                table.c.engineer_status == 'closed'
+            )
         elif employee.group == 'accountant':
-            closed_requests = session.query(Request).filter(
-                Request.accountant_id == employee.id,
-                Request.accountant_status == 'closed'
-            ).all()
-        elif employee.group == 'manager':
-            closed_requests = session.query(Request).filter(
-                Request.accountant_status == 'closed',
-                Request.engineer_status == 'closed'
-            ).all()
+            condition = lambda table: and_(
+                table.c.accountant_id == employee.id,
+                table.c.accountant_status == 'closed'
+            )
+        else:
+            condition = lambda table: and_(
+                table.c.accountant_status == 'closed',
+                table.c.engineer_status == 'closed'
+            )
+        closed_requests = get_request_cards(condition, session=session)
 
         if not closed_requests:
             await message.answer("Нет закрытых заявок")
             return
 
         for request in closed_requests:
-            await send_notification(bot, request, [employee])
+            await send_notification(bot, request, [employee], session=session)
     except Exception as e:
         await message.answer("Ошибка при получении заявок")
         logging.exception(f"Error getting requests: {e}")
-        print(f"Error getting requests: {e}")
-    finally:
-        session.close()
 
 
-@dp.callback_query(lambda c: c.data.startswith("reopen:"))
-async def reopen_request_handler(callback: types.CallbackQuery, **kwargs):
+@callback_router.register(ReopenRequest)
+async def reopen_request_handler(callback: types.CallbackQuery, callback_data: ReopenRequest, state: FSMContext,
+                                 **kwargs):
     await callback.answer()
     employee = kwargs.get('employee')
     if not employee or employee.group not in ['engineer', 'accountant']:
         await callback.answer("Доступ запрещен!")
         return
 
-    request = get_active_request(employee)
-    if request:
+    session = kwargs.get('session')
+    if count_in_work(employee, session=session) >= Config.MAX_IN_WORK:
         await callback.answer("У вас уже есть заявка в работе!")
         return
 
-    request_id = callback.data.split(":")[1]
-    request = get_request_by_id(request_id)
+    request = get_request_by_id(callback_data.request_id, session=session)
 
     data = {}
     if employee.group == 'engineer' and request.engineer_id == employee.id:
@@ -715,21 +979,15 @@ async def reopen_request_handler(callback: types.CallbackQuery, **kwargs):
         await callback.answer("Вы не можете переоткрыть эту заявку!")
         return
 
-    if update_request(request.id, **data):
+    if update_request(request.id, event=request_event('reopen', employee), session=session, **data):
+        await select_request(state, request.id)
         # Возвращаем основное меню
         await show_work_menu(callback.message, employee.group == 'engineer', text=f"Заявка №{request.id} переоткрыта:")
+        await refresh_cards(bot, request.id, session=session)
     else:
         await callback.message.answer("Ошибка при переоткрытии заявки!")
 
 
-# Функция для создания клавиатуры Готово
-def get_done_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[[types.KeyboardButton(text="Готово")]],
-        resize_keyboard=True
-    )
-
-
 # Обработчик добавления фото
 @dp.message(F.text == "Добавить фото")
 async def add_photo_handler(message: Message, state: FSMContext, **kwargs):
@@ -737,27 +995,41 @@ async def add_photo_handler(message: Message, state: FSMContext, **kwargs):
     if not employee or employee.group not in ['engineer']:
         await message.answer("Доступ запрещен!")
         return
-    request = get_active_request(employee)
+    request = await active_request(employee, state, kwargs.get('session'))
     if not request:
         await message.answer("У вас нет активных заявок!")
         return
 
     await state.update_data(request_id=request.id)
-    await message.answer("Отправьте фото:", reply_markup=get_done_keyboard())
+    await message.answer("Отправьте фото:", reply_markup=DONE_KEYBOARD)
     await state.set_state(EmployeeStates.waiting_for_photo)
 
 
+async def save_photos(key, items):
+    chat_id, request_id = key
+    # Элементы пачки — пары (file_id, сотрудник), сотрудник нужен для журнала событий
+    photo_ids = [photo_id for photo_id, _ in items]
+    add_photos(request_id, photo_ids, items[-1][1])
+    text = "Фото успешно добавлено!" if len(photo_ids) == 1 else f"Фото успешно добавлены: {len(photo_ids)} шт."
+    await bot.send_message(chat_id, f"{text} Отправьте еще или нажмите 'Готово'.", reply_markup=DONE_KEYBOARD)
+    await refresh_cards(bot, request_id)
+
+
+async def photos_not_saved(key, items):
+    chat_id, _ = key
+    await bot.send_message(chat_id, f"Ошибка при сохранении фото ({len(items)} шт.), отправьте их еще раз.",
+                           reply_markup=DONE_KEYBOARD)
+
+
+# Альбом приходит отдельными сообщениями, поэтому фото копятся и сохраняются одной пачкой
+photo_batches = Debouncer(Config.INGEST_DEBOUNCE, save_photos, on_error=photos_not_saved)
+
+
 # Обработчик фото
 @dp.message(EmployeeStates.waiting_for_photo, F.content_type == ContentType.PHOTO)
-async def process_photo(message: Message, state: FSMContext):
+async def process_photo(message: Message, state: FSMContext, **kwargs):
     data = await state.get_data()
-    request_id = data['request_id']
-    photo_id = message.photo[-1].file_id
-
-    add_photo(request_id, photo_id)
-
-    await message.answer("Фото успешно добавлено! Отправьте еще или нажмите 'Готово'.",
-                         reply_markup=get_done_keyboard())
+    photo_batches.add((message.chat.id, data['request_id']), (message.photo[-1].file_id, kwargs.get('employee')))
 
 
 @dp.message(EmployeeStates.waiting_for_photo, F.text == "Готово")
@@ -767,8 +1039,10 @@ async def finish_adding_photos(message: Message, state: FSMContext, **kwargs):
         await callback.answer("Доступ запрещен!")
         return
 
+    data = await state.get_data()
+    await photo_batches.flush((message.chat.id, data['request_id']))
     await message.answer("Добавление фото завершено.", reply_markup=None)
-    await state.clear()
+    await reset_state(state)
     await show_work_menu(message, employee.group == 'engineer')
 
 
@@ -779,16 +1053,35 @@ async def add_comment_handler(message: Message, state: FSMContext, **kwargs):
     if not employee or employee.group not in ['engineer', 'accountant']:
         await message.answer("Доступ запрещен!")
         return
-    request = get_active_request(employee)
+    request = await active_request(employee, state, kwargs.get('session'))
     if not request:
         await message.answer("У вас нет активных заявок!")
         return
 
     await state.update_data(request_id=request.id, role=employee.group)
-    await message.answer("Введите ваш комментарий или код:", reply_markup=get_done_keyboard())
+    await message.answer("Введите ваш комментарий или код:", reply_markup=DONE_KEYBOARD)
     await state.set_state(EmployeeStates.waiting_for_comment)
 
 
+async def save_comments(key, items):
+    chat_id, request_id, role = key
+    texts = [text for text, _ in items]
+    add_comments(request_id, texts, role, items[-1][1])
+    text = "Код/комментарий успешно добавлен!" if len(texts) == 1 else \
+        f"Коды/комментарии успешно добавлены: {len(texts)} шт."
+    await bot.send_message(chat_id, f"{text} Введите еще или нажмите 'Готово'.", reply_markup=DONE_KEYBOARD)
+    await refresh_cards(bot, request_id)
+
+
+async def comments_not_saved(key, items):
+    chat_id, _, _ = key
+    await bot.send_message(chat_id, f"Ошибка при сохранении кодов/комментариев ({len(items)} шт.), "
+                                    f"отправьте их еще раз.", reply_markup=DONE_KEYBOARD)
+
+
+comment_batches = Debouncer(Config.INGEST_DEBOUNCE, save_comments, on_error=comments_not_saved)
+
+
 # Обработчик комментария
 @dp.message(EmployeeStates.waiting_for_comment)
 async def process_comment(message: Message, state: FSMContext, **kwargs):
@@ -798,8 +1091,10 @@ async def process_comment(message: Message, state: FSMContext, **kwargs):
         return
 
     if message.text == "Готово":
+        data = await state.get_data()
+        await comment_batches.flush((message.chat.id, data['request_id'], data['role']))
         await message.answer("Добавление кодов и комментариев завершено.", reply_markup=None)
-        await state.clear()
+        await reset_state(state)
         await show_work_menu(message, employee.group == 'engineer')
         return
 
@@ -808,36 +1103,18 @@ async def process_comment(message: Message, state: FSMContext, **kwargs):
         return
 
     data = await state.get_data()
-    request_id = data['request_id']
-    role = data['role']
-
-    add_comment(request_id, message.text, role)
-
-    await message.answer("Код/комментарий успешно добавлен! Введите еще или нажмите 'Готово'.",
-                         reply_markup=get_done_keyboard())
-
-
-# Функция для создания клавиатуры подтверждения
-def get_confirmation_keyboard():
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                types.InlineKeyboardButton(text="Подтвердить", callback_data=f"confirm_close"),
-                types.InlineKeyboardButton(text="Отменить", callback_data=f"cancel_close")
-            ]
-        ]
-    )
+    comment_batches.add((message.chat.id, data['request_id'], data['role']), (message.text, employee))
 
 
 # Обработчик для закрытия заявки
 @dp.message(F.text == "Закрыть заявку")
-async def close_request_handler(message: Message, **kwargs):
+async def close_request_handler(message: Message, state: FSMContext, **kwargs):
     employee = kwargs.get('employee')
     if not employee or employee.group not in ['engineer', 'accountant']:
         await message.answer("Доступ запрещен!")
         return
 
-    request = get_active_request(employee)
+    request = await active_request(employee, state, kwargs.get('session'))
     if not request:
         await message.answer("У вас нет активных заявок!")
         return
@@ -845,35 +1122,36 @@ async def close_request_handler(message: Message, **kwargs):
     # Отправляем сообщение с подтверждением
     await message.answer(
         f"Подтвердите закрытие заявки №{request.id}\n\nНомер автомата/аппарата: {request.machine_number}\nАдрес: {request.machine.address}",
-        reply_markup=get_confirmation_keyboard()
+        reply_markup=CLOSE_CONFIRMATION_KEYBOARD
     )
 
 
 # Обработчик для подтверждения закрытия заявки
-@dp.callback_query(lambda c: c.data.startswith("confirm_close"))
-async def confirm_close_handler(callback: types.CallbackQuery, **kwargs):
+@callback_router.register(ConfirmClose)
+async def confirm_close_handler(callback: types.CallbackQuery, state: FSMContext, **kwargs):
     await callback.answer()
     employee = kwargs.get('employee')
     if not employee or employee.group not in ['engineer', 'accountant']:
         await callback.answer("Доступ запрещен!")
         return
 
-    request = get_active_request(employee)
+    session = kwargs.get('session')
+    request = await active_request(employee, state, session)
     if not request:
-        await message.answer("У вас нет активных заявок!")
+        await callback.message.answer("У вас нет активных заявок!")
         return
 
     data = {}
     if employee.group == 'engineer':
         data['engineer_status'] = 'closed'
-        data['engineer_closed_at'] = datetime.now()
+        data['engineer_closed_at'] = utcnow()
         data['engineer_closed_by'] = employee.full_name
     if employee.group == 'accountant':
         data['accountant_status'] = 'closed'
-        data['accountant_closed_at'] = datetime.now()
+        data['accountant_closed_at'] = utcnow()
         data['accountant_closed_by'] = employee.full_name
 
-    if update_request(request.id, **data):
+    if update_request(request.id, event=request_event('close', employee), session=session, **data):
         await callback.message.answer(
             "Заявка успешно закрыта!",
             reply_markup=types.ReplyKeyboardRemove()
@@ -882,16 +1160,16 @@ async def confirm_close_handler(callback: types.CallbackQuery, **kwargs):
         # Возвращаем основное меню
         await show_main_menu(callback.message, employee.group)
 
-        if employee.group == 'engineer':
-            request = get_request_by_id(request.id)
-            employees = get_employees_by_groups(['accountant'])
-            await send_notification(bot, request, employees, title_appendix="закрыта инженером")
+        # Диспетчерам, у которых еще нет карточки заявки, отправляем новую
+        employees = routing_table.recipients(request.machine_number, ['accountant']) \
+            if employee.group == 'engineer' else None
+        await refresh_cards(bot, request.id, notify=employees, title_appendix="закрыта инженером", session=session)
     else:
         await callback.message.answer("Ошибка при закрытии заявки!")
 
 
 # Обработчик для отмены закрытия заявки
-@dp.callback_query(lambda c: c.data.startswith("cancel_close"))
+@callback_router.register(CancelClose)
 async def cancel_close_handler(callback: types.CallbackQuery):
     await callback.answer()
 
@@ -900,27 +1178,26 @@ async def cancel_close_handler(callback: types.CallbackQuery):
     await callback.message.answer("Закрытие заявки отменено")
 
 
-@dp.callback_query(lambda c: c.data.startswith("view_report:"))
-async def view_report_handler(callback: types.CallbackQuery, **kwargs):
+@callback_router.register(ViewReport)
+async def view_report_handler(callback: types.CallbackQuery, callback_data: ViewReport, **kwargs):
     await callback.answer()
     employee = kwargs.get('employee')
     if not employee or employee.group != 'manager':
         await callback.answer("Доступ запрещен!")
         return
 
-    request_id = int(callback.data.split(":")[1])
-    request = get_request_by_id(request_id)
+    session = kwargs.get('session')
+    request_id = callback_data.request_id
+    request = get_request_card(request_id, session=session)
 
     if not request:
         await callback.message.answer("Заявка не найдена")
         return
 
-    photos = get_photos(request_id)
-    comments = get_comments(request_id)
     report_text = get_base_info(request)
     report_text = append_info(report_text, request)
-    report_text = append_engineer_info(report_text, request, comments, len(photos))
-    report_text = append_accountant_info(report_text, request, comments)
+    report_text = append_engineer_info(report_text, request)
+    report_text = append_accountant_info(report_text, request)
 
     if request.photo:
         await callback.message.answer_photo(
@@ -931,19 +1208,350 @@ async def view_report_handler(callback: types.CallbackQuery, **kwargs):
     else:
         await callback.message.answer(report_text, parse_mode='HTML')
 
+    # Сами фото нужны только для альбома, в карточке — их количество
+    photos = get_photos(request_id, session=session) if request.photos_count else []
     if photos:
         media = [types.InputMediaPhoto(media=photo.file_id) for photo in photos[:10]]  # Ограничим 10 фото
         await callback.message.answer_media_group(media)
 
+    # История отдельным сообщением: подпись к фото ограничена по длине
+    events = get_request_events(request_id, session=session)
+    if events:
+        await callback.message.answer(get_timeline_text(request_id, events))
+
+
+EVENT_TITLES = {
+    'created': 'создана',
+    'take': 'взята в работу',
+    'refuse': 'отказ от заявки',
+    'close': 'закрыта',
+    'reopen': 'переоткрыта',
+    'comment': 'код/комментарий',
+    'photo': 'добавлены фото',
+    'reassign': 'передана',
+}
+GROUP_TITLES = {'engineer': 'инженер', 'accountant': 'диспетчер'}
+
+
+def get_timeline_text(request_id: int, events: list):
+    lines = [f"История заявки №{request_id}:\n"]
+    for created_at, kind, group, details, full_name in events:
+        line = f"{format_datetime(created_at)} — {EVENT_TITLES.get(kind, kind)}"
+        actor = " ".join(part for part in (GROUP_TITLES.get(group), full_name) if part)
+        if actor:
+            line += f" ({actor})"
+        if details:
+            line += f": {details}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+@dp.message(Command("turnaround"))
+async def turnaround_report(message: Message, **kwargs):
+    employee = kwargs.get('employee')
+    if not employee or employee.group != 'manager':
+        await message.answer("Доступ запрещен!")
+        return
+
+    stats = get_turnaround_stats(utcnow() - timedelta(days=30))
+    if not stats:
+        await message.answer("Нет данных за последние 30 дней")
+        return
+
+    lines = ["Среднее время за последние 30 дней:\n"]
+    for group in ('engineer', 'accountant'):
+        reaction = stats.get((group, 'reaction'))
+        work = stats.get((group, 'work'))
+        lines.append(
+            f"{GROUP_TITLES[group].capitalize()}: взятие в работу — {format_duration(reaction) if reaction else 'нет данных'}, "
+            f"работа — {format_duration(work) if work else 'нет данных'}"
+        )
+    await message.answer("\n".join(lines))
+
+
+@dp.message(Command("hotspots"))
+async def hotspots_report(message: Message, **kwargs):
+    employee = kwargs.get('employee')
+    if not employee or employee.group != 'manager':
+        await message.answer("Доступ запрещен!")
+        return
+
+    top = hotspots.top(10, utcnow())
+    if not top:
+        await message.answer("Нет данных о заявках")
+        return
 
+    lines = ["Автоматы с наибольшей частотой заявок:\n"]
+    for hotspot in top:
+        lines.append(("⚠️ " if hotspot.spiking else "") + format_hotspot(hotspot))
+    await message.answer("\n".join(lines))
+
+
+# Сводка профилирования запросов: /queries — самые затратные по суммарному времени, /queries reset — сброс
+@dp.message(Command("queries"))
+async def queries_report(message: Message, command: CommandObject, **kwargs):
+    employee = kwargs.get('employee')
+    if not employee or employee.group != 'manager':
+        await message.answer("Доступ запрещен!")
+        return
+
+    if not Config.SLOW_QUERY_MS:
+        await message.answer("Профилирование запросов выключено (SLOW_QUERY_MS)")
+        return
+    if (command.args or "").strip() == 'reset':
+        profiler.reset()
+        await message.answer("Статистика запросов сброшена")
+        return
+
+    top = profiler.top(10)
+    if not top:
+        await message.answer("Нет данных о запросах")
+        return
+
+    lines = ["Запросы по суммарному времени:\n"]
+    for statement, stats in top:
+        handler = stats.handlers.most_common(1)
+        lines.append(
+            f"{stats.total * 1000:.0f} мс, {stats.count} раз, макс. {stats.max * 1000:.1f} мс"
+            + (f", {handler[0][0]}" if handler else "")
+            + f"\n{' '.join(statement.split())[:200]}\n"
+        )
+    await message.answer("\n".join(lines))
+
+
+def throttle_scope(event: Message | CallbackQuery, data: Dict[str, Any]):
+    # Ограничиваем только клиентов: сотрудники работают с заявками без лимитов
+    if data.get('employee'):
+        return None
+    raw_state = data.get('raw_state')
+    if isinstance(event, CallbackQuery):
+        return 'submission' if raw_state == ClientStates.confirmation.state else 'callback'
+    if raw_state == ClientStates.waiting_for_machine.state:
+        return 'machine_lookup'
+    return None
+
+
+throttling = ThrottlingMiddleware(Config.THROTTLE_LIMITS, throttle_scope, Config.THROTTLE_CACHE_SIZE,
+                                  Config.BAN_AFTER_THROTTLES)
+
+
+# Счетчики отклоненных действий и разбан: /throttling [unban ID]
+@dp.message(Command("throttling"))
+async def throttling_report(message: Message, command: CommandObject, **kwargs):
+    employee = kwargs.get('employee')
+    if not employee or employee.group != 'manager':
+        await message.answer("Доступ запрещен!")
+        return
+
+    args = (command.args or "").split()
+    if len(args) == 2 and args[0] == 'unban' and args[1].isdigit():
+        user_id = int(args[1])
+        throttling.banned.discard(user_id)
+        found = unban_user(user_id)
+        await message.answer(f"Пользователь {user_id} разблокирован" if found else f"Пользователь {user_id} не в бан-листе")
+        return
+
+    lines = ["Отклонено действий с момента запуска:\n"]
+    for scope in (*Config.THROTTLE_LIMITS, 'banned'):
+        lines.append(f"{scope}: {throttling.throttled[scope]}")
+    lines.append(f"\nВ бан-листе: {len(throttling.banned)}")
+    await message.answer("\n".join(lines))
+
+
+BULK_RESULTS = {'close': 'Закрыто', 'reopen': 'Переоткрыто', 'reassign': 'Передано'}
+BULK_USAGE = (
+    "Формат: /bulk close|reopen|reassign group=engineer|accountant [machine=N] [district=N] "
+    "[older=ДНЕЙ] [assignee=ID] [status=open|in_work|closed] [to=ID]"
+)
+BULK_KEYS = {'group', 'machine', 'district', 'older', 'assignee', 'status', 'to'}
+
+
+def parse_bulk_args(args: list):
+    # Разбор фильтров вида ключ=значение; None, если что-то не так. Неизвестный ключ — скорее
+    # опечатка в фильтре, и без него операция затронула бы больше заявок, чем задумано
+    options = dict(arg.split('=', 1) for arg in args if '=' in arg)
+    if len(options) != len(args) or not options.keys() <= BULK_KEYS or options.get('group') not in GROUP_TITLES:
+        return None
+    filters = {}
+    try:
+        if 'machine' in options:
+            filters['machine'] = options['machine']
+        if 'district' in options:
+            filters['district'] = int(options['district'])
+        if 'older' in options:
+            filters['older_than'] = utcnow() - timedelta(days=int(options['older']))
+        if 'assignee' in options:
+            filters['assignee'] = int(options['assignee'])
+        if 'to' in options:
+            int(options['to'])
+    except ValueError:
+        return None
+    if 'status' in options:
+        if options['status'] not in ('open', 'in_work', 'closed'):
+            return None
+        filters['status'] = options['status']
+    return options, filters
+
+
+# Массовые операции руководителя: один UPDATE по фильтру и одно обновление карточек
+@dp.message(Command("bulk"))
+async def bulk_command(message: Message, command: CommandObject, **kwargs):
+    employee = kwargs.get('employee')
+    if not employee or employee.group != 'manager':
+        await message.answer("Доступ запрещен!")
+        return
+
+    args = (command.args or "").split()
+    parsed = parse_bulk_args(args[1:]) if args and args[0] in BULK_ACTIONS else None
+    if not parsed:
+        await message.answer(BULK_USAGE)
+        return
+    action, (options, filters) = args[0], parsed
+    group = options['group']
+
+    # Без фильтров операция затронула бы все заявки — такое скорее опечатка
+    if not filters:
+        await message.answer("Укажите хотя бы один фильтр\n" + BULK_USAGE)
+        return
+
+    target = None
+    if action == 'reassign':
+        target = get_employee(int(options['to'])) if 'to' in options else None
+        if not target or target.group != group:
+            await message.answer(f"Укажите в to= ID сотрудника группы «{GROUP_TITLES[group]}»")
+            return
+
+    request_ids = bulk_transition(group, action, employee, filters, target)
+    if not request_ids:
+        await message.answer("Подходящих заявок не найдено")
+        return
+
+    # Карточки всех затронутых заявок обновляются одной рассылкой
+    session = kwargs.get('session')
+    requests = get_request_cards(lambda table: table.c.id.in_(request_ids), session=session)
+    await refresh_request_cards(message.bot, requests, notify=[target] if target else None,
+                                title_appendix="передана" if target else "", session=session)
+    await message.answer(
+        f"{BULK_RESULTS[action]} заявок: {len(request_ids)}\n"
+        + ", ".join(f"№{request_id}" for request_id in request_ids[:200])
+        + (" …" if len(request_ids) > 200 else "")
+    )
+
+
+# Все нажатия на кнопки проходят через один обработчик с маршрутизацией по префиксу
+dp.callback_query.register(callback_router.dispatch, callback_router.filter)
+dp.message.middleware(HandlerContextMiddleware())
+dp.callback_query.middleware(HandlerContextMiddleware())
 dp.message.middleware(EmployeeMiddleware())
 dp.callback_query.middleware(EmployeeMiddleware())
+dp.message.middleware(throttling)
+dp.callback_query.middleware(throttling)
+
+
+inflight = InflightMiddleware()
+dp.update.outer_middleware(CorrelationMiddleware())
+dp.update.outer_middleware(inflight)
+dp.update.outer_middleware(IdempotencyMiddleware(Config.DEDUP_CACHE_SIZE))
+dp.update.outer_middleware(UnitOfWorkMiddleware())
+
+
+async def start_webhook():
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path=Config.WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # reuse_port позволяет новому процессу начать принимать запросы, пока старый еще работает
+    await web.TCPSite(runner, Config.WEBAPP_HOST, Config.WEBAPP_PORT, reuse_port=True).start()
+    await bot.set_webhook(Config.WEBHOOK_URL + Config.WEBHOOK_PATH)
+    return runner
+
+
+async def load_hotspots():
+    # История заявок для счетчиков проблемных автоматов читается в потоке и не задерживает запуск.
+    # Границу history_until задает main до приема первого апдейта: заявки, созданные позже,
+    # учитываются при подтверждении, раньше — только из истории
+    until = hotspots.history_until
+    try:
+        history = await asyncio.to_thread(
+            hotspots.history, until - timedelta(days=Config.HOTSPOT_BACKFILL_DAYS), until
+        )
+    except Exception as e:
+        logging.exception(f"Error loading hotspot history: {e}")
+        return
+    hotspots.merge(history)
+
+
+def start_background_work():
+    # Состояние в памяти загружается, а фоновые задачи запускаются только после остановки старого
+    # процесса: таймеры и заявки, созданные им во время остановки, попадают в новый процесс,
+    # а таймеры и очередь отправки не срабатывают одновременно в двух процессах
+    work_queue.load()
+    scheduler.start()
+    outbox.start()
+    return [asyncio.create_task(load_hotspots()), asyncio.create_task(run_archiver()),
+            asyncio.create_task(run_digest(send_digest))]
+
+
+async def drain():
+    # Дожидаемся обработки принятых апдейтов, отправки накопленных фото и комментариев и текущего таймера
+    await inflight.drain()
+    await asyncio.gather(photo_batches.drain(), comment_batches.drain())
+    await scheduler.stop()
+    await outbox.stop()
 
 
 # Запуск бота
-async def main():
-    await dp.start_polling(bot)
+async def main(handover_pid: int = None):
+    log_listener = setup_logging()
+    stop_event = asyncio.Event()
+    install_stop_signals(stop_event)
+    if Config.SLOW_QUERY_MS:
+        profiler.install(engine)
+    migrate()
+    # В режиме webhook апдейты принимаются до запуска фоновых задач, поэтому граница истории
+    # счетчиков задается заранее, иначе заявки из этого промежутка учитывались бы дважды
+    hotspots.history_until = utcnow()
+
+    if Config.WEBHOOK_URL:
+        # Пока старый процесс дорабатывает, новый уже принимает апдейты, поэтому очередь заявок нужна сразу
+        work_queue.load()
+        runner = await start_webhook()
+        if handover_pid:
+            await handover(handover_pid, Config.SHUTDOWN_TIMEOUT + 5)
+        background = start_background_work()
+        await stop_event.wait()
+        # Перестаем принимать запросы, уже принятые апдейты дорабатываются ниже
+        await runner.cleanup()
+    else:
+        # Получать апдейты может только один процесс, поэтому старый останавливаем до начала polling
+        if handover_pid:
+            await handover(handover_pid, Config.SHUTDOWN_TIMEOUT + 5)
+        background = start_background_work()
+        polling = asyncio.create_task(dp.start_polling(
+            bot, handle_signals=False, close_bot_session=False, tasks_concurrency_limit=Config.MAX_CONCURRENT_UPDATES
+        ))
+        stopping = asyncio.create_task(stop_event.wait())
+        await asyncio.wait([polling, stopping], return_when=asyncio.FIRST_COMPLETED)
+        if not polling.done():
+            await dp.stop_polling()
+        stopping.cancel()
+        await polling
+
+    try:
+        await asyncio.wait_for(drain(), Config.SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.error("Shutdown timeout: some updates were not processed")
+    finally:
+        for task in background:
+            task.cancel()
+        await bot.session.close()
+        engine.dispose()
+        log_listener.stop()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # bot.py --handover PID: запуститься и затем остановить работающий процесс PID
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--handover', type=int)
+    asyncio.run(main(parser.parse_args().handover))
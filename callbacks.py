@@ -0,0 +1,65 @@
+from aiogram.dispatcher.event.handler import CallableObject
+from aiogram.filters.callback_data import CallbackData
+from aiogram.fsm.state import State
+from aiogram.types import CallbackQuery
+from typing import Optional
+
+
+# Формат callback_data кнопок: префикс и поля через ":", например take_request:12
+class TakeRequest(CallbackData, prefix='take_request'):
+    request_id: int
+
+
+class ReopenRequest(CallbackData, prefix='reopen'):
+    request_id: int
+
+
+class ViewReport(CallbackData, prefix='view_report'):
+    request_id: int
+
+
+class ConfirmClose(CallbackData, prefix='confirm_close'):
+    pass
+
+
+class CancelClose(CallbackData, prefix='cancel_close'):
+    pass
+
+
+class ConfirmApplication(CallbackData, prefix='confirm_application'):
+    pass
+
+
+class CancelApplication(CallbackData, prefix='cancel_application'):
+    pass
+
+
+class CallbackRouter:
+    # Маршрутизация нажатий на кнопки: callback_data разбирается один раз,
+    # обработчик находится по префиксу в словаре, а не перебором фильтров
+    def __init__(self):
+        self._routes = {}
+
+    def register(self, factory: type[CallbackData], state: Optional[State] = None):
+        def decorator(handler):
+            self._routes[factory.__prefix__] = (factory, state, CallableObject(handler))
+            return handler
+        return decorator
+
+    def filter(self, callback: CallbackQuery, raw_state: Optional[str] = None):
+        data = callback.data or ""
+        route = self._routes.get(data.split(':', 1)[0])
+        if route is None:
+            return False
+        factory, state, handler = route
+        if state is not None and raw_state != state.state:
+            return False
+        try:
+            callback_data = factory.unpack(data)
+        except (TypeError, ValueError):
+            return False
+        return {'callback_data': callback_data, 'callback_handler': handler}
+
+    async def dispatch(self, callback: CallbackQuery, callback_handler: CallableObject, **kwargs):
+        # CallableObject передает обработчику только те аргументы, которые он принимает
+        return await callback_handler.call(callback, **kwargs)
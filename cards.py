@@ -0,0 +1,119 @@
+from dataclasses import dataclass, fields, replace
+from datetime import datetime
+from sqlalchemy import func, select, union_all
+from sqlalchemy.orm.util import identity_key
+from typing import Optional
+
+from database import session_scope
+from models import Request, Machine, Comment, Photo, ArchivedRequest, ArchivedComment, ArchivedPhoto
+
+
+# Модели для отображения заявок: неизменяемые объекты со __slots__ без состояния ORM.
+# Имена полей совпадают с Request и Machine, поэтому код карточек работает с ними так же
+
+
+@dataclass(frozen=True, slots=True)
+class MachineInfo:
+    name: Optional[str]
+    model: Optional[str]
+    address: str
+    engineer: Optional[int]
+    priority: Optional[int]
+    pump: Optional[bool]
+    saturday: Optional[bool]
+    sunday: Optional[bool]
+    ip: Optional[str]
+
+
+@dataclass(frozen=True, slots=True)
+class RequestCard:
+    id: int
+    created_at: datetime
+    full_name: str
+    phone: str
+    photo: Optional[str]
+    machine_number: str
+    issue_description: Optional[str]
+    payment_method: Optional[str]
+    payment_type: Optional[str]
+    expense_amount: Optional[float]
+    item_name: Optional[str]
+    expense_time: Optional[str]
+    client_id: Optional[int]
+    engineer_id: Optional[int]
+    engineer_status: str
+    engineer_closed_by: Optional[str]
+    engineer_closed_at: Optional[datetime]
+    accountant_id: Optional[int]
+    accountant_status: str
+    accountant_closed_by: Optional[str]
+    accountant_closed_at: Optional[datetime]
+    machine: Optional[MachineInfo]
+    photos_count: int
+    engineer_comments: tuple
+    accountant_comments: tuple
+
+
+AGGREGATES = ('machine', 'photos_count', 'engineer_comments', 'accountant_comments')
+REQUEST_FIELDS = [field.name for field in fields(RequestCard) if field.name not in AGGREGATES]
+MACHINE_FIELDS = [field.name for field in fields(MachineInfo)]
+# Разделитель комментариев в group_concat: в тексте комментария он не встречается
+SEPARATOR = '\x1f'
+
+
+def select_cards(requests, comments, photos, condition):
+    # Заявка, ее автомат, число фото и комментарии по группам одним запросом.
+    # Подзапрос во FROM сам не коррелирует, поэтому связь с заявкой задается явно
+    def comment_texts(role):
+        ordered = select(comments.c.text).where(
+            comments.c.request_id == requests.c.id, comments.c.added_by == role
+        ).order_by(comments.c.id).correlate(requests).subquery()
+        return select(func.group_concat(ordered.c.text, SEPARATOR)).scalar_subquery()
+
+    machines = Machine.__table__
+    return select(
+        *[requests.c[name] for name in REQUEST_FIELDS],
+        machines.c.id.label('machine_id'),
+        *[machines.c[name].label(f'machine_{name}') for name in MACHINE_FIELDS],
+        select(func.count()).where(photos.c.request_id == requests.c.id).scalar_subquery().label('photos_count'),
+        comment_texts('engineer').label('engineer_comments'),
+        comment_texts('accountant').label('accountant_comments'),
+    ).outerjoin(machines, machines.c.number == requests.c.machine_number).where(condition(requests))
+
+
+def card_from_row(row) -> RequestCard:
+    machine = MachineInfo(*(row[f'machine_{name}'] for name in MACHINE_FIELDS)) if row['machine_id'] else None
+    return RequestCard(
+        *(row[name] for name in REQUEST_FIELDS),
+        machine=machine,
+        photos_count=row['photos_count'],
+        engineer_comments=tuple(row['engineer_comments'].split(SEPARATOR)) if row['engineer_comments'] else (),
+        accountant_comments=tuple(row['accountant_comments'].split(SEPARATOR)) if row['accountant_comments'] else (),
+    )
+
+
+def with_pending_changes(card: RequestCard, session) -> RequestCard:
+    # Сессия апдейта пишет изменения в базу только при коммите: если обработчик уже
+    # поменял статус заявки, карточка должна показывать новое состояние
+    request = session.identity_map.get(identity_key(Request, card.id))
+    if request is None or request not in session.dirty:
+        return card
+    changes = {name: getattr(request, name) for name in REQUEST_FIELDS if name in request.__dict__}
+    return replace(card, **changes)
+
+
+def get_request_cards(condition, session=None, archive: bool = False) -> list:
+    # condition(table) — условие отбора для таблицы заявок; archive — искать и в архиве
+    sources = [(Request.__table__, Comment.__table__, Photo.__table__)]
+    if archive:
+        sources.append((ArchivedRequest, ArchivedComment, ArchivedPhoto))
+    query = union_all(*(select_cards(*source, condition) for source in sources)).subquery()
+    with session_scope(session) as session:
+        rows = session.execute(select(query).order_by(query.c.id)).mappings().all()
+        cards = [card_from_row(row) for row in rows]
+        return [with_pending_changes(card, session) for card in cards]
+
+
+def get_request_card(request_id: int, session=None) -> Optional[RequestCard]:
+    cards = get_request_cards(lambda table: table.c.id == request_id, session=session, archive=True)
+    return cards[0] if cards else None
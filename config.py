@@ -1,3 +1,4 @@
+from datetime import time
 from dotenv import load_dotenv
 
 import os
@@ -9,3 +10,74 @@ load_dotenv()
 class Config:
     BOT_TOKEN = os.getenv('BOT_TOKEN')
     DATABASE_URL = 'sqlite:///vending.db'
+    # Полностью закрытые заявки старше ARCHIVE_AFTER_DAYS переносятся в отдельную базу
+    ARCHIVE_DATABASE = os.getenv('ARCHIVE_DATABASE', 'archive.db')
+    ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 90))
+    ARCHIVE_INTERVAL_HOURS = int(os.getenv('ARCHIVE_INTERVAL_HOURS', 24))
+    # Лимиты рассылки: Telegram допускает около 30 сообщений в секунду
+    SEND_RATE = float(os.getenv('SEND_RATE', 25))
+    SEND_CONCURRENCY = int(os.getenv('SEND_CONCURRENCY', 10))
+    # Лог в формате JSON: файл, уровень, ротация по размеру и доля сохраняемых отладочных записей
+    LOG_FILE = os.getenv('LOG_FILE', 'bot.log')
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+    LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+    LOG_DEBUG_SAMPLE = float(os.getenv('LOG_DEBUG_SAMPLE', 1.0))
+    # Неотправленные карточки повторяются с экспоненциальной задержкой от BASE до MAX секунд
+    OUTBOX_RETRY_BASE = float(os.getenv('OUTBOX_RETRY_BASE', 5))
+    OUTBOX_RETRY_MAX = float(os.getenv('OUTBOX_RETRY_MAX', 600))
+    # Сколько апдейтов обрабатывается одновременно. Обработчик держит соединение с базой,
+    # пока ждет ответов Telegram, поэтому столько же соединений держит пул
+    MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', 20))
+    # Сколько секунд при остановке ждать завершения обработки апдейтов и отправки сообщений
+    SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', 25))
+    # Если задан WEBHOOK_URL, бот принимает апдейты через вебхук, иначе — через long polling
+    WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+    WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+    WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+    WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', 8080))
+    # Маршрутизация заявок: время жизни кэша (сек) и через сколько минут
+    # невзятая заявка рассылается всем сотрудникам группы и руководству
+    ROUTING_TTL = int(os.getenv('ROUTING_TTL', 300))
+    ESCALATION_MINUTES = int(os.getenv('ESCALATION_MINUTES', 30))
+    # Срок взятия заявки в работу (ч) по приоритету автомата, формат "1:4,2:8,3:24"
+    SLA_HOURS = {
+        int(priority): float(hours)
+        for priority, hours in (item.split(':') for item in os.getenv('SLA_HOURS', '1:4,2:8,3:24').split(','))
+    }
+    SLA_DEFAULT_HOURS = float(os.getenv('SLA_DEFAULT_HOURS', 24))
+    # Сколько заявок сотрудник может одновременно держать в работе
+    MAX_IN_WORK = int(os.getenv('MAX_IN_WORK', 1))
+    # Фото и комментарии сотрудника, пришедшие с паузой меньше этой (сек), сохраняются одной пачкой
+    INGEST_DEBOUNCE = float(os.getenv('INGEST_DEBOUNCE', 1.0))
+    # Защита от повторной доставки апдейтов: сколько ключей держать в памяти
+    # и сколько часов хранить в базе (Telegram хранит неполученные апдейты сутки)
+    DEDUP_CACHE_SIZE = int(os.getenv('DEDUP_CACHE_SIZE', 10000))
+    DEDUP_RETENTION_HOURS = int(os.getenv('DEDUP_RETENTION_HOURS', 48))
+    # Ограничения для клиентов в формате "область:действий:секунд": отправка заявок,
+    # ввод номера автомата и нажатия кнопок. Сотрудников ограничения не касаются
+    THROTTLE_LIMITS = {
+        scope: (int(burst), float(period))
+        for scope, burst, period in (
+            item.split(':') for item in
+            os.getenv('THROTTLE_LIMITS', 'submission:3:3600,machine_lookup:10:60,callback:30:60').split(',')
+        )
+    }
+    THROTTLE_CACHE_SIZE = int(os.getenv('THROTTLE_CACHE_SIZE', 10000))
+    # После скольких отказов подряд пользователь попадает в бан-лист (0 — не банить)
+    BAN_AFTER_THROTTLES = int(os.getenv('BAN_AFTER_THROTTLES', 0))
+    # Проблемные автоматы: периоды полураспада счетчиков заявок — текущего (ч) и обычного уровня (дней),
+    # во сколько раз текущая частота должна превысить обычную и сколько заявок для этого нужно как минимум.
+    # Повторное оповещение по автомату — не чаще раза в HOTSPOT_COOLDOWN_HOURS
+    HOTSPOT_HALF_LIFE_HOURS = float(os.getenv('HOTSPOT_HALF_LIFE_HOURS', 24))
+    HOTSPOT_BASELINE_DAYS = float(os.getenv('HOTSPOT_BASELINE_DAYS', 30))
+    HOTSPOT_FACTOR = float(os.getenv('HOTSPOT_FACTOR', 3))
+    HOTSPOT_MIN_COUNT = float(os.getenv('HOTSPOT_MIN_COUNT', 3))
+    HOTSPOT_COOLDOWN_HOURS = float(os.getenv('HOTSPOT_COOLDOWN_HOURS', 24))
+    # За сколько дней история заявок загружается в счетчики при запуске
+    HOTSPOT_BACKFILL_DAYS = int(os.getenv('HOTSPOT_BACKFILL_DAYS', 180))
+    # Во сколько (по Москве) строится и рассылается подписчикам сводка за прошедшие сутки
+    DIGEST_TIME = time.fromisoformat(os.getenv('DIGEST_TIME', '06:00'))
+    # Профилирование запросов к базе: запросы дольше SLOW_QUERY_MS пишутся в лог с планом выполнения,
+    # сводка доступна руководству по /queries. 0 — выключено
+    SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 0))
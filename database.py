@@ -1,36 +1,246 @@
-from datetime import datetime
-from sqlalchemy import create_engine, MetaData, Table
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import case, create_engine, event, func, insert, inspect, select, union_all, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker, joinedload
-
-from models import Base, Request, Machine, Employee, Photo, Comment
-
-import pandas as pd
-import time
-
-
-# Настройка подключения к SQLite
-engine = create_engine('sqlite:///vending.db')
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-
-
-def get_db_session():
-    return Session()
+from sqlalchemy.pool import NullPool
+
+from config import Config
+from models import Base, Request, Machine, Employee, Photo, Comment, CardMessage, archive_metadata, ArchivedRequest, \
+    ArchivedComment, ArchivedPhoto, ArchivedRequestEvent, RequestEvent, ProcessedUpdate, BannedUser, \
+    DigestSubscriber, MOSCOW_TZ, utcnow
+
+import csv
+import gzip
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+
+
+# Настройка подключения к SQLite. Сессия апдейта держит соединение, пока обработчик ждет ответов
+# Telegram, а ожидание свободного соединения в QueuePool блокирует весь цикл событий. Поэтому пул
+# рассчитан на MAX_CONCURRENT_UPDATES, а сверх него соединения открываются без ожидания
+engine = create_engine('sqlite:///vending.db', pool_size=Config.MAX_CONCURRENT_UPDATES, max_overflow=-1)
+
+
+# Архив подключается к каждому соединению, поэтому запросы могут обращаться к таблицам archive.*
+# Обе базы работают в режиме WAL: чтение не блокирует запись и наоборот
+@event.listens_for(engine, 'connect')
+def attach_archive(dbapi_connection, connection_record):
+    dbapi_connection.execute("ATTACH DATABASE ? AS archive", (Config.ARCHIVE_DATABASE,))
+    dbapi_connection.execute("PRAGMA main.journal_mode=WAL")
+    dbapi_connection.execute("PRAGMA archive.journal_mode=WAL")
+
+
+def convert_local_times_to_utc(schema, columns):
+    # Раньше время заявок записывалось как локальное время сервера без пояса, переводим его в UTC
+    def migration(connection):
+        for table, names in columns.items():
+            rows = connection.exec_driver_sql(f"SELECT id, {', '.join(names)} FROM {schema}.{table}").all()
+            updates = []
+            for row in rows:
+                values = [
+                    datetime.fromisoformat(value).astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')
+                    if value else None
+                    for value in row[1:]
+                ]
+                updates.append((*values, row[0]))
+            if updates:
+                assignments = ', '.join(f"{name} = ?" for name in names)
+                connection.exec_driver_sql(f"UPDATE {schema}.{table} SET {assignments} WHERE id = ?", updates)
+    return migration
+
+
+# Таблицы, строки которых переносятся в архив с сохранением номеров, и их копии в архиве
+ARCHIVED_TABLES = ((Request.__table__, ArchivedRequest), (Comment.__table__, ArchivedComment),
+                   (Photo.__table__, ArchivedPhoto), (RequestEvent.__table__, ArchivedRequestEvent))
+
+
+# Схема таблиц на момент перехода на AUTOINCREMENT. Миграция не должна зависеть от текущих моделей:
+# колонки и индексы, появившиеся позже, добавляют свои миграции
+AUTOINCREMENT_TABLES = {
+    'requests': """
+        id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        created_at DATETIME NOT NULL,
+        full_name VARCHAR NOT NULL,
+        phone VARCHAR NOT NULL,
+        machine_number VARCHAR(20) NOT NULL,
+        issue_description VARCHAR,
+        payment_method VARCHAR,
+        payment_type VARCHAR,
+        expense_amount FLOAT,
+        item_name VARCHAR,
+        expense_time VARCHAR,
+        client_id INTEGER,
+        photo VARCHAR,
+        engineer_id INTEGER,
+        engineer_status VARCHAR(20),
+        engineer_closed_at DATETIME,
+        engineer_closed_by VARCHAR,
+        accountant_id INTEGER,
+        accountant_status VARCHAR(20),
+        accountant_closed_at DATETIME,
+        accountant_closed_by VARCHAR,
+        FOREIGN KEY(machine_number) REFERENCES machines (number),
+        FOREIGN KEY(engineer_id) REFERENCES employees (id),
+        FOREIGN KEY(accountant_id) REFERENCES employees (id)
+    """,
+    'comments': """
+        id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        text VARCHAR NOT NULL,
+        request_id INTEGER NOT NULL,
+        added_by VARCHAR NOT NULL,
+        created_at DATETIME,
+        FOREIGN KEY(request_id) REFERENCES requests (id)
+    """,
+    'photos': """
+        id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        file_id VARCHAR NOT NULL,
+        request_id INTEGER NOT NULL,
+        FOREIGN KEY(request_id) REFERENCES requests (id)
+    """,
+    'request_events': """
+        id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        request_id INTEGER NOT NULL,
+        created_at DATETIME NOT NULL,
+        kind VARCHAR(20) NOT NULL,
+        "group" VARCHAR(20),
+        employee_id INTEGER,
+        details VARCHAR,
+        FOREIGN KEY(request_id) REFERENCES requests (id),
+        FOREIGN KEY(employee_id) REFERENCES employees (id)
+    """,
+}
+AUTOINCREMENT_INDEXES = [
+    "CREATE INDEX ix_request_events_request_id_id ON request_events (request_id, id)",
+]
+
+
+def rebuild_with_autoincrement(connection):
+    # AUTOINCREMENT нельзя добавить через ALTER TABLE: таблица создается заново,
+    # строки копируются, старая удаляется, а новая получает ее имя и индексы
+    for name, columns in AUTOINCREMENT_TABLES.items():
+        connection.exec_driver_sql(f"CREATE TABLE {name}_new ({columns})")
+        old, new = (
+            [row[1] for row in connection.exec_driver_sql(f"PRAGMA main.table_info({table})")]
+            for table in (name, f"{name}_new")
+        )
+        copied = ', '.join(f'"{column}"' for column in old if column in new)
+        connection.exec_driver_sql(f"INSERT INTO {name}_new ({copied}) SELECT {copied} FROM {name}")
+        connection.exec_driver_sql(f"DROP TABLE {name}")
+        connection.exec_driver_sql(f"ALTER TABLE {name}_new RENAME TO {name}")
+    for index in AUTOINCREMENT_INDEXES:
+        connection.exec_driver_sql(index)
+
+
+def sync_id_sequences(connection):
+    # Счетчик номеров не должен отставать от архива: например, если рабочая база создана заново
+    for table, archived in ARCHIVED_TABLES:
+        last_id = max(
+            connection.scalar(select(func.max(table.c.id))) or 0,
+            connection.scalar(select(func.max(archived.c.id))) or 0,
+            connection.exec_driver_sql("SELECT seq FROM sqlite_sequence WHERE name = ?", (table.name,)).scalar() or 0,
+        )
+        connection.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name = ?", (table.name,))
+        connection.exec_driver_sql("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table.name, last_id))
+
+
+# Миграции существующей базы, номер последней примененной хранится в PRAGMA user_version.
+# Миграция — SQL-строка или функция от соединения
+MIGRATIONS = [
+    "ALTER TABLE requests ADD COLUMN client_id INTEGER",
+    "ALTER TABLE employees ADD COLUMN district INTEGER",
+    convert_local_times_to_utc('main', {
+        'requests': ['created_at', 'engineer_closed_at', 'accountant_closed_at'],
+        'timers': ['due_at'],
+    }),
+    # Начальная история для заявок, созданных до появления журнала
+    "INSERT INTO request_events (request_id, created_at, kind) SELECT id, created_at, 'created' FROM requests",
+    "INSERT INTO request_events (request_id, created_at, kind, \"group\", employee_id) "
+    "SELECT id, engineer_closed_at, 'close', 'engineer', engineer_id FROM requests WHERE engineer_closed_at IS NOT NULL",
+    "INSERT INTO request_events (request_id, created_at, kind, \"group\", employee_id) "
+    "SELECT id, accountant_closed_at, 'close', 'accountant', accountant_id FROM requests "
+    "WHERE accountant_closed_at IS NOT NULL",
+    rebuild_with_autoincrement,
+    # Карточка выбирает комментарии и фото своей заявки, без индекса это перебор всей таблицы
+    "CREATE INDEX IF NOT EXISTS ix_comments_request_id ON comments (request_id)",
+    "CREATE INDEX IF NOT EXISTS ix_photos_request_id ON photos (request_id)",
+    # Из повторных карточек заявки в одном чате остается последняя
+    "DELETE FROM card_messages WHERE id NOT IN (SELECT MAX(id) FROM card_messages GROUP BY request_id, chat_id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_card_messages_request_id_chat_id ON card_messages (request_id, chat_id)",
+]
+# Изменения колонок requests, comments и photos нужно повторять и для архива
+ARCHIVE_MIGRATIONS = [
+    convert_local_times_to_utc('archive', {
+        'requests': ['created_at', 'engineer_closed_at', 'accountant_closed_at'],
+    }),
+    "INSERT INTO archive.request_events (request_id, created_at, kind) "
+    "SELECT id, created_at, 'created' FROM archive.requests",
+    "INSERT INTO archive.request_events (request_id, created_at, kind, \"group\", employee_id) "
+    "SELECT id, engineer_closed_at, 'close', 'engineer', engineer_id FROM archive.requests "
+    "WHERE engineer_closed_at IS NOT NULL",
+    "INSERT INTO archive.request_events (request_id, created_at, kind, \"group\", employee_id) "
+    "SELECT id, accountant_closed_at, 'close', 'accountant', accountant_id FROM archive.requests "
+    "WHERE accountant_closed_at IS NOT NULL",
+]
+
+
+def migrate():
+    # Создание схемы и миграции выполняются явно при запуске бота, а не при импорте модуля
+    is_new = {
+        'main': not inspect(engine).has_table('requests'),
+        'archive': not inspect(engine).has_table('requests', schema='archive'),
+    }
+    Base.metadata.create_all(engine)
+    archive_metadata.create_all(engine)
+    with engine.begin() as connection:
+        for schema, migrations in (('main', MIGRATIONS), ('archive', ARCHIVE_MIGRATIONS)):
+            version = connection.exec_driver_sql(f"PRAGMA {schema}.user_version").scalar()
+            # Новая база создается сразу по актуальным моделям
+            if not is_new[schema]:
+                for migration in migrations[version:]:
+                    if callable(migration):
+                        migration(connection)
+                    else:
+                        connection.exec_driver_sql(migration)
+            connection.exec_driver_sql(f"PRAGMA {schema}.user_version = {len(migrations)}")
+        sync_id_sequences(connection)
+
+
+# Объекты остаются загруженными после коммита: функции ниже возвращают их вызывающему коду
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+
+
+@contextmanager
+def session_scope(session=None):
+    # Функции принимают сессию апдейта из UnitOfWorkMiddleware: тогда изменения фиксируются
+    # одним коммитом в конце обработки. Без нее открывается своя сессия с коммитом при выходе
+    if session is not None:
+        yield session
+        return
+    with Session() as session:
+        yield session
+        session.commit()
 
 
-def machine_exists(machine_number: str) -> bool:
-    with Session() as session:
+def machine_exists(machine_number: str, session=None) -> bool:
+    with session_scope(session) as session:
         return session.query(Machine).filter(
             Machine.number == machine_number
         ).first() is not None
 
 
-def save_to_db(user_data: dict):
-    with Session() as session:
+def save_to_db(user_data: dict, session=None):
+    # В сессии апдейта откат затронул бы и остальные изменения обработчика, поэтому ошибка
+    # передается дальше, и откатом всего апдейта распоряжается UnitOfWorkMiddleware
+    shared = session is not None
+    with session_scope(session) as session:
         try:
             # Создаем новую заявку
             new_request = Request(
-                created_at=datetime.now(),
+                created_at=utcnow(),
                 full_name=user_data['full_name'],
                 phone=user_data['phone'],
                 machine_number=user_data['machine'],
@@ -41,6 +251,7 @@ def save_to_db(user_data: dict):
                 expense_amount=user_data.get('expense_amount'),
                 item_name=user_data.get('item_name'),
                 expense_time=user_data.get('expense_time'),
+                client_id=user_data.get('client_id'),
             )
             
             # Добавляем связь с автоматом
@@ -54,102 +265,419 @@ def save_to_db(user_data: dict):
             session.add(new_request)
             session.flush()  # Это нужно, чтобы получить id до коммита
             request_id = new_request.id
-            session.commit()
+            session.add(RequestEvent(request_id=request_id, created_at=new_request.created_at, kind='created'))
+            session.flush()
             return request_id
         except Exception as e:
+            if shared:
+                raise
             session.rollback()
-            print(f"Database error: {e}")
+            logging.exception(f"Database error: {e}")
             return None
 
 
-def get_request_by_id(request_id: int):
-    with Session() as session:
+def get_request_by_id(request_id: int, session=None):
+    # В сессии апдейта заявка остается привязанной к ней: видны еще не записанные изменения
+    # и работает ленивая загрузка связей
+    with session_scope(session) as session:
         request = session.query(Request).options(joinedload(Request.machine)).get(request_id)
-        # Если нужно использовать объект вне сессии, можно сделать его отдельную копию
-        session.expunge(request)
+        if request is None:
+            return get_archived_request(session, request_id)
         return request
 
 
-def update_request(request_id: int, **kwargs):
-    with Session() as session:
-        try:
+def get_archived_request(session, request_id: int):
+    # Заявка из архива собирается в несвязанный с сессией объект Request, только для чтения
+    row = session.execute(select(ArchivedRequest).where(ArchivedRequest.c.id == request_id)).first()
+    if row is None:
+        return None
+    machine = session.query(Machine).filter(Machine.number == row.machine_number).first()
+    if machine:
+        session.expunge(machine)
+    request = Request(**row._mapping)
+    request.machine = machine
+    return request
+
+
+def request_event(kind: str, employee=None, details: str = None):
+    return {
+        'kind': kind,
+        'group': employee.group if employee else None,
+        'employee_id': employee.id if employee else None,
+        'details': details,
+    }
+
+
+def update_request(request_id: int, event: dict = None, session=None, **kwargs):
+    # Статус в requests и событие в журнале записываются одной транзакцией
+    try:
+        with session_scope(session) as session:
             request = session.query(Request).get(request_id)
             for key, value in kwargs.items():
                 setattr(request, key, value)
-            session.commit()
-            return True
-        except Exception as e:
-            session.rollback()
-            print(f"Update error: {e}")
-            return False
+            if event:
+                session.add(RequestEvent(request_id=request_id, **event))
+        return True
+    except Exception as e:
+        logging.exception(f"Update error: {e}")
+        return False
 
 
-def get_employees_by_groups(groups: list):
-    with Session() as session:
+def get_employees_by_groups(groups: list, session=None):
+    with session_scope(session) as session:
         return session.query(Employee).filter(
             Employee.group.in_(groups)
         ).all()
 
 
-def get_active_request(employee):
+def in_work_columns(group: str):
+    if group == 'engineer':
+        return Request.engineer_id, Request.engineer_status
+    return Request.accountant_id, Request.accountant_status
+
+
+def count_in_work(employee, session=None) -> int:
+    employee_column, status_column = in_work_columns(employee.group)
+    with session_scope(session) as session:
+        return session.scalar(
+            select(func.count()).where(employee_column == employee.id, status_column == 'in_work')
+        )
+
+
+def claim_request(request_id: int, employee, max_in_work: int) -> bool:
+    # Взятие в работу одним условным UPDATE: заявку получает только первый из нажавших,
+    # и только если у сотрудника меньше max_in_work заявок в работе.
+    # Своя короткая транзакция, чтобы результат был виден сразу, а не после коммита апдейта
+    employee_column, status_column = in_work_columns(employee.group)
+    in_work = select(func.count()).where(employee_column == employee.id, status_column == 'in_work') \
+        .scalar_subquery()
     with Session() as session:
-        if employee.group == 'engineer':
-            return session.query(Request).options(joinedload(Request.machine)).filter(
-                Request.engineer_id == employee.id,
-                Request.engineer_status == 'in_work'
-            ).first()
-        if employee.group == 'accountant':
-            return session.query(Request).options(joinedload(Request.machine)).filter(
-                Request.accountant_id == employee.id,
-                Request.accountant_status == 'in_work'
-            ).first()
-        else:
-            return None
+        result = session.execute(
+            update(Request)
+            .where(Request.id == request_id, status_column == 'open', in_work < max_in_work)
+            .values({employee_column: employee.id, status_column: 'in_work'})
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 0:
+            return False
+        session.add(RequestEvent(request_id=request_id, **request_event('take', employee)))
+        session.commit()
+        return True
+
+
+BULK_ACTIONS = ('close', 'reopen', 'reassign')
+
+
+def bulk_transition(group: str, action: str, manager, filters: dict, target=None) -> list:
+    # Массовая смена статуса по фильтру одним UPDATE ... RETURNING и журнал одной вставкой,
+    # в одной транзакции. filters: machine, district, older_than (datetime), assignee (id), status.
+    # Событие пишется от имени руководителя с группой той стороны, чей статус изменен.
+    # Возвращает номера измененных заявок
+    employee_column, status_column = in_work_columns(group)
+    closed_at = Request.engineer_closed_at if group == 'engineer' else Request.accountant_closed_at
+    closed_by = Request.engineer_closed_by if group == 'engineer' else Request.accountant_closed_by
+
+    conditions = []
+    if 'machine' in filters:
+        conditions.append(Request.machine_number == filters['machine'])
+    if 'district' in filters:
+        conditions.append(Request.machine_number.in_(
+            select(Machine.number).where(Machine.engineer == filters['district'])
+        ))
+    if 'older_than' in filters:
+        conditions.append(Request.created_at < filters['older_than'])
+    if 'assignee' in filters:
+        conditions.append(employee_column == filters['assignee'])
+    if 'status' in filters:
+        conditions.append(status_column == filters['status'])
+
+    if action == 'close':
+        conditions.append(status_column != 'closed')
+        values = {status_column: 'closed', closed_at: utcnow(), closed_by: manager.full_name}
+        details = "массовая операция"
+    elif action == 'reopen':
+        # Как и переоткрытие из карточки: закрытая заявка возвращается в работу тому, кто ее вел.
+        # Заявки, закрытые без исполнителя, снова становятся открытыми
+        conditions.append(status_column == 'closed')
+        values = {status_column: case((employee_column.is_(None), 'open'), else_='in_work')}
+        details = "массовая операция"
+    else:
+        conditions.append(status_column == 'in_work')
+        values = {employee_column: target.id}
+        details = target.full_name
+
+    with Session() as session:
+        request_ids = session.scalars(
+            update(Request).where(*conditions).values(values).returning(Request.id)
+            .execution_options(synchronize_session=False)
+        ).all()
+        if request_ids:
+            session.execute(insert(RequestEvent), [
+                {'request_id': request_id, 'created_at': utcnow(), 'kind': action, 'group': group,
+                 'employee_id': manager.id, 'details': details}
+                for request_id in request_ids
+            ])
+        session.commit()
+    return sorted(request_ids)
+
+
+def get_employee(employee_id: int, session=None):
+    with session_scope(session) as session:
+        return session.get(Employee, employee_id)
+
+
+def get_active_request(employee, request_id: int = None, session=None):
+    # Заявка, с которой работает сотрудник: выбранная им последней (request_id), пока она у него в работе.
+    # Иначе, в том числе после перезапуска, — заявка в работе с меньшим номером
+    if employee.group not in ('engineer', 'accountant'):
+        return None
+    employee_column, status_column = in_work_columns(employee.group)
+    with session_scope(session) as session:
+        query = session.query(Request).options(joinedload(Request.machine)).filter(
+            employee_column == employee.id,
+            status_column == 'in_work'
+        )
+        request = query.filter(Request.id == request_id).first() if request_id is not None else None
+        return request or query.order_by(Request.id).first()
+
+
+def add_photos(request_id, photo_ids, employee=None, session=None):
+    with session_scope(session) as session:
+        session.add_all([Photo(file_id=photo_id, request_id=request_id) for photo_id in photo_ids])
+        session.add(RequestEvent(request_id=request_id, **request_event('photo', employee, f"{len(photo_ids)} шт.")))
+
+
+def add_comments(request_id, texts, role, employee=None, session=None):
+    with session_scope(session) as session:
+        session.add_all([Comment(text=text, request_id=request_id, added_by=role) for text in texts])
+        session.add_all([
+            RequestEvent(request_id=request_id, **request_event('comment', employee, text)) for text in texts
+        ])
 
 
-def add_photo(request_id, photo_id):
-    new_photo = Photo(file_id=photo_id, request_id=request_id)
-    session = get_db_session()
-    session.add(new_photo)
-    session.commit()
-    session.close()
+def get_request_events(request_id, session=None):
+    # История заявки одним запросом по индексу (request_id, id), имена сотрудников — из справочника
+    with session_scope(session) as session:
+        for table in (RequestEvent.__table__, ArchivedRequestEvent):
+            events = session.execute(
+                select(table.c.created_at, table.c.kind, table.c.group, table.c.details, Employee.full_name)
+                .outerjoin(Employee, Employee.id == table.c.employee_id)
+                .where(table.c.request_id == request_id)
+                .order_by(table.c.id)
+            ).all()
+            if events:
+                return events
+        return []
+
+
+def get_turnaround_stats(since: datetime):
+    # Среднее время от создания до взятия в работу и от взятия до закрытия по группам.
+    # Считается по журналу событий за период, без перебора заявок
+    with Session() as session:
+        events = session.execute(
+            select(RequestEvent.request_id, RequestEvent.kind, RequestEvent.group, RequestEvent.created_at)
+            .where(RequestEvent.created_at >= since, RequestEvent.kind.in_(['created', 'take', 'close']))
+            .order_by(RequestEvent.request_id, RequestEvent.id)
+        )
+        created = {}
+        taken = {}
+        durations = {}
+        for request_id, kind, group, created_at in events:
+            if kind == 'created':
+                created[request_id] = created_at
+            elif kind == 'take':
+                # Считаем первое взятие в работу, повторные после отказа не сбрасывают время реакции
+                if request_id in created and (request_id, group) not in taken:
+                    durations.setdefault((group, 'reaction'), []).append(created_at - created[request_id])
+                taken[(request_id, group)] = created_at
+            elif kind == 'close' and (request_id, group) in taken:
+                durations.setdefault((group, 'work'), []).append(created_at - taken[(request_id, group)])
+        return {key: sum(values, timedelta()) / len(values) for key, values in durations.items()}
+
+
+def get_photos(request_id, session=None):
+    with session_scope(session) as session:
+        photos = session.query(Photo).filter(Photo.request_id == request_id).order_by(Photo.id).all()
+        if photos:
+            return photos
+        rows = session.execute(
+            select(ArchivedPhoto).where(ArchivedPhoto.c.request_id == request_id).order_by(ArchivedPhoto.c.id)
+        )
+        return [Photo(**row._mapping) for row in rows]
+
+
+def get_comments(request_id, session=None):
+    with session_scope(session) as session:
+        comments = session.query(Comment).filter(Comment.request_id == request_id).order_by(Comment.id).all()
+        if comments:
+            return comments
+        rows = session.execute(
+            select(ArchivedComment).where(ArchivedComment.c.request_id == request_id).order_by(ArchivedComment.c.id)
+        )
+        return [Comment(**row._mapping) for row in rows]
+
+
+def add_card_messages(request_id, cards, session=None):
+    # cards: список (chat_id, message_id, group, has_photo). Новая карточка в чате заменяет прежнюю:
+    # например, список заявок, открытый повторно, не добавляет записей, а обновляет их.
+    # Запись идет через сессию, а не отдельным INSERT: сессия апдейта пишет в базу только при коммите
+    with session_scope(session) as session:
+        known = {card.chat_id: card for card in session.query(CardMessage).filter(
+            CardMessage.request_id == request_id, CardMessage.chat_id.in_([card[0] for card in cards])
+        )}
+        for chat_id, message_id, group, has_photo in cards:
+            card = known.get(chat_id)
+            if card is None:
+                card = known[chat_id] = CardMessage(request_id=request_id, chat_id=chat_id)
+                session.add(card)
+            card.message_id, card.group, card.has_photo = message_id, group, has_photo
+
+
+def get_card_messages(request_ids: list, session=None):
+    with session_scope(session) as session:
+        return session.query(CardMessage).filter(CardMessage.request_id.in_(request_ids)).all()
+
+
+def delete_card_messages(card_ids, session=None):
+    with session_scope(session) as session:
+        session.query(CardMessage).filter(CardMessage.id.in_(card_ids)).delete(synchronize_session=False)
+
+
+def mark_processed(keys) -> bool:
+    # Возвращает False, если хотя бы один из ключей уже был обработан
+    with Session() as session:
+        session.add_all([ProcessedUpdate(key=key) for key in keys])
+        try:
+            session.commit()
+        except IntegrityError:
+            return False
+        return True
 
 
-def add_comment(request_id, text, role):
-    new_comment = Comment(text=text, request_id=request_id, added_by=role)
-    session = get_db_session()
-    session.add(new_comment)
-    session.commit()
-    session.close()
+def prune_processed_updates(older_than: datetime):
+    with Session() as session:
+        session.query(ProcessedUpdate).filter(ProcessedUpdate.processed_at < older_than).delete(synchronize_session=False)
+        session.commit()
 
 
-def get_photos(request_id):
+def get_banned_user_ids():
     with Session() as session:
-        return session.query(Photo).filter(Photo.request_id == request_id).order_by(Photo.id).all()
+        return session.scalars(select(BannedUser.telegram_id)).all()
 
 
-def get_comments(request_id):
+def ban_user(telegram_id: int, reason: str = None):
     with Session() as session:
-        return session.query(Comment).filter(Comment.request_id == request_id).order_by(Comment.id).all()
+        session.merge(BannedUser(telegram_id=telegram_id, reason=reason))
+        session.commit()
 
 
-def localize_tz_column(df, name):
-    df[name] = pd.to_datetime(df[name])  # Преобразуем в формат datetime
-    df[name] = df[name].dt.tz_localize('UTC')  # Указываем исходный часовой пояс (например, UTC)
-    df[name] = df[name].dt.tz_convert('Europe/Moscow')  # Сдвигаем в нужный часовой пояс
-    df[name] = df[name].dt.tz_localize(None)  # Убираем информацию о часовом поясе для совместимости с Excel
+def unban_user(telegram_id: int) -> bool:
+    with Session() as session:
+        deleted = session.query(BannedUser).filter(BannedUser.telegram_id == telegram_id).delete()
+        session.commit()
+        return bool(deleted)
 
 
-def export_to_excel():
+def get_digest_subscribers():
     with Session() as session:
-        # Загружаем метаданные и выбираем таблицу
-        metadata = MetaData()
-        metadata.reflect(bind=engine)
-        table = metadata.tables['requests']  # Замените на имя вашей таблицы
-        related_table = metadata.tables['machines']
-
-        # Указываем конкретные столбцы для выборки
-        columns_to_select = [
+        return session.scalars(
+            select(Employee).join(DigestSubscriber, DigestSubscriber.employee_id == Employee.id)
+        ).all()
+
+
+def set_digest_subscription(employee, enabled: bool):
+    with Session() as session:
+        if enabled:
+            session.merge(DigestSubscriber(employee_id=employee.id))
+        else:
+            session.query(DigestSubscriber).filter(DigestSubscriber.employee_id == employee.id).delete()
+        session.commit()
+
+
+def localize_tz_column(df, name):
+    import pandas as pd
+
+    # Значения уже в UTC: один векторный перевод в Москву и снятие пояса для совместимости с Excel
+    df[name] = pd.to_datetime(df[name], utc=True).dt.tz_convert(MOSCOW_TZ).dt.tz_localize(None)
+
+
+# Перенос пачки заявок в архив и снимок обеих баз не выполняются одновременно:
+# иначе в снимок попала бы рабочая база после переноса, а архив — до него
+archive_lock = threading.Lock()
+
+
+@contextmanager
+def snapshot_session():
+    # Сессия на копии базы и архива, снятой через backup API SQLite. Отчеты читают копию
+    # сколько угодно долго и не мешают записи и контрольным точкам WAL в рабочей базе
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {schema: os.path.join(directory, f"{schema}.db") for schema in ('main', 'archive')}
+        source = engine.raw_connection()
+        try:
+            with archive_lock:
+                for schema, path in paths.items():
+                    target = sqlite3.connect(path)
+                    try:
+                        source.driver_connection.backup(target, name=schema)
+                    finally:
+                        target.close()
+        finally:
+            source.close()
+
+        snapshot_engine = create_engine(f"sqlite:///{paths['main']}", poolclass=NullPool)
+        event.listen(snapshot_engine, 'connect', lambda dbapi_connection, connection_record: dbapi_connection.execute(
+            "ATTACH DATABASE ? AS archive", (paths['archive'],)
+        ))
+        try:
+            with Session(bind=snapshot_engine) as session:
+                yield session
+        finally:
+            snapshot_engine.dispose()
+
+
+# Столбцы отчета и их типы: общие для всех форматов выгрузки
+EXPORT_COLUMNS = [
+    ('Номер заявки', 'int'),
+    ('Создана', 'datetime'),
+    ('Имя клиента', 'str'),
+    ('Телефон', 'str'),
+    ('Номер автомата/аппарата', 'str'),
+    ('Описание неисправности', 'str'),
+    ('Способ оплаты', 'str'),
+    ('Тип оплаты', 'str'),
+    ('Сумма затрат', 'float'),
+    ('Наименование товара', 'str'),
+    ('Время покупки/списания средств', 'str'),
+    ('Приоритет', 'int'),
+    ('Помпа', 'bool'),
+    ('Суббота', 'bool'),
+    ('Воскресенье', 'bool'),
+    ('ИП', 'str'),
+    ('Инженер', 'str'),
+    ('Статус от инженера', 'str'),
+    ('Когда закрыто инженером', 'datetime'),
+    ('Диспетчер', 'str'),
+    ('Статус от диспетчера', 'str'),
+    ('Когда закрыто диспетчером', 'datetime'),
+]
+EXPORT_BATCH_SIZE = 5000
+
+
+def export_path(suffix: str) -> str:
+    # Уникальное имя файла выгрузки: одновременные выгрузки не перезаписывают файлы друг друга
+    descriptor, path = tempfile.mkstemp(prefix='report_', suffix=suffix, dir='.')
+    os.close(descriptor)
+    return path
+
+
+def iter_export_rows(session, batch_size: int = EXPORT_BATCH_SIZE):
+    # Общий источник строк для всех форматов: текущие заявки вместе с архивными.
+    # Строки читаются пачками по мере записи файла, вся история в памяти не держится
+    related_table = Machine.__table__
+
+    # Указываем конкретные столбцы для выборки
+    def select_requests(table):
+        return select(
             table.c.id,
             table.c.created_at,
             table.c.full_name,
@@ -172,42 +700,79 @@ def export_to_excel():
             table.c.accountant_closed_by,
             table.c.accountant_status,
             table.c.accountant_closed_at
-        ]
-        
-        # Выполняем запрос на выбор данных
-        query = session.query(*columns_to_select).join(related_table, table.c.machine_number == related_table.c.number)
-        result = query.all()
-
-        df = pd.DataFrame(result, columns=[
-            'Номер заявки',
-            'Создана',
-            'Имя клиента',
-            'Телефон',
-            'Номер автомата/аппарата',
-            'Описание неисправности',
-            'Способ оплаты',
-            'Тип оплаты',
-            'Сумма затрат',
-            'Наименование товара',
-            'Время покупки/списания средств',
-            'Приоритет',
-            'Помпа',
-            'Суббота',
-            'Воскресенье',
-            'ИП',
-            'Инженер',
-            'Статус от инженера',
-            'Когда закрыто инженером',
-            'Диспетчер',
-            'Статус от диспетчера',
-            'Когда закрыто диспетчером'
-        ])
-        
-        localize_tz_column(df, 'Создана')
-        localize_tz_column(df, 'Когда закрыто инженером')
-        localize_tz_column(df, 'Когда закрыто диспетчером')
+        ).join(related_table, table.c.machine_number == related_table.c.number)
+
+    query = union_all(select_requests(ArchivedRequest), select_requests(Request.__table__)).subquery()
+    result = session.execute(select(query).order_by(query.c.id).execution_options(yield_per=batch_size))
+    yield from result.partitions()
+
+
+def export_to_excel(session=None):
+    # pandas и openpyxl нужны только для отчета и долго импортируются, поэтому грузим их здесь
+    import pandas as pd
+
+    with session_scope(session) as session:
+        # XLSX пишется только целиком, поэтому пачки собираются в одну таблицу
+        rows = [row for batch in iter_export_rows(session) for row in batch]
+        df = pd.DataFrame(rows, columns=[name for name, _ in EXPORT_COLUMNS])
+
+        for name, kind in EXPORT_COLUMNS:
+            if kind == 'datetime':
+                localize_tz_column(df, name)
 
         # Экспортируем данные в Excel
-        random_file_name = f"{int(time.time())}.xlsx"
+        random_file_name = export_path('.xlsx')
         df.to_excel(random_file_name, index=False)
         return random_file_name
+
+
+def export_to_csv(session=None):
+    # Сжатый CSV пишется потоком: память не зависит от объема истории, а файл в разы меньше XLSX.
+    # Разделитель ";" и BOM нужны, чтобы Excel с русской локалью открыл файл без настройки
+    datetime_columns = [index for index, (_, kind) in enumerate(EXPORT_COLUMNS) if kind == 'datetime']
+
+    def localize(row):
+        row = list(row)
+        for index in datetime_columns:
+            if row[index] is not None:
+                row[index] = row[index].astimezone(MOSCOW_TZ).strftime('%Y-%m-%d %H:%M:%S')
+        return row
+
+    random_file_name = export_path('.csv.gz')
+    with session_scope(session) as session, \
+            gzip.open(random_file_name, 'wt', encoding='utf-8-sig', newline='') as file:
+        writer = csv.writer(file, delimiter=';')
+        writer.writerow([name for name, _ in EXPORT_COLUMNS])
+        for batch in iter_export_rows(session):
+            writer.writerows(localize(row) for row in batch)
+    return random_file_name
+
+
+def export_to_parquet(session=None):
+    # Parquet — самый компактный формат для анализа, но требует pyarrow.
+    # Без него возвращает None. Пишется потоком, по группе строк на пачку
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        return None
+
+    types = {'int': pa.int64(), 'float': pa.float64(), 'bool': pa.bool_(), 'str': pa.string(),
+             'datetime': pa.timestamp('us', tz='UTC')}
+    schema = pa.schema([(name, types[kind]) for name, kind in EXPORT_COLUMNS])
+
+    random_file_name = export_path('.parquet')
+    with session_scope(session) as session, pq.ParquetWriter(random_file_name, schema, compression='zstd') as writer:
+        for batch in iter_export_rows(session):
+            columns = zip(*batch)
+            writer.write_batch(pa.record_batch(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema
+            ))
+    return random_file_name
+
+
+EXPORT_FORMATS = {
+    'xlsx': export_to_excel,
+    'csv': export_to_csv,
+    'parquet': export_to_parquet,
+}
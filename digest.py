@@ -0,0 +1,141 @@
+from dataclasses import dataclass
+from datetime import datetime, time, timedelta
+from sqlalchemy import func, select
+from typing import Optional
+
+from config import Config
+from database import Session
+from models import Request, RequestEvent, MOSCOW_TZ, utcnow
+
+import asyncio
+import logging
+import os
+import threading
+
+
+# Ежедневная сводка для диспетчеров и руководства: заявки за вчера, открытые заявки
+# и суммы к возврату по телефонам. Строится заранее, в DIGEST_TIME, и рассылается подписчикам
+
+
+@dataclass(frozen=True, slots=True)
+class DigestRow:
+    id: int
+    created_at: datetime
+    full_name: str
+    phone: str
+    machine_number: str
+    expense_amount: Optional[float]
+    engineer_status: str
+    accountant_status: str
+
+
+@dataclass(slots=True)
+class Digest:
+    day: datetime
+    path: str
+    caption: str
+    file_id: Optional[str] = None  # после первой отправки файл пересылается по file_id без повторной загрузки
+
+
+def next_run(now: datetime, at: time) -> datetime:
+    local = now.astimezone(MOSCOW_TZ)
+    run = datetime.combine(local.date(), at, tzinfo=MOSCOW_TZ)
+    if run <= local:
+        run += timedelta(days=1)
+    return run
+
+
+class DigestBuilder:
+    # Держит в памяти незакрытые заявки и заявки за последние сутки. При каждом запуске
+    # одним запросом читает только заявки, по которым с прошлого запуска появились события журнала
+    def __init__(self):
+        self._event_id = None  # последнее учтенное событие журнала
+        self._requests = {}  # request_id -> DigestRow
+        self.latest: Optional[Digest] = None
+        # Сводка строится в отдельном потоке: по расписанию и по запросу, если готовой еще нет
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        latest_event = select(func.max(RequestEvent.id)).scalar_subquery()
+        query = select(
+            Request.id, Request.created_at, Request.full_name, Request.phone, Request.machine_number,
+            Request.expense_amount, Request.engineer_status, Request.accountant_status, latest_event
+        )
+        # Первый запуск читает все текущие заявки: закрытые давно уже перенесены в архив
+        if self._event_id is not None:
+            query = query.where(Request.id.in_(
+                select(RequestEvent.request_id).where(RequestEvent.id > self._event_id)
+            ))
+        with Session() as session:
+            rows = session.execute(query).all()
+        for *values, event_id in rows:
+            row = DigestRow(*values)
+            self._requests[row.id] = row
+            self._event_id = event_id
+        if self._event_id is None:
+            self._event_id = 0
+
+    def build(self, now: datetime) -> Digest:
+        with self._lock:
+            return self._build(now)
+
+    def _build(self, now: datetime) -> Digest:
+        # pandas и openpyxl нужны только для файла сводки и долго импортируются, поэтому грузим их здесь
+        import pandas as pd
+
+        self.refresh()
+        today = datetime.combine(now.astimezone(MOSCOW_TZ).date(), time.min, tzinfo=MOSCOW_TZ)
+        yesterday = today - timedelta(days=1)
+
+        # Закрытые обеими сторонами заявки старше вчерашнего дня больше не нужны
+        self._requests = {
+            request_id: row for request_id, row in self._requests.items()
+            if row.engineer_status != 'closed' or row.accountant_status != 'closed' or row.created_at >= yesterday
+        }
+        rows = sorted(self._requests.values(), key=lambda row: row.id)
+        created = [row for row in rows if yesterday <= row.created_at < today]
+        backlog = [row for row in rows if row.engineer_status != 'closed' or row.accountant_status != 'closed']
+        refunds = {}
+        for row in rows:
+            if row.accountant_status != 'closed' and row.expense_amount:
+                count, total = refunds.get(row.phone, (0, 0.0))
+                refunds[row.phone] = count + 1, total + row.expense_amount
+
+        def requests_frame(items):
+            return pd.DataFrame([
+                (row.id, row.created_at.astimezone(MOSCOW_TZ).replace(tzinfo=None), row.machine_number,
+                 row.full_name, row.phone, row.expense_amount, row.engineer_status, row.accountant_status)
+                for row in items
+            ], columns=['Номер заявки', 'Создана', 'Номер автомата/аппарата', 'Имя клиента', 'Телефон',
+                        'Сумма затрат', 'Статус от инженера', 'Статус от диспетчера'])
+
+        path = f"digest_{yesterday.date().isoformat()}.xlsx"
+        with pd.ExcelWriter(path) as writer:
+            requests_frame(created).to_excel(writer, sheet_name='За вчера', index=False)
+            requests_frame(backlog).to_excel(writer, sheet_name='Открытые', index=False)
+            pd.DataFrame(
+                [(phone, count, total) for phone, (count, total) in sorted(refunds.items())],
+                columns=['Телефон', 'Заявок', 'Сумма к возврату']
+            ).to_excel(writer, sheet_name='К возврату', index=False)
+
+        caption = (f"Сводка за {yesterday.strftime('%d.%m.%Y')}: новых заявок {len(created)}, "
+                   f"открытых {len(backlog)}, к возврату {sum(total for _, total in refunds.values()):.0f} руб.")
+        if self.latest and self.latest.path != path and os.path.exists(self.latest.path):
+            os.remove(self.latest.path)
+        self.latest = Digest(yesterday, path, caption)
+        return self.latest
+
+
+async def run_digest(send):
+    # send(digest) рассылает готовую сводку подписчикам
+    while True:
+        run = next_run(utcnow(), Config.DIGEST_TIME)
+        await asyncio.sleep((run - utcnow()).total_seconds())
+        try:
+            digest = await asyncio.to_thread(digest_builder.build, utcnow())
+            await send(digest)
+        except Exception as e:
+            logging.exception(f"Error building daily digest: {e}")
+
+
+digest_builder = DigestBuilder()
@@ -0,0 +1,26 @@
+import asyncio
+import time
+
+
+class FloodLimiter:
+    # Ограничивает исходящие запросы к Telegram API: не чаще rate в секунду
+    # и не больше concurrency одновременно
+    def __init__(self, rate: float, concurrency: int):
+        self._interval = 1 / rate
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._next_slot = 0.0
+
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+        now = time.monotonic()
+        delay = self._next_slot - now
+        self._next_slot = max(now, self._next_slot) + self._interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float):
+        # Telegram ответил 429: не отправляем ничего, пока не истечет retry_after
+        self._next_slot = max(self._next_slot, time.monotonic() + seconds)
+
+    async def __aexit__(self, *exc_info):
+        self._semaphore.release()
@@ -0,0 +1,64 @@
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+from typing import Dict, Any, Callable, Awaitable
+
+import asyncio
+import logging
+import os
+import signal
+
+
+class InflightMiddleware(BaseMiddleware):
+    # Запоминает задачи, которые сейчас обрабатывают апдейты, чтобы при остановке дождаться их
+    def __init__(self):
+        self._tasks = set()
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            return await handler(event, data)
+        finally:
+            self._tasks.discard(task)
+
+    async def drain(self):
+        tasks = self._tasks - {asyncio.current_task()}
+        if tasks:
+            await asyncio.wait(tasks)
+
+
+def install_stop_signals(stop_event: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+async def handover(pid: int, timeout: float):
+    # Новый процесс уже готов к работе: просим старый завершиться и ждем, пока он доработает
+    if not process_alive(pid):
+        return
+    logging.info(f"Stopping previous process {pid}")
+    os.kill(pid, signal.SIGTERM)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while process_alive(pid):
+        if loop.time() > deadline:
+            logging.error(f"Previous process {pid} did not stop in {timeout} s, killing it")
+            os.kill(pid, signal.SIGKILL)
+            return
+        await asyncio.sleep(0.2)
@@ -0,0 +1,130 @@
+from aiogram import BaseMiddleware
+from aiogram.types import Update, Message, CallbackQuery
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Any, Callable, Awaitable
+
+from config import Config
+
+import copy
+import json
+import logging
+import queue
+import random
+import time
+
+
+# Поля апдейта, который сейчас обрабатывается: update_id, chat_id, handler, request_id.
+# Каждый апдейт обрабатывается в своей задаче asyncio, поэтому значение не пересекается с другими
+log_context: ContextVar[dict] = ContextVar('log_context', default=None)
+
+
+def bind_request(request_id: int):
+    # Привязывает к записям лога заявку, с которой работает обработчик
+    context = log_context.get()
+    if context is not None:
+        context['request_id'] = request_id
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            **getattr(record, 'context', {}),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RecordQueueHandler(QueueHandler):
+    # Стандартный prepare вписывает трассировку в текст сообщения и убирает exc_info.
+    # Очередь здесь в том же процессе, поэтому запись передается с exc_info как есть,
+    # а JsonFormatter пишет трассировку отдельным полем exception
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class ContextFilter(logging.Filter):
+    # Работает в потоке, который пишет запись, поэтому видит контекст текущего апдейта
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.context = dict(log_context.get() or {})
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    # Оставляет только долю rate отладочных записей, остальные уровни пропускает все
+    def __init__(self, rate: float):
+        super().__init__()
+        self._rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or random.random() < self._rate
+
+
+def setup_logging() -> QueueListener:
+    # Обработчики только кладут запись в очередь, в файл пишет отдельный поток,
+    # поэтому запись лога не блокирует цикл событий
+    file_handler = RotatingFileHandler(
+        Config.LOG_FILE, maxBytes=Config.LOG_MAX_BYTES, backupCount=Config.LOG_BACKUP_COUNT, encoding='utf-8'
+    )
+    file_handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = RecordQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(Config.LOG_DEBUG_SAMPLE))
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(Config.LOG_LEVEL)
+    root.handlers = [queue_handler]
+    # aiogram пишет строку на каждый апдейт, время обработки уже есть в записи "Update handled"
+    logging.getLogger('aiogram.event').setLevel(max(root.level, logging.WARNING))
+
+    listener = QueueListener(log_queue, file_handler)
+    listener.start()
+    return listener
+
+
+class CorrelationMiddleware(BaseMiddleware):
+    # Внешний middleware апдейтов: заводит контекст лога и пишет время обработки
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        chat = data.get('event_chat')
+        log_context.set({'update_id': event.update_id, 'chat_id': chat.id if chat else None})
+        started = time.monotonic()
+        try:
+            return await handler(event, data)
+        finally:
+            log_context.get()['duration_ms'] = round((time.monotonic() - started) * 1000, 1)
+            logging.debug("Update handled")
+
+
+class HandlerContextMiddleware(BaseMiddleware):
+    # Внутренний middleware сообщений и нажатий: добавляет в контекст имя обработчика и заявку из кнопки
+    async def __call__(
+        self,
+        handler: Callable[[Message | CallbackQuery, Dict[str, Any]], Awaitable[Any]],
+        event: Message | CallbackQuery,
+        data: Dict[str, Any]
+    ) -> Any:
+        # Нажатия приходят в CallbackRouter.dispatch, настоящий обработчик он кладет в callback_handler
+        handler_object = data.get('callback_handler') or data.get('handler')
+        context = log_context.get()
+        if context is not None:
+            if handler_object:
+                context['handler'] = handler_object.callback.__name__
+            request_id = getattr(data.get('callback_data'), 'request_id', None)
+            if request_id is not None:
+                context['request_id'] = request_id
+        return await handler(event, data)
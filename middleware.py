@@ -1,10 +1,13 @@
 from aiogram import BaseMiddleware
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, Update
+from collections import OrderedDict
 from typing import Dict, Any, Callable, Awaitable
 
-from database import get_db_session
+from database import Session, mark_processed
 from models import Employee
 
+import logging
+
 
 class EmployeeMiddleware(BaseMiddleware):
     async def __call__(
@@ -14,17 +17,68 @@ class EmployeeMiddleware(BaseMiddleware):
         data: Dict[str, Any]
     ) -> Any:
         user_id = event.from_user.id
-        session = get_db_session()
-        
-        try:
-            employee = session.query(Employee).filter(
-                Employee.telegram_id == user_id
-            ).first()
-            
-            # Добавляем информацию о сотрудникe в data
-            data['employee'] = employee
-            
-            # Продолжаем обработку для всех пользователей
-            return await handler(event, data)
-        finally:
-            session.close()
+        # Сотрудник загружается в сессию апдейта из UnitOfWorkMiddleware
+        employee = data['session'].query(Employee).filter(
+            Employee.telegram_id == user_id
+        ).first()
+
+        # Добавляем информацию о сотрудникe в data
+        data['employee'] = employee
+
+        # Продолжаем обработку для всех пользователей
+        return await handler(event, data)
+
+
+class UnitOfWorkMiddleware(BaseMiddleware):
+    # Одна сессия на апдейт: обработчики получают ее в data['session'] и передают в функции database,
+    # все изменения фиксируются одним коммитом после обработчика, при ошибке откатываются.
+    # autoflush выключен: до коммита изменения не пишутся в базу, поэтому SQLite не держит
+    # блокировку записи, пока обработчик ждет ответов Telegram
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        with Session(autoflush=False) as session:
+            data['session'] = session
+            result = await handler(event, data)
+            session.commit()
+            return result
+
+
+class IdempotencyMiddleware(BaseMiddleware):
+    # Пропускает апдейты, которые уже обрабатывались: Telegram повторяет доставку после
+    # падения или перезапуска бота. Недавние ключи проверяются в памяти, остальные — в базе.
+    # Апдейт отмечается до обработки, поэтому повтор не создаст вторую заявку или рассылку
+    def __init__(self, cache_size: int):
+        self._cache_size = cache_size
+        self._seen = OrderedDict()
+
+    @staticmethod
+    def keys(update: Update) -> list:
+        keys = [f"update:{update.update_id}"]
+        if update.callback_query:
+            keys.append(f"callback:{update.callback_query.id}")
+        return keys
+
+    def _remember(self, keys):
+        for key in keys:
+            self._seen[key] = None
+            self._seen.move_to_end(key)
+        while len(self._seen) > self._cache_size:
+            self._seen.popitem(last=False)
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        keys = self.keys(event)
+        duplicate = any(key in self._seen for key in keys) or not mark_processed(keys)
+        self._remember(keys)
+        if duplicate:
+            logging.info(f"Skipping duplicate update {event.update_id}")
+            return None
+        return await handler(event, data)
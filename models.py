@@ -1,10 +1,36 @@
-from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Boolean, ForeignKey, Float
+from datetime import datetime, timezone
+from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Boolean, ForeignKey, Float, \
+    UniqueConstraint, MetaData, Table, TypeDecorator, Index
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from zoneinfo import ZoneInfo
 
 
 Base = declarative_base()
 
+# Время хранится в UTC, пользователям и в отчетах показывается московское
+MOSCOW_TZ = ZoneInfo("Europe/Moscow")
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+class UTCDateTime(TypeDecorator):
+    # В базе — UTC без пояса, в Python — всегда datetime с tzinfo=UTC.
+    # Значение без пояса при записи считается уже указанным в UTC
+    impl = DateTime
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value
+
 
 class Employee(Base):
     __tablename__ = 'employees'
@@ -13,6 +39,7 @@ class Employee(Base):
     telegram_id = Column(Integer, unique=True, nullable=False)
     full_name = Column(String(100), nullable=False)
     group = Column(String(20), nullable=False)  # engineer, accountant, manager
+    district = Column(Integer, nullable=True)  # Район (Machine.engineer), пусто — все районы
 
 
 class Machine(Base):
@@ -32,33 +59,41 @@ class Machine(Base):
     engineer = Column(Integer)
 
 
+# Заявки, комментарии, фото и события переносятся в архив с теми же номерами, поэтому
+# номера не должны повторяться после переноса: AUTOINCREMENT вместо max(id) + 1
+UNIQUE_IDS = {'sqlite_autoincrement': True}
+
+
 class Photo(Base):
     __tablename__ = 'photos'
+    __table_args__ = UNIQUE_IDS
 
     id = Column(Integer, primary_key=True)
     file_id = Column(String, nullable=False)
-    request_id = Column(Integer, ForeignKey('requests.id'), nullable=False)
+    request_id = Column(Integer, ForeignKey('requests.id'), nullable=False, index=True)
 
     request = relationship("Request", back_populates="photos")
 
 
 class Comment(Base):
     __tablename__ = 'comments'
+    __table_args__ = UNIQUE_IDS
 
     id = Column(Integer, primary_key=True)
     text = Column(String, nullable=False)
-    request_id = Column(Integer, ForeignKey('requests.id'), nullable=False)
+    request_id = Column(Integer, ForeignKey('requests.id'), nullable=False, index=True)
     added_by = Column(String, nullable=False)  # 'engineer' или 'accountant'
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(UTCDateTime, default=utcnow)
 
     request = relationship("Request", back_populates="comments")
 
 
 class Request(Base):
     __tablename__ = 'requests'
+    __table_args__ = UNIQUE_IDS
     
     id = Column(Integer, primary_key=True)
-    created_at = Column(DateTime, nullable=False)
+    created_at = Column(UTCDateTime, nullable=False)
     full_name = Column(String, nullable=False)
     phone = Column(String, nullable=False)
     machine_number = Column(String(20), ForeignKey('machines.number'), nullable=False)
@@ -68,16 +103,17 @@ class Request(Base):
     expense_amount = Column(Float)
     item_name = Column(String)
     expense_time = Column(String)
+    client_id = Column(Integer, nullable=True)  # Telegram ID клиента, создавшего заявку
     comments = relationship("Comment", back_populates="request")
     photo = Column(String)  # Это фото из заявки от клиента
     photos = relationship("Photo", back_populates="request")  # Это фото от инженера
     engineer_id = Column(Integer, ForeignKey('employees.id'), nullable=True)  # Инженер, взявший заявку в работу
     engineer_status = Column(String(20), default='open')  # open, in_work, closed
-    engineer_closed_at = Column(DateTime, nullable=True)  # Время закрытия инженером
+    engineer_closed_at = Column(UTCDateTime, nullable=True)  # Время закрытия инженером
     engineer_closed_by = Column(String, nullable=True)  # Имя инженера
     accountant_id = Column(Integer, ForeignKey('employees.id'), nullable=True)  # Диспетчер, взявший заявку в работу
     accountant_status = Column(String(20), default='open')  # open, in_work, closed
-    accountant_closed_at = Column(DateTime, nullable=True)  # Время закрытия диспетчером
+    accountant_closed_at = Column(UTCDateTime, nullable=True)  # Время закрытия диспетчером
     accountant_closed_by = Column(String, nullable=True)  # Имя диспетчера
     # Связи
     assigned_engineer = relationship("Employee", foreign_keys=[engineer_id])  # Инженер
@@ -85,5 +121,107 @@ class Request(Base):
 
     machine = relationship("Machine", back_populates="requests")
 
+
+class CardMessage(Base):
+    __tablename__ = 'card_messages'
+
+    id = Column(Integer, primary_key=True)
+    request_id = Column(Integer, ForeignKey('requests.id'), nullable=False, index=True)
+    chat_id = Column(Integer, nullable=False)
+    message_id = Column(Integer, nullable=False)
+    group = Column(String(20), nullable=False)  # Группа получателя, от нее зависят текст и кнопки карточки
+    has_photo = Column(Boolean, default=False)  # Карточка отправлена как фото с подписью
+
+    # В каждом чате обновляется только последняя отправленная карточка заявки
+    __table_args__ = (Index('ux_card_messages_request_id_chat_id', 'request_id', 'chat_id', unique=True),)
+
+
+class Timer(Base):
+    __tablename__ = 'timers'
+
+    id = Column(Integer, primary_key=True)
+    request_id = Column(Integer, ForeignKey('requests.id'), nullable=False)
+    kind = Column(String(20), nullable=False)  # escalation, sla
+    due_at = Column(UTCDateTime, nullable=False)
+
+    __table_args__ = (UniqueConstraint('request_id', 'kind'),)
+
+
+class OutboxMessage(Base):
+    __tablename__ = 'outbox'
+
+    # Карточка заявки, которую не удалось отправить или обновить. Текст не хранится:
+    # при отправке карточка рисуется по текущему состоянию заявки, поэтому на пару
+    # заявка-чат достаточно одной записи, и более новое изменение заменяет старое
+    id = Column(Integer, primary_key=True)
+    request_id = Column(Integer, ForeignKey('requests.id'), nullable=False)
+    chat_id = Column(Integer, nullable=False)
+    group = Column(String(20), nullable=False)
+    message_id = Column(Integer, nullable=True)  # Пусто — отправить новую карточку, иначе — изменить эту
+    has_photo = Column(Boolean, default=False)
+    title_appendix = Column(String, default="")
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(UTCDateTime, nullable=False, default=utcnow, index=True)
+
+    __table_args__ = (UniqueConstraint('request_id', 'chat_id'),)
+
+
+class RequestEvent(Base):
+    __tablename__ = 'request_events'
+
+    id = Column(Integer, primary_key=True)
+    request_id = Column(Integer, ForeignKey('requests.id'), nullable=False)
+    created_at = Column(UTCDateTime, nullable=False, default=utcnow)
+    kind = Column(String(20), nullable=False)  # created, take, refuse, close, reopen, comment, photo
+    group = Column(String(20), nullable=True)  # Группа сотрудника: engineer, accountant
+    employee_id = Column(Integer, ForeignKey('employees.id'), nullable=True)
+    details = Column(String, nullable=True)
+
+    # Журнал только дополняется, история заявки читается одним диапазоном по индексу
+    __table_args__ = (Index('ix_request_events_request_id_id', 'request_id', 'id'), UNIQUE_IDS)
+
+
+class ProcessedUpdate(Base):
+    __tablename__ = 'processed_updates'
+
+    # update:<update_id> или callback:<callback_query_id>
+    key = Column(String(64), primary_key=True)
+    processed_at = Column(UTCDateTime, nullable=False, default=utcnow, index=True)
+
+
+class BannedUser(Base):
+    __tablename__ = 'banned_users'
+
+    telegram_id = Column(Integer, primary_key=True)
+    reason = Column(String, nullable=True)
+    created_at = Column(UTCDateTime, nullable=False, default=utcnow)
+
+
+class DigestSubscriber(Base):
+    __tablename__ = 'digest_subscribers'
+
+    employee_id = Column(Integer, ForeignKey('employees.id'), primary_key=True)
+    created_at = Column(UTCDateTime, nullable=False, default=utcnow)
+
+
 Machine.requests = relationship("Request", order_by=Request.id, back_populates="machine")
 
+
+
+# Архив закрытых заявок: те же таблицы в отдельной базе, подключенной как схема archive
+archive_metadata = MetaData(schema='archive')
+
+
+def archive_table(table):
+    return Table(
+        table.name,
+        archive_metadata,
+        *[Column(column.name, column.type, primary_key=column.primary_key, index=column.name == 'request_id')
+          for column in table.columns]
+    )
+
+
+ArchivedRequest = archive_table(Request.__table__)
+ArchivedComment = archive_table(Comment.__table__)
+ArchivedPhoto = archive_table(Photo.__table__)
+ArchivedRequestEvent = archive_table(RequestEvent.__table__)
@@ -0,0 +1,122 @@
+from aiogram.exceptions import ClientDecodeError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from datetime import timedelta
+
+from database import Session
+from flood import FloodLimiter
+from models import OutboxMessage, utcnow
+
+import asyncio
+import logging
+
+
+# Ошибки, после которых отправку имеет смысл повторить: нет связи, сбой на стороне Telegram
+# (в том числе ответ прокси не в JSON), 429
+TRANSIENT_ERRORS = (TelegramNetworkError, TelegramServerError, ClientDecodeError, TelegramRetryAfter)
+BATCH_SIZE = 100
+
+
+class Outbox:
+    # Очередь карточек, которые не удалось отправить или обновить, в таблице outbox.
+    # Повторы идут с экспоненциальной задержкой; как только одна отправка прошла,
+    # остальные записи отправляются сразу, с той скоростью, которую допускает limiter
+    def __init__(self, deliver, limiter: FloodLimiter, retry_base: float, retry_max: float):
+        self._deliver = deliver
+        self._limiter = limiter
+        self._retry_base = retry_base
+        self._retry_max = retry_max
+        self._offline = False
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+    def postpone(self, error: Exception, request_id: int, chat_id: int, group: str, message_id: int = None,
+                 has_photo: bool = False, title_appendix: str = "") -> bool:
+        # Ставит карточку в очередь, если ошибка временная. Возвращает False для остальных ошибок
+        if not isinstance(error, TRANSIENT_ERRORS):
+            return False
+        if isinstance(error, TelegramRetryAfter):
+            self._limiter.pause(error.retry_after)
+        self._offline = True
+        with Session() as session:
+            message = session.query(OutboxMessage).filter(
+                OutboxMessage.request_id == request_id, OutboxMessage.chat_id == chat_id
+            ).first()
+            if message is None:
+                message = OutboxMessage(request_id=request_id, chat_id=chat_id, next_attempt_at=self._retry_at(0))
+                session.add(message)
+            message.group = group
+            message.message_id = message_id if message_id is not None else message.message_id
+            message.has_photo = has_photo if message_id is not None else message.has_photo
+            message.title_appendix = title_appendix
+            session.commit()
+        logging.warning(f"Card for request {request_id} to chat {chat_id} postponed: {error}")
+        self._wakeup.set()
+        return True
+
+    def pending_chats(self, request_ids: list) -> set:
+        # Пары (заявка, чат), карточки для которых ждут в очереди
+        with Session() as session:
+            rows = session.query(OutboxMessage.request_id, OutboxMessage.chat_id).filter(
+                OutboxMessage.request_id.in_(request_ids)
+            ).all()
+        return {(request_id, chat_id) for request_id, chat_id in rows}
+
+    def _retry_at(self, attempts: int):
+        return utcnow() + timedelta(seconds=min(self._retry_base * 2 ** attempts, self._retry_max))
+
+    async def _attempt(self, message: OutboxMessage):
+        try:
+            async with self._limiter:
+                await self._deliver(message)
+        except TRANSIENT_ERRORS as e:
+            self._offline = True
+            if isinstance(e, TelegramRetryAfter):
+                self._limiter.pause(e.retry_after)
+                next_attempt_at, attempts = utcnow() + timedelta(seconds=e.retry_after), message.attempts
+            else:
+                next_attempt_at, attempts = self._retry_at(message.attempts + 1), message.attempts + 1
+            with Session() as session:
+                session.query(OutboxMessage).filter(OutboxMessage.id == message.id).update(
+                    {OutboxMessage.attempts: attempts, OutboxMessage.next_attempt_at: next_attempt_at}
+                )
+                session.commit()
+            return
+        except Exception as e:
+            logging.exception(f"Dropping card for request {message.request_id} to chat {message.chat_id}: {e}")
+
+        with Session() as session:
+            session.query(OutboxMessage).filter(OutboxMessage.id == message.id).delete()
+            # Связь восстановилась: не ждем задержек, отправляем все, что накопилось
+            if self._offline:
+                self._offline = False
+                session.query(OutboxMessage).update({OutboxMessage.next_attempt_at: utcnow()})
+            session.commit()
+
+    async def _run(self):
+        while not self._stopping:
+            with Session() as session:
+                due = session.query(OutboxMessage).filter(OutboxMessage.next_attempt_at <= utcnow()) \
+                    .order_by(OutboxMessage.next_attempt_at).limit(BATCH_SIZE).all()
+                next_attempt_at = None if due else session.query(OutboxMessage.next_attempt_at) \
+                    .order_by(OutboxMessage.next_attempt_at).limit(1).scalar()
+            if due:
+                await asyncio.gather(*(self._attempt(message) for message in due))
+                continue
+
+            timeout = (next_attempt_at - utcnow()).total_seconds() if next_attempt_at else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Недоставленное остается в таблице и будет отправлено после перезапуска
+        if self._task:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
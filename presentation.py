@@ -0,0 +1,82 @@
+from aiogram import types
+from aiogram.types import ReplyKeyboardMarkup, InlineKeyboardMarkup
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+from callbacks import ConfirmClose, CancelClose, ConfirmApplication, CancelApplication
+from models import MOSCOW_TZ
+
+
+# Клавиатуры не зависят от заявки, поэтому создаются один раз.
+# Объекты aiogram неизменяемые, их можно переиспользовать в любых сообщениях
+def reply_keyboard(*rows):
+    return ReplyKeyboardMarkup(
+        keyboard=[[types.KeyboardButton(text=text) for text in row] for row in rows],
+        resize_keyboard=True
+    )
+
+
+CLIENT_MENU_KEYBOARD = reply_keyboard(["Создать заявку"])
+
+# Главное меню по группам сотрудников
+MAIN_MENU_KEYBOARDS = {
+    'engineer': reply_keyboard(["Взять следующую"], ["Открытые заявки"], ["Закрытые заявки"]),
+    'accountant': reply_keyboard(
+        ["Взять следующую"], ["Открытые заявки"], ["Закрытые заявки"], ["Скачать отчет в Excel"]
+    ),
+    'manager': reply_keyboard(
+        ["Открытые заявки"], ["Закрытые заявки"], ["Скачать отчет в Excel"], ["Создать заявку"]
+    ),
+}
+
+# Рабочее меню: инженер дополнительно может добавлять фото
+WORK_MENU_KEYBOARDS = {
+    True: reply_keyboard(["Добавить код/комментарий"], ["Добавить фото"], ["Закрыть заявку"], ["Отказаться от заявки"]),
+    False: reply_keyboard(["Добавить код/комментарий"], ["Закрыть заявку"], ["Отказаться от заявки"]),
+}
+
+DONE_KEYBOARD = reply_keyboard(["Готово"])
+
+CLOSE_CONFIRMATION_KEYBOARD = InlineKeyboardMarkup(
+    inline_keyboard=[[
+        types.InlineKeyboardButton(text="Подтвердить", callback_data=ConfirmClose().pack()),
+        types.InlineKeyboardButton(text="Отменить", callback_data=CancelClose().pack())
+    ]]
+)
+
+# Анкета клиента
+CANCEL_KEYBOARD = reply_keyboard(["Отменить заявку"])
+SKIP_KEYBOARD = reply_keyboard(["Пропустить"])
+PAYMENT_METHOD_KEYBOARD = reply_keyboard(["Наличные"], ["Безналичные"])
+PAYMENT_TYPE_KEYBOARD = reply_keyboard(["QR код"], ["Карта"])
+QR_CONTINUE_KEYBOARD = reply_keyboard(["Продолжить оформление"], ["Отменить заявку"])
+APPLICATION_CONFIRMATION_KEYBOARD = InlineKeyboardMarkup(
+    inline_keyboard=[[
+        types.InlineKeyboardButton(text="Подтвердить заявку", callback_data=ConfirmApplication().pack()),
+        types.InlineKeyboardButton(text="Отменить заявку", callback_data=CancelApplication().pack())
+    ]]
+)
+
+
+MONTHS = {
+    1: 'января', 2: 'февраля', 3: 'марта', 4: 'апреля', 5: 'мая', 6: 'июня',
+    7: 'июля', 8: 'августа', 9: 'сентября', 10: 'октября', 11: 'ноября', 12: 'декабря'
+}
+
+
+@lru_cache(maxsize=1024)
+def format_day(day: date):
+    return f"{day.day:02d} {MONTHS[day.month]} {day.year}"
+
+
+def format_duration(duration: timedelta):
+    minutes = int(duration.total_seconds()) // 60
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{days} д {hours} ч {minutes} мин" if days else f"{hours} ч {minutes} мин"
+
+
+def format_datetime(date_time: datetime):
+    # Форматирование даты по русской локали, например "05 января 2025, 14:30"
+    target_datetime = date_time.astimezone(MOSCOW_TZ)
+    return f"{format_day(target_datetime.date())}, {target_datetime.hour:02d}:{target_datetime.minute:02d}"
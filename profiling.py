@@ -0,0 +1,115 @@
+from collections import Counter
+from dataclasses import dataclass, field
+from sqlalchemy import event
+
+from config import Config
+from logs import log_context
+
+import logging
+import re
+import threading
+import time
+
+
+# Профилирование запросов к базе, включается настройкой SLOW_QUERY_MS. Время каждого запроса
+# складывается в сводку по тексту запроса, а медленные пишутся в лог вместе с параметрами,
+# обработчиком (из контекста логов) и планом EXPLAIN QUERY PLAN
+
+
+@dataclass(slots=True)
+class QueryStats:
+    count: int = 0
+    total: float = 0.0  # секунды
+    max: float = 0.0
+    handlers: Counter = field(default_factory=Counter)
+
+
+# Списки параметров IN (?, ?, ...) и строки VALUES многострочной вставки разворачиваются по числу
+# значений, поэтому один и тот же запрос приходит с разным текстом. В сводке они сворачиваются
+PARAMETER_LIST = re.compile(r"\(\?(?:,\s*\?)+\)")
+VALUES_ROWS = re.compile(r"(VALUES\s*\([^()]*\))(?:,\s*\([^()]*\))+", re.IGNORECASE)
+# Сюда попадают запросы сверх stats_size разных текстов
+OTHER_QUERIES = '(другие запросы)'
+
+
+def normalize(statement: str) -> str:
+    return PARAMETER_LIST.sub("(?, ...)", VALUES_ROWS.sub(r"\1, ...", statement.strip()))
+
+
+def full_scans(plan: list) -> list:
+    # Строки плана SQLite вида "SCAN requests" — полный перебор таблицы без индекса
+    return [detail for detail in plan if detail.startswith('SCAN') and ' USING ' not in detail]
+
+
+class QueryProfiler:
+    def __init__(self, threshold: float, plan_cache_size: int = 256, stats_size: int = 1000):
+        self.threshold = threshold  # секунды
+        self.plan_cache_size = plan_cache_size
+        self.stats_size = stats_size
+        self.stats = {}  # нормализованный statement -> QueryStats
+        self._plans = {}  # нормализованный statement -> строки плана, EXPLAIN выполняется один раз на запрос
+        # Запросы выполняются и из потоков (архивация, отчеты)
+        self._lock = threading.Lock()
+
+    def install(self, engine):
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        context_data = log_context.get() or {}
+        handler = context_data.get('handler')
+        key = normalize(statement)
+        with self._lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                if len(self.stats) >= self.stats_size:
+                    key = OTHER_QUERIES
+                stats = self.stats.setdefault(key, QueryStats())
+            stats.count += 1
+            stats.total += elapsed
+            stats.max = max(stats.max, elapsed)
+            if handler:
+                stats.handlers[handler] += 1
+
+        if elapsed < self.threshold:
+            return
+        plan = None if executemany else self.explain(cursor.connection, statement, parameters, key)
+        scans = full_scans(plan or [])
+        logging.warning(
+            f"Slow query {elapsed * 1000:.1f} ms{' (full scan: ' + ', '.join(scans) + ')' if scans else ''}: "
+            f"{statement} {parameters!r}" + (f"\nQuery plan:\n" + "\n".join(plan) if plan else "")
+        )
+
+    def explain(self, dbapi_connection, statement: str, parameters, key: str):
+        if not statement.lstrip().upper().startswith(('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT')):
+            return None
+        plan = self._plans.get(key)
+        if plan is None:
+            try:
+                rows = dbapi_connection.execute(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+            except Exception as e:
+                logging.debug(f"EXPLAIN QUERY PLAN failed: {e}")
+                return None
+            # Строка плана: (id, parent, notused, detail)
+            plan = [row[-1] for row in rows]
+            with self._lock:
+                if len(self._plans) >= self.plan_cache_size:
+                    self._plans.clear()
+                self._plans[key] = plan
+        return plan
+
+    def top(self, limit: int) -> list:
+        # Запросы с наибольшим суммарным временем: [(statement, QueryStats)]
+        with self._lock:
+            return sorted(self.stats.items(), key=lambda item: item[1].total, reverse=True)[:limit]
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+
+
+profiler = QueryProfiler(Config.SLOW_QUERY_MS / 1000)
@@ -1,13 +1,14 @@
 #!/bin/bash
 
-# 1. Поиск и завершение процесса "python3 bot.py"
-PID=$(pgrep -f "python3 bot.py")
-if [ -n "$PID" ]; then
-    echo "Завершаем процесс $PID..."
-    kill -9 "$PID"
-else
-    echo "Процесс не найден."
+# 1. Поиск работающего процесса "python3 bot.py".
+# Процесс, запущенный прошлой передачей работы, тоже называется "python3 bot.py --handover N",
+# поэтому два процесса сразу означают, что передача еще идет: второй запуск ее бы сломал
+PIDS=$(pgrep -f '^python3 bot.py( |$)')
+if [ "$(echo "$PIDS" | grep -c .)" -gt 1 ]; then
+    echo "Идет передача работы между процессами $(echo $PIDS), повторите позже."
+    exit 1
 fi
+PID=$PIDS
 
 # 2. Переход в директорию с кодом
 cd /home/bot/vending_machines_bot || exit
@@ -18,6 +19,14 @@ git pull
 # 4. Активация виртуального окружения
 source /home/bot/vending_machines_bot/venv/bin/activate
 
-# 5. Запуск нового процесса с перенаправлением вывода
-nohup python3 bot.py > telegram-bot.log 2>&1 &
+# 5. Запуск нового процесса с перенаправлением вывода.
+# Новый процесс после инициализации сам останавливает старый сигналом SIGTERM
+# и ждет, пока тот доработает принятые апдейты, поэтому kill -9 не нужен
+if [ -n "$PID" ]; then
+    echo "Передаем работу от процесса $PID..."
+    nohup python3 bot.py --handover "$PID" >> telegram-bot.log 2>&1 &
+else
+    echo "Процесс не найден."
+    nohup python3 bot.py >> telegram-bot.log 2>&1 &
+fi
 echo "Процесс запущен. PID: $!"
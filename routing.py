@@ -0,0 +1,70 @@
+from collections import defaultdict
+from sqlalchemy import event
+
+from config import Config
+from database import Session
+from models import Employee, Machine
+
+import time
+
+
+ROUTED_GROUPS = ('engineer', 'accountant')
+
+
+class RoutingTable:
+    # Кому отправлять заявки по каждому автомату. Инженеры и диспетчеры получают заявки своего района
+    # (сотрудник без района обслуживает все), если в районе никого нет — всю группу.
+    # Таблица строится один раз и сбрасывается при изменении сотрудников или автоматов,
+    # а также по истечении ttl, так как справочники правят и напрямую в базе
+    def __init__(self, ttl: float):
+        self._ttl = ttl
+        self._built_at = None
+        self._machines = {}
+        self._routes = {}
+        self._groups = {}
+
+    def invalidate(self, *args):
+        self._built_at = None
+
+    def _ensure_built(self):
+        if self._built_at is not None and time.monotonic() - self._built_at < self._ttl:
+            return
+
+        with Session() as session:
+            employees = session.query(Employee).all()
+            machines = session.query(Machine.number, Machine.engineer).all()
+
+        groups = defaultdict(list)
+        for employee in employees:
+            groups[employee.group].append(employee)
+
+        routes = {}
+        for district in {district for _, district in machines} | {None}:
+            routes[district] = {}
+            for group in ROUTED_GROUPS:
+                assigned = [
+                    employee for employee in groups[group]
+                    if employee.district is None or employee.district == district
+                ]
+                routes[district][group] = tuple(assigned or groups[group])
+
+        self._machines = dict(machines)
+        self._routes = routes
+        self._groups = {group: tuple(members) for group, members in groups.items()}
+        self._built_at = time.monotonic()
+
+    def recipients(self, machine_number: str, groups=ROUTED_GROUPS):
+        self._ensure_built()
+        route = self._routes[self._machines.get(machine_number)]
+        return [employee for group in groups for employee in route[group]]
+
+    def employees(self, groups):
+        self._ensure_built()
+        return [employee for group in groups for employee in self._groups.get(group, ())]
+
+
+routing_table = RoutingTable(Config.ROUTING_TTL)
+
+for model in (Employee, Machine):
+    for name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, name, routing_table.invalidate)
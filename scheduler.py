@@ -0,0 +1,141 @@
+from datetime import datetime, time, timedelta, timezone
+
+from config import Config
+from database import Session
+from models import Timer, MOSCOW_TZ, utcnow
+
+import asyncio
+import heapq
+import logging
+
+
+def sla_deadline(start: datetime, machine) -> datetime:
+    # Срок зависит от приоритета автомата. Субботы и воскресенья (по Москве), в которые автомат
+    # не обслуживается (saturday/sunday = False), в срок не засчитываются
+    hours = Config.SLA_HOURS.get(machine.priority, Config.SLA_DEFAULT_HOURS) if machine else Config.SLA_DEFAULT_HOURS
+    skipped_days = set()
+    if machine and machine.saturday is False:
+        skipped_days.add(5)
+    if machine and machine.sunday is False:
+        skipped_days.add(6)
+
+    remaining = timedelta(hours=hours)
+    current = start.astimezone(MOSCOW_TZ)
+    while True:
+        day_end = datetime.combine(current.date() + timedelta(days=1), time.min, tzinfo=MOSCOW_TZ)
+        if current.weekday() not in skipped_days:
+            if current + remaining <= day_end:
+                return (current + remaining).astimezone(timezone.utc)
+            remaining -= day_end - current
+        current = day_end
+
+
+class Scheduler:
+    # Таймеры заявок на одной задаче asyncio: куча по времени срабатывания, O(log n) на постановку.
+    # Таймеры хранятся в таблице timers и восстанавливаются после перезапуска.
+    # На заявку приходится не больше одного таймера каждого вида, отмененные таймеры
+    # остаются в куче и пропускаются при извлечении
+    def __init__(self):
+        self._heap = []
+        self._timers = {}  # id -> (request_id, kind)
+        self._keys = {}  # (request_id, kind) -> id
+        self._handlers = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+    def register(self, kind: str, handler):
+        self._handlers[kind] = handler
+
+    def load(self):
+        with Session() as session:
+            timers = session.query(Timer.id, Timer.request_id, Timer.kind, Timer.due_at).all()
+        self._timers = {timer_id: (request_id, kind) for timer_id, request_id, kind, _ in timers}
+        self._keys = {key: timer_id for timer_id, key in self._timers.items()}
+        self._heap = [(due_at, timer_id) for timer_id, _, _, due_at in timers]
+        heapq.heapify(self._heap)
+
+    def pending(self, request_id: int, kind: str) -> bool:
+        return (request_id, kind) in self._keys
+
+    def schedule(self, request_id: int, kind: str, due_at: datetime):
+        with Session() as session:
+            session.query(Timer).filter(Timer.request_id == request_id, Timer.kind == kind).delete()
+            timer = Timer(request_id=request_id, kind=kind, due_at=due_at)
+            session.add(timer)
+            session.commit()
+            timer_id = timer.id
+
+        self._forget(request_id, kind)
+        self._timers[timer_id] = (request_id, kind)
+        self._keys[(request_id, kind)] = timer_id
+        heapq.heappush(self._heap, (due_at, timer_id))
+        if self._heap[0][1] == timer_id:
+            self._wakeup.set()
+
+    def cancel(self, request_ids: list, kinds: list = None):
+        # Отменяет таймеры нескольких заявок одним удалением
+        timers = [(request_id, kind) for request_id in request_ids for kind in (kinds or self._handlers)
+                  if self.pending(request_id, kind)]
+        if not timers:
+            return
+        with Session() as session:
+            session.query(Timer).filter(Timer.id.in_([self._keys[key] for key in timers])).delete()
+            session.commit()
+        for request_id, kind in timers:
+            self._forget(request_id, kind)
+
+    def _forget(self, request_id, kind):
+        timer_id = self._keys.pop((request_id, kind), None)
+        if timer_id is not None:
+            del self._timers[timer_id]
+        # Пересобираем кучу, если отмененных записей в ней больше, чем действующих
+        if len(self._heap) > 2 * len(self._timers) + 64:
+            self._heap = [item for item in self._heap if item[1] in self._timers]
+            heapq.heapify(self._heap)
+
+    async def _fire(self, timer_id):
+        request_id, kind = self._timers[timer_id]
+        self._forget(request_id, kind)
+        with Session() as session:
+            session.query(Timer).filter(Timer.id == timer_id).delete()
+            session.commit()
+        try:
+            await self._handlers[kind](request_id)
+        except Exception as e:
+            logging.exception(f"Error in {kind} timer for request {request_id}: {e}")
+
+    async def _run(self):
+        while not self._stopping:
+            while self._heap and self._heap[0][1] not in self._timers:
+                heapq.heappop(self._heap)
+
+            timeout = None
+            if self._heap:
+                due_at, timer_id = self._heap[0]
+                timeout = (due_at - utcnow()).total_seconds()
+                if timeout <= 0:
+                    heapq.heappop(self._heap)
+                    await self._fire(timer_id)
+                    continue
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self._stopping = False
+        self.load()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Срабатывающий сейчас таймер дорабатывает, новые не запускаются
+        if self._task:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+
+
+scheduler = Scheduler()
@@ -0,0 +1,56 @@
+from pathlib import Path
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+
+# Бот и база настраиваются при импорте модулей: пути к базам относительные, поэтому
+# тесты работают в отдельном временном каталоге с фиктивным токеном
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.chdir(tempfile.mkdtemp(prefix='bot-tests-'))
+os.environ['BOT_TOKEN'] = '123456:test'
+os.environ.setdefault('LOG_FILE', 'bot.log')
+
+
+@pytest.fixture(scope='session')
+def schema():
+    from database import migrate
+    migrate()
+
+
+@pytest.fixture
+def db(schema):
+    # Каждый тест начинается с пустых таблиц
+    from database import engine
+    from models import Base, archive_metadata
+
+    with engine.begin() as connection:
+        for metadata in (Base.metadata, archive_metadata):
+            for table in reversed(metadata.sorted_tables):
+                connection.execute(table.delete())
+        connection.exec_driver_sql("DELETE FROM sqlite_sequence")
+    return engine
+
+
+@pytest.fixture
+def machine(db):
+    from database import Session
+    from models import Machine
+
+    with Session() as session:
+        machine = Machine(number='0001', address='ул. Тестовая, 1')
+        session.add(machine)
+        session.commit()
+        return machine
+
+
+def new_request(**fields):
+    from database import save_to_db
+
+    data = {'machine': '0001', 'full_name': 'Клиент', 'phone': '79000000000', 'client_id': 1}
+    data.update(fields)
+    return save_to_db(data)
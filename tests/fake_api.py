@@ -0,0 +1,96 @@
+from aiohttp import web
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import asyncio
+import itertools
+
+
+class FakeBotAPI:
+    # Локальный сервер Bot API для тестов: отвечает на методы, записывает вызовы
+    # и умеет изображать медленную сеть, недоступность (502) и 429 Too Many Requests
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.mode = 'up'  # up, down, 429
+        self.retry_after = 1
+        self.calls = []  # (метод, параметры)
+        self.updates = []  # отдаются первым же getUpdates
+        self.sent = asyncio.Event()  # первый sendMessage
+        self._message_ids = itertools.count(1)
+        self._runner = None
+        self.url = None
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._runner.cleanup()
+
+    def session(self):
+        return AiohttpSession(api=TelegramAPIServer.from_base(self.url))
+
+    def methods(self, name: str) -> list:
+        return [data for method, data in self.calls if method == name]
+
+    async def handle(self, request: web.Request):
+        method = request.match_info['method']
+        data = dict(await request.post())
+        if method == 'getMe':
+            return self.ok({'id': 123456, 'is_bot': True, 'first_name': 'Бот', 'username': 'test_bot'})
+        if method == 'getUpdates':
+            updates, self.updates = self.updates, []
+            if not updates:
+                await asyncio.sleep(min(float(data.get('timeout', 0)), 1))
+            return self.ok(updates)
+
+        self.calls.append((method, data))
+        if self.mode == 'down':
+            return web.Response(status=502, text='Bad Gateway')
+        if self.mode == '429':
+            return web.json_response({'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                                      'parameters': {'retry_after': self.retry_after}})
+        if method.startswith('send'):
+            self.sent.set()
+        await asyncio.sleep(self.delay)
+        if method in ('answerCallbackQuery', 'deleteMessage', 'setWebhook', 'deleteWebhook'):
+            return self.ok(True)
+        chat_id = int(data.get('chat_id', 1))
+        return self.ok({'message_id': next(self._message_ids), 'date': 0,
+                        'chat': {'id': chat_id, 'type': 'private'}, 'text': data.get('text', '')})
+
+    @staticmethod
+    def ok(result):
+        return web.json_response({'ok': True, 'result': result})
+
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': 0, 'text': text,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Клиент'},
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+            if text.startswith('/') else [],
+        },
+    }
+
+
+def callback_update(update_id: int, callback_id: str, user_id: int, data: str) -> dict:
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': callback_id, 'chat_instance': 'chat', 'data': data,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Пользователь'},
+            'message': {'message_id': 1, 'date': 0, 'text': 'Сообщение с кнопками',
+                        'chat': {'id': user_id, 'type': 'private'}},
+        },
+    }
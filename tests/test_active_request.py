@@ -0,0 +1,48 @@
+from aiogram.types import Update
+
+from config import Config
+from database import get_request_by_id, Session
+from models import Employee
+
+from tests.conftest import new_request
+from tests.fake_api import FakeBotAPI, callback_update, message_update
+
+import asyncio
+
+import bot
+
+
+ENGINEER = 4000
+
+
+def test_actions_apply_to_the_last_taken_request(machine, monkeypatch):
+    monkeypatch.setattr(Config, 'MAX_IN_WORK', 2)
+    with Session() as session:
+        session.add(Employee(telegram_id=ENGINEER, full_name='Инженер', group='engineer'))
+        session.commit()
+    first, second = new_request(), new_request()
+
+    stream = [
+        callback_update(301, 'take-1', ENGINEER, f'take_request:{first}'),
+        callback_update(302, 'take-2', ENGINEER, f'take_request:{second}'),
+        message_update(303, ENGINEER, 'Закрыть заявку'),
+        callback_update(304, 'close', ENGINEER, 'confirm_close'),
+        message_update(305, ENGINEER, '/start'),
+    ]
+
+    async def scenario():
+        async with FakeBotAPI() as api:
+            bot.bot.session = api.session()
+            for update in stream:
+                await bot.dp.feed_update(bot.bot, Update.model_validate(update, context={'bot': bot.bot}))
+            await bot.bot.session.close()
+            return api
+
+    api = asyncio.run(scenario())
+
+    texts = [data['text'] for data in api.methods('sendMessage') if int(data['chat_id']) == ENGINEER]
+    assert any(text.startswith(f"Подтвердите закрытие заявки №{second}") for text in texts)
+    # Закрыта взятая последней заявка, первая осталась в работе и снова стала текущей
+    assert get_request_by_id(second).engineer_status == 'closed'
+    assert get_request_by_id(first).engineer_status == 'in_work'
+    assert texts[-1] == f"Работа с заявкой №{first}:"
@@ -0,0 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from sqlalchemy import select
+
+from archive import archive_closed_requests, copy_to_archive, delete_archived
+from bot import export_snapshot
+from cards import get_request_card, get_request_cards
+from database import Session, update_request, add_comments, export_to_csv
+from models import Request, ArchivedRequest, utcnow
+
+from tests.conftest import new_request
+
+import csv
+import gzip
+import os
+import threading
+
+import archive
+
+
+def close(request_id):
+    update_request(request_id, engineer_status='closed', engineer_closed_at=utcnow() - timedelta(days=100),
+                   accountant_status='closed', accountant_closed_at=utcnow() - timedelta(days=100))
+
+
+def test_archived_requests_move_with_comments(machine):
+    first, second = new_request(), new_request()
+    add_comments(first, ['код 1'], 'engineer')
+    close(first)
+
+    assert archive_closed_requests(utcnow() - timedelta(days=90)) == 1
+
+    with Session() as session:
+        assert [request.id for request in session.query(Request)] == [second]
+    cards = {card.id: card for card in get_request_cards(lambda table: table.c.id > 0, archive=True)}
+    assert sorted(cards) == [first, second]
+    assert cards[first].engineer_comments == ('код 1',)
+
+
+def test_ids_are_not_reused_after_archiving(machine):
+    old = new_request(full_name='old')
+    close(old)
+    archive_closed_requests(utcnow() - timedelta(days=90))
+
+    new = new_request(full_name='new')
+
+    assert new > old
+    cards = get_request_cards(lambda table: table.c.id > 0, archive=True)
+    assert [(card.id, card.full_name) for card in cards] == [(old, 'old'), (new, 'new')]
+
+
+def archived_ids():
+    with Session() as session:
+        return session.scalars(select(ArchivedRequest.c.id).order_by(ArchivedRequest.c.id)).all()
+
+
+def test_move_interrupted_after_copy_is_completed(machine):
+    request_id = new_request()
+    add_comments(request_id, ['код 1'], 'engineer')
+    close(request_id)
+    # Сбой между копированием в архив и удалением из рабочей базы
+    copy_to_archive([request_id])
+
+    assert archive_closed_requests(utcnow() - timedelta(days=90)) == 1
+
+    assert archived_ids() == [request_id]
+    cards = get_request_cards(lambda table: table.c.id > 0, archive=True)
+    assert [(card.id, card.engineer_comments) for card in cards] == [(request_id, ('код 1',))]
+
+
+def test_request_changed_after_copy_stays_live(machine):
+    request_id = new_request()
+    close(request_id)
+    copy_to_archive([request_id])
+    # Комментарий добавлен после копирования: удалять заявку из рабочей базы нельзя
+    add_comments(request_id, ['поздний комментарий'], 'accountant')
+
+    assert delete_archived([request_id], utcnow() - timedelta(days=90)) == []
+    update_request(request_id, engineer_status='in_work')
+    assert archive_closed_requests(utcnow() - timedelta(days=90)) == 0
+
+    assert archived_ids() == []
+    card = get_request_card(request_id)
+    assert card.engineer_status == 'in_work' and card.accountant_comments == ('поздний комментарий',)
+
+
+def test_exports_during_inserts_and_archiving(machine, monkeypatch):
+    # Выгрузки идут одновременно друг с другом, с созданием заявок и переносом в архив:
+    # у каждой свой файл, и в каждой каждая заявка ровно один раз
+    monkeypatch.setattr(archive, 'BATCH_SIZE', 1)
+    old = [new_request() for _ in range(100)]
+    for request_id in old:
+        close(request_id)
+    stop = threading.Event()
+
+    def insert_requests():
+        while not stop.is_set():
+            new_request()
+
+    def export():
+        path = export_snapshot(export_to_csv)
+        with gzip.open(path, 'rt', encoding='utf-8-sig') as file:
+            return path, [int(row[0]) for row in list(csv.reader(file, delimiter=';'))[1:]]
+
+    with ThreadPoolExecutor(8) as pool:
+        inserter = pool.submit(insert_requests)
+        archiver = pool.submit(archive_closed_requests, utcnow() - timedelta(days=90))
+        exports = [pool.submit(export) for _ in range(20)]
+        results = [future.result() for future in exports]
+        assert archiver.result() == len(old)
+        stop.set()
+        inserter.result()
+
+    assert len({path for path, _ in results}) == len(results)
+    for path, ids in results:
+        os.remove(path)
+        assert len(ids) == len(set(ids))
+        assert set(old) <= set(ids)
+    assert archived_ids() == old
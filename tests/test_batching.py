@@ -0,0 +1,24 @@
+from batching import Debouncer
+
+import asyncio
+
+
+def test_failed_flush_is_reported():
+    failed = []
+
+    async def flush(key, items):
+        raise RuntimeError("database is locked")
+
+    async def on_error(key, items):
+        failed.append((key, items))
+
+    async def scenario():
+        batches = Debouncer(0.01, flush, on_error=on_error)
+        batches.add('chat', 'photo-1')
+        batches.add('chat', 'photo-2')
+        await asyncio.sleep(0.05)
+        await batches.drain()
+
+    asyncio.run(scenario())
+    # Пачка не теряется молча: отправитель узнает, какие элементы не сохранены
+    assert failed == [('chat', ['photo-1', 'photo-2'])]
@@ -0,0 +1,84 @@
+from aiogram.types import Update
+from sqlalchemy import event
+
+from bot import parse_bulk_args
+from database import add_card_messages, bulk_transition, engine, get_request_by_id, Session, update_request
+from models import Employee
+
+from tests.conftest import new_request
+from tests.fake_api import FakeBotAPI, message_update
+
+import asyncio
+
+import bot
+
+
+REQUESTS = 5
+
+
+def test_bulk_filters_are_parsed():
+    options, filters = parse_bulk_args(['group=engineer', 'machine=0001', 'status=in_work', 'to=7'])
+    assert options['to'] == '7'
+    assert filters == {'machine': '0001', 'status': 'in_work'}
+
+
+def test_unknown_or_malformed_bulk_keys_are_rejected():
+    # Опечатка в фильтре не должна превращать операцию в операцию над всеми заявками группы
+    assert parse_bulk_args(['group=engineer', 'machne=0001']) is None
+    assert parse_bulk_args(['group=engineer', 'district=1', 'olders=30']) is None
+    assert parse_bulk_args(['group=engineer', 'machine']) is None
+    assert parse_bulk_args(['group=engineer', 'district=north']) is None
+    assert parse_bulk_args(['group=client', 'machine=0001']) is None
+
+
+def test_bulk_reopen_returns_closed_requests_to_their_engineer(machine):
+    with Session() as session:
+        manager = Employee(telegram_id=5000, full_name='Руководитель', group='manager')
+        engineer = Employee(telegram_id=5001, full_name='Инженер', group='engineer')
+        session.add_all([manager, engineer])
+        session.commit()
+    in_work, closed, closed_unassigned = new_request(), new_request(), new_request()
+    update_request(in_work, engineer_status='in_work', engineer_id=engineer.id)
+    update_request(closed, engineer_status='closed', engineer_id=engineer.id)
+    update_request(closed_unassigned, engineer_status='closed')
+
+    assert bulk_transition('engineer', 'reopen', manager, {'machine': '0001'}) == [closed, closed_unassigned]
+    # Заявка в работе не затронута, закрытая вернулась к своему инженеру
+    assert (get_request_by_id(in_work).engineer_status, get_request_by_id(in_work).engineer_id) == \
+        ('in_work', engineer.id)
+    assert (get_request_by_id(closed).engineer_status, get_request_by_id(closed).engineer_id) == \
+        ('in_work', engineer.id)
+    assert get_request_by_id(closed_unassigned).engineer_status == 'open'
+
+
+def test_bulk_close_refreshes_all_cards_in_one_fan_out(machine):
+    with Session() as session:
+        manager = Employee(telegram_id=5100, full_name='Руководитель', group='manager')
+        session.add(manager)
+        session.commit()
+    request_ids = [new_request() for _ in range(REQUESTS)]
+    for request_id in request_ids:
+        add_card_messages(request_id, [(5200, request_id, 'engineer', False), (5100, request_id, 'manager', False)])
+
+    statements = []
+
+    def on_execute(connection, cursor, statement, *args):
+        statements.append(statement)
+
+    async def scenario():
+        async with FakeBotAPI() as api:
+            bot.bot.session = api.session()
+            update = message_update(501, 5100, '/bulk close group=engineer machine=0001')
+            await bot.dp.feed_update(bot.bot, Update.model_validate(update, context={'bot': bot.bot}))
+            await bot.bot.session.close()
+            return api
+
+    event.listen(engine, 'before_cursor_execute', on_execute)
+    try:
+        api = asyncio.run(scenario())
+    finally:
+        event.remove(engine, 'before_cursor_execute', on_execute)
+
+    assert len(api.methods('editMessageText')) == 2 * REQUESTS
+    # Карточки и записи о них читаются одним запросом на всю операцию, а не на каждую заявку
+    assert sum('FROM card_messages' in statement for statement in statements) == 1
@@ -0,0 +1,31 @@
+from cards import get_request_card, get_request_cards
+from database import add_card_messages, add_comments, add_photos, get_card_messages
+
+from tests.conftest import new_request
+
+
+def test_cards_show_only_their_own_comments(machine):
+    first, second = new_request(), new_request()
+    add_comments(first, ["первый", "второй"], 'engineer')
+    add_comments(second, ["чужой"], 'engineer')
+    add_comments(second, ["возврат"], 'accountant')
+    add_photos(second, ["photo-1", "photo-2"])
+
+    cards = {card.id: card for card in get_request_cards(lambda table: table.c.id.in_([first, second]))}
+    assert cards[first].engineer_comments == ("первый", "второй")
+    assert cards[first].accountant_comments == ()
+    assert cards[first].photos_count == 0
+    assert cards[second].engineer_comments == ("чужой",)
+    assert cards[second].accountant_comments == ("возврат",)
+    assert cards[second].photos_count == 2
+    assert get_request_card(first).engineer_comments == ("первый", "второй")
+
+
+def test_reopened_list_keeps_one_card_per_chat(machine):
+    request_id = new_request()
+    add_card_messages(request_id, [(10, 1, 'engineer', False), (20, 2, 'engineer', False)])
+    # Список заявок открыт в чате 10 еще раз: запись указывает на новое сообщение
+    add_card_messages(request_id, [(10, 3, 'manager', False)])
+
+    cards = sorted((card.chat_id, card.message_id, card.group) for card in get_card_messages([request_id]))
+    assert cards == [(10, 3, 'manager'), (20, 2, 'engineer')]
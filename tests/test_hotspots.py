@@ -0,0 +1,38 @@
+from datetime import timedelta
+
+from analytics import HotspotTracker
+from cards import get_request_cards
+from models import utcnow
+
+from tests.conftest import new_request
+
+import pytest
+
+
+def tracker():
+    return HotspotTracker(half_life=timedelta(hours=24), baseline_half_life=timedelta(days=30), factor=3,
+                          min_count=3, cooldown=timedelta(hours=24))
+
+
+def test_history_loaded_after_startup_merges_with_live_requests(machine):
+    history = [new_request(expense_amount=100) for _ in range(3)]
+    until = utcnow()
+    live = tracker()
+    live.history_until = until
+
+    # Пока история загружается, подтверждаются новые заявки; заявки до until уже есть в истории
+    assert not live.record('0001', until - timedelta(seconds=1), 100)
+    live.record('0001', until + timedelta(hours=1), 50)
+    live.merge(live.history(until - timedelta(days=1), until))
+
+    expected = tracker()
+    for card in get_request_cards(lambda table: table.c.id.in_(history)):
+        expected.record('0001', card.created_at, card.expense_amount)
+    expected.record('0001', until + timedelta(hours=1), 50)
+
+    now = until + timedelta(hours=2)
+    merged, reference = live.hotspot('0001', now), expected.hotspot('0001', now)
+    assert merged.recent_rate == pytest.approx(reference.recent_rate)
+    assert merged.baseline_rate == pytest.approx(reference.baseline_rate)
+    assert merged.refunds == pytest.approx(reference.refunds) and merged.refunds > 300
+    assert merged.spiking and reference.spiking
@@ -0,0 +1,59 @@
+from aiogram.types import Update
+from sqlalchemy import func, select
+
+from database import Session
+from models import Employee, ProcessedUpdate, Request
+from routing import routing_table
+
+from tests.fake_api import FakeBotAPI, callback_update, message_update
+
+import asyncio
+
+import bot
+
+
+CLIENT = 2000
+ENGINEER = 3000
+
+
+def test_replayed_stream_creates_one_request(machine):
+    with Session() as session:
+        session.add(Employee(telegram_id=ENGINEER, full_name='Инженер', group='engineer'))
+        session.commit()
+    routing_table.invalidate()
+
+    confirm = callback_update(201, 'tap-1', CLIENT, 'confirm_application')
+    stream = [
+        confirm,
+        confirm,  # повторная доставка того же апдейта
+        dict(confirm, update_id=202),  # тот же callback_query в другом апдейте
+        callback_update(203, 'tap-2', CLIENT, 'confirm_application'),  # двойное нажатие кнопки
+        message_update(204, CLIENT, '/start'),
+        message_update(204, CLIENT, '/start'),
+    ]
+
+    async def scenario():
+        async with FakeBotAPI() as api:
+            bot.bot.session = api.session()
+            state = bot.dp.fsm.get_context(bot.bot, chat_id=CLIENT, user_id=CLIENT)
+            await state.set_state(bot.ClientStates.confirmation)
+            await state.set_data({'machine': '0001', 'full_name': 'Клиент', 'phone': '89000000000'})
+            # Апдейты приходят одновременно, как при повторной доставке после перезапуска
+            await asyncio.gather(*(
+                bot.dp.feed_update(bot.bot, Update.model_validate(update, context={'bot': bot.bot}))
+                for update in stream
+            ))
+            await bot.bot.session.close()
+            return api
+
+    api = asyncio.run(scenario())
+
+    with Session() as session:
+        assert session.scalar(select(func.count()).select_from(Request)) == 1
+        # Апдейт 202 отброшен целиком, его ключи не записываются
+        assert set(session.scalars(select(ProcessedUpdate.key))) == {
+            'update:201', 'callback:tap-1', 'update:203', 'callback:tap-2', 'update:204'
+        }
+    # Карточка разослана один раз, клиент получил одно подтверждение и один ответ на /start
+    assert [int(data['chat_id']) for data in api.methods('sendMessage')].count(ENGINEER) == 1
+    assert [int(data['chat_id']) for data in api.methods('sendMessage')].count(CLIENT) == 2
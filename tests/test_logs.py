@@ -0,0 +1,20 @@
+from logs import JsonFormatter, RecordQueueHandler
+
+import json
+import logging
+import queue
+
+
+def test_exception_is_written_as_a_separate_field():
+    log_queue = queue.SimpleQueue()
+    logger = logging.getLogger('tests.logs')
+    logger.propagate = False
+    logger.addHandler(RecordQueueHandler(log_queue))
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        logger.exception("Error %s", 'saving')
+
+    entry = json.loads(JsonFormatter().format(log_queue.get_nowait()))
+    assert entry['message'] == "Error saving"
+    assert entry['exception'].endswith("ValueError: boom")
@@ -0,0 +1,35 @@
+from sqlalchemy import create_engine
+
+from database import AUTOINCREMENT_TABLES, MIGRATIONS, rebuild_with_autoincrement
+
+
+def test_autoincrement_rebuild_keeps_rows_and_later_migrations_apply():
+    # База до перехода на AUTOINCREMENT: те же таблицы без него и без индексов более поздних миграций
+    engine = create_engine('sqlite://')
+    with engine.begin() as connection:
+        for name, columns in AUTOINCREMENT_TABLES.items():
+            connection.exec_driver_sql(f"CREATE TABLE {name} ({columns.replace(' AUTOINCREMENT', '')})")
+        connection.exec_driver_sql("CREATE TABLE card_messages (id INTEGER PRIMARY KEY, request_id INTEGER, chat_id INTEGER)")
+        connection.exec_driver_sql(
+            "INSERT INTO requests (id, created_at, full_name, phone, machine_number) "
+            "VALUES (7, '2024-01-01 00:00:00', 'Клиент', '79000000000', '0001')"
+        )
+        connection.exec_driver_sql("INSERT INTO comments (id, text, request_id, added_by) VALUES (3, 'т', 7, 'engineer')")
+
+        for migration in MIGRATIONS[MIGRATIONS.index(rebuild_with_autoincrement):]:
+            if callable(migration):
+                migration(connection)
+            else:
+                connection.exec_driver_sql(migration)
+
+        assert connection.exec_driver_sql("SELECT id FROM requests").scalars().all() == [7]
+        assert connection.exec_driver_sql("SELECT id FROM comments").scalars().all() == [3]
+        indexes = set(connection.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'").scalars())
+        assert {'ix_request_events_request_id_id', 'ix_comments_request_id', 'ix_photos_request_id'} <= indexes
+        # Удаленный номер не выдается повторно
+        connection.exec_driver_sql("DELETE FROM requests")
+        connection.exec_driver_sql(
+            "INSERT INTO requests (created_at, full_name, phone, machine_number) "
+            "VALUES ('2024-01-02 00:00:00', 'Клиент', '79000000000', '0001')"
+        )
+        assert connection.exec_driver_sql("SELECT id FROM requests").scalar() == 8
@@ -0,0 +1,80 @@
+from sqlalchemy import select
+
+from cards import get_request_card
+from database import Session
+from models import CardMessage, Employee, OutboxMessage
+
+from tests.conftest import new_request
+from tests.fake_api import FakeBotAPI
+
+import asyncio
+import time
+
+import bot
+
+
+ENGINEERS = (3001, 3002, 3003)
+
+
+def outbox_rows():
+    with Session() as session:
+        return session.scalars(select(OutboxMessage)).all()
+
+
+async def wait_for(condition, timeout: float):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        await asyncio.sleep(0.05)
+
+
+def test_outbox_survives_outage_and_429(machine, monkeypatch):
+    with Session() as session:
+        session.add_all([Employee(telegram_id=telegram_id, full_name='Инженер', group='engineer')
+                         for telegram_id in ENGINEERS])
+        session.commit()
+        employees = session.scalars(select(Employee)).all()
+    request = get_request_card(new_request())
+    monkeypatch.setattr(bot.outbox, '_retry_base', 0.05)
+    monkeypatch.setattr(bot.outbox, '_retry_max', 30)
+    # Событие привязывается к циклу событий теста, у main() в других тестах — свое
+    monkeypatch.setattr(bot.outbox, '_wakeup', asyncio.Event())
+
+    async def scenario():
+        async with FakeBotAPI() as api:
+            bot.bot.session = api.session()
+
+            # Telegram недоступен: карточки попадают в очередь, повторное изменение заменяет запись
+            api.mode = 'down'
+            await bot.send_notification(bot.bot, request, employees)
+            await bot.send_notification(bot.bot, request, employees, title_appendix="повтор")
+            rows = outbox_rows()
+            assert sorted(row.chat_id for row in rows) == list(ENGINEERS)
+            assert {row.title_appendix for row in rows} == {"повтор"}
+
+            bot.outbox.start()
+            try:
+                # Повторы идут с растущей задержкой
+                await wait_for(lambda: all(row.attempts >= 2 for row in outbox_rows()), 5)
+
+                # 429: до истечения retry_after новых запросов нет
+                api.mode, api.retry_after = '429', 1
+                calls = len(api.calls)
+                await wait_for(lambda: len(api.calls) > calls, 5)
+                await asyncio.sleep(0.1)
+                limited = len(api.calls)
+                await asyncio.sleep(0.5)
+                assert len(api.calls) == limited
+
+                # Связь восстановилась: очередь отправляется целиком, без ожидания задержек
+                api.mode = 'up'
+                await wait_for(lambda: not outbox_rows(), 5)
+            finally:
+                await bot.outbox.stop()
+            await bot.bot.session.close()
+
+    asyncio.run(scenario())
+
+    with Session() as session:
+        cards = session.scalars(select(CardMessage)).all()
+    assert sorted(card.chat_id for card in cards) == list(ENGINEERS)
@@ -0,0 +1,36 @@
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, insert, select
+
+from profiling import OTHER_QUERIES, QueryProfiler
+
+
+metadata = MetaData()
+items = Table('items', metadata, Column('id', Integer, primary_key=True), Column('name', String))
+
+
+def test_expanded_parameter_lists_share_one_entry():
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine)
+    profiler = QueryProfiler(threshold=10)
+    profiler.install(engine)
+    with engine.begin() as connection:
+        for size in range(2, 50):
+            connection.execute(select(items.c.name).where(items.c.id.in_(range(size))))
+            connection.execute(insert(items).values([{'name': str(value)} for value in range(size)]))
+
+    counts = {' '.join(statement.split()): stats.count for statement, stats in profiler.stats.items()}
+    assert counts == {
+        "SELECT items.name FROM items WHERE items.id IN (?, ...)": 48,
+        "INSERT INTO items (name) VALUES (?), ...": 48,
+    }
+
+
+def test_stats_are_capped():
+    engine = create_engine('sqlite://')
+    profiler = QueryProfiler(threshold=10, stats_size=5)
+    profiler.install(engine)
+    with engine.connect() as connection:
+        for value in range(20):
+            connection.exec_driver_sql(f"SELECT {value}")
+
+    assert len(profiler.stats) == 6
+    assert profiler.stats[OTHER_QUERIES].count == 15
@@ -0,0 +1,37 @@
+from sqlalchemy import func, select
+
+from database import Session
+from models import ProcessedUpdate
+
+from tests.fake_api import FakeBotAPI, message_update
+
+import asyncio
+import os
+import signal
+
+import bot
+
+
+UPDATES = 20
+
+
+def test_sigterm_under_load_loses_no_updates(db):
+    # Получив пачку апдейтов, бот получает SIGTERM, пока их обработчики ждут медленный API.
+    # Все принятые апдейты должны быть доработаны до выхода из main()
+    async def scenario():
+        async with FakeBotAPI(delay=0.3) as api:
+            bot.bot.session = api.session()
+            api.updates = [message_update(index, 1000 + index, '/start') for index in range(1, UPDATES + 1)]
+
+            main = asyncio.create_task(bot.main())
+            await asyncio.wait_for(api.sent.wait(), 10)
+            os.kill(os.getpid(), signal.SIGTERM)
+            await asyncio.wait_for(main, 30)
+            return api
+
+    api = asyncio.run(scenario())
+
+    assert sorted(int(data['chat_id']) for data in api.methods('sendMessage')) == \
+        [1000 + index for index in range(1, UPDATES + 1)]
+    with Session() as session:
+        assert session.scalar(select(func.count()).select_from(ProcessedUpdate)) == UPDATES
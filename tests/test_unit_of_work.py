@@ -0,0 +1,76 @@
+from aiogram.types import Update
+from sqlalchemy import event
+
+from config import Config
+from database import engine, save_to_db, Session
+from models import Employee
+
+from tests.fake_api import FakeBotAPI, message_update
+
+import asyncio
+import time
+
+import pytest
+
+import bot
+
+
+# Вдвое больше апдейтов, чем соединений в пуле, и каждый обработчик ждет медленный API
+UPDATES = Config.MAX_CONCURRENT_UPDATES * 2
+
+
+def test_concurrent_updates_do_not_wait_for_connections(db):
+    counters = {'checkout': 0, 'checkedout': 0, 'max_checkedout': 0, 'commit': 0}
+
+    def on_checkout(*args):
+        counters['checkout'] += 1
+        counters['checkedout'] += 1
+        counters['max_checkedout'] = max(counters['max_checkedout'], counters['checkedout'])
+
+    def on_checkin(*args):
+        counters['checkedout'] -= 1
+
+    def on_commit(*args):
+        counters['commit'] += 1
+
+    async def scenario():
+        async with FakeBotAPI(delay=0.5) as api:
+            bot.bot.session = api.session()
+            updates = [
+                Update.model_validate(message_update(100 + index, 1000 + index, '/start'), context={'bot': bot.bot})
+                for index in range(1, UPDATES + 1)
+            ]
+            started = time.monotonic()
+            await asyncio.gather(*(bot.dp.feed_update(bot.bot, update) for update in updates))
+            elapsed = time.monotonic() - started
+            await bot.bot.session.close()
+            return api, elapsed
+
+    bot.throttling.banned  # бан-лист загружается один раз, до подсчета
+    listeners = [(engine.pool, 'checkout', on_checkout), (engine.pool, 'checkin', on_checkin),
+                 (engine, 'commit', on_commit)]
+    for target, name, listener in listeners:
+        event.listen(target, name, listener)
+    try:
+        api, elapsed = asyncio.run(scenario())
+    finally:
+        for target, name, listener in listeners:
+            event.remove(target, name, listener)
+
+    assert len(api.methods('sendMessage')) == UPDATES
+    # Ожидание API идет параллельно: ни один апдейт не ждал освобождения соединения
+    assert elapsed < 5
+    assert counters['max_checkedout'] > Config.MAX_CONCURRENT_UPDATES
+    # На апдейт: отметка об обработке и один коммит сессии апдейта, все соединения возвращены в пул
+    assert counters['commit'] == UPDATES * 2
+    assert counters['checkout'] == UPDATES * 2
+    assert counters['checkedout'] == 0
+
+
+def test_failed_insert_does_not_roll_back_the_update(machine):
+    # Ошибка вставки в сессии апдейта не откатывает молча остальную работу обработчика
+    with Session(autoflush=False) as session:
+        session.add(Employee(telegram_id=6000, full_name='Инженер', group='engineer'))
+        with pytest.raises(KeyError):
+            save_to_db({'machine': '0001'}, session=session)
+        assert session.new
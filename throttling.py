@@ -0,0 +1,86 @@
+from aiogram import BaseMiddleware
+from aiogram.types import Message, CallbackQuery
+from collections import Counter, OrderedDict
+from typing import Dict, Any, Callable, Awaitable, Optional
+
+from database import get_banned_user_ids, ban_user
+
+import logging
+import time
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    # Ограничивает частоту действий одного пользователя корзиной токенов на каждую область:
+    # limits = {scope: (burst, period)} — не больше burst действий, за period секунд запас восстанавливается.
+    # scope(event, data) определяет область действия или возвращает None, если его не нужно ограничивать.
+    # Храним не больше max_users корзин, давно не использованные вытесняются
+    def __init__(self, limits: dict, scope: Callable, max_users: int, ban_after: int = 0):
+        self._limits = limits
+        self._scope = scope
+        self._max_users = max_users
+        self._ban_after = ban_after
+        # (scope, user_id) -> [токены, время обновления, отказов подряд]
+        self._buckets = OrderedDict()
+        self._banned = None
+        self.throttled = Counter()
+
+    def _take(self, scope: str, user_id: int) -> Optional[list]:
+        # Возвращает None, если токен есть, иначе состояние корзины
+        burst, period = self._limits[scope]
+        now = time.monotonic()
+        bucket = self._buckets.pop((scope, user_id), None) or [burst, now, 0]
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * burst / period)
+        bucket[1] = now
+        self._buckets[(scope, user_id)] = bucket
+        while len(self._buckets) > self._max_users:
+            self._buckets.popitem(last=False)
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = 0
+            return None
+        bucket[2] += 1
+        return bucket
+
+    def ban(self, user_id: int, reason: str):
+        ban_user(user_id, reason)
+        self.banned.add(user_id)
+
+    @property
+    def banned(self) -> set:
+        if self._banned is None:
+            self._banned = set(get_banned_user_ids())
+        return self._banned
+
+    async def __call__(
+        self,
+        handler: Callable[[Message | CallbackQuery, Dict[str, Any]], Awaitable[Any]],
+        event: Message | CallbackQuery,
+        data: Dict[str, Any]
+    ) -> Any:
+        user_id = event.from_user.id
+        if user_id in self.banned:
+            self.throttled['banned'] += 1
+            return None
+
+        scope = self._scope(event, data)
+        if scope is None or scope not in self._limits:
+            return await handler(event, data)
+
+        bucket = self._take(scope, user_id)
+        if bucket is None:
+            return await handler(event, data)
+
+        self.throttled[scope] += 1
+        if self._ban_after and bucket[2] >= self._ban_after:
+            logging.warning(f"User {user_id} banned after {bucket[2]} throttled {scope} events")
+            self.ban(user_id, f"throttled: {scope}")
+            return None
+
+        # Отвечаем только на первый отказ подряд, чтобы не рассылать ответы самим
+        text = "Слишком много запросов. Пожалуйста, попробуйте позже."
+        if isinstance(event, CallbackQuery):
+            await event.answer(text)
+        elif bucket[2] == 1:
+            await event.answer(text)
+        return None
@@ -0,0 +1,61 @@
+from dataclasses import dataclass
+from typing import Any, Callable, Optional, Union
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.types import Message
+
+
+class InvalidInput(Exception):
+    # Некорректный ввод: текст исключения показывается пользователю, шаг повторяется
+    pass
+
+
+@dataclass(frozen=True)
+class Step:
+    prompt: Union[str, Callable[[dict], str]]  # Текст при входе в шаг, может зависеть от уже введенных данных
+    keyboard: Any
+    field: Optional[str] = None  # Куда сохранить введенное значение
+    parse: Optional[Callable[[Message], Any]] = None  # Разбор и проверка ввода, без него сообщения игнорируются
+    next: Optional[Union[State, Callable[[Any], State]]] = None  # Следующий шаг, функция — для ветвления
+    skip: Optional[str] = None  # Кнопка, по которой шаг пропускается
+
+
+class FormWizard:
+    # Анкета, описанная таблицей шагов. Шаг находится по состоянию за O(1),
+    # клавиатуры создаются один раз при описании шагов
+    def __init__(self, steps: dict, cancel_text: str, on_cancel: Callable):
+        self._steps = {state.state: step for state, step in steps.items()}
+        self._cancel_text = cancel_text
+        self._on_cancel = on_cancel
+
+    def filter(self, message: Message, raw_state: Optional[str] = None) -> bool:
+        return raw_state in self._steps
+
+    async def enter(self, message: Message, state: FSMContext, target: State):
+        step = self._steps[target.state]
+        prompt = step.prompt(await state.get_data()) if callable(step.prompt) else step.prompt
+        await message.answer(prompt, reply_markup=step.keyboard)
+        await state.set_state(target)
+
+    async def handle(self, message: Message, state: FSMContext, raw_state: str, **kwargs):
+        if message.text == self._cancel_text:
+            await self._on_cancel(message, state, **kwargs)
+            return
+
+        step = self._steps[raw_state]
+        if step.parse is None:
+            return
+
+        value = None
+        if not (step.skip and message.text == step.skip):
+            try:
+                value = step.parse(message)
+            except InvalidInput as e:
+                await message.answer(str(e), reply_markup=step.keyboard)
+                return
+            if step.field:
+                await state.update_data({step.field: value})
+
+        # State сам по себе вызываемый (это фильтр aiogram), поэтому проверяем тип явно
+        await self.enter(message, state, step.next if isinstance(step.next, State) else step.next(value))
@@ -0,0 +1,79 @@
+from sqlalchemy import or_
+
+from cards import RequestCard, get_request_cards
+from scheduler import sla_deadline
+
+import heapq
+
+
+QUEUE_GROUPS = ('engineer', 'accountant')
+NO_PRIORITY = 1 << 30
+
+
+class WorkQueue:
+    # Очередь открытых заявок для кнопки "Взять следующую", отдельная куча на каждую группу.
+    # Первой идет заявка с самым ранним сроком SLA, при равных сроках — с более высоким
+    # приоритетом автомата (меньшее число), затем более старая. Заявки, которые сменили
+    # статус или место в очереди, остаются в куче и пропускаются при извлечении
+    def __init__(self):
+        self._heaps = {group: [] for group in QUEUE_GROUPS}
+        self._ranks = {}  # (group, request_id) -> текущий ключ заявки в куче
+
+    def load(self):
+        cards = get_request_cards(lambda table: or_(table.c.engineer_status == 'open',
+                                                    table.c.accountant_status == 'open'))
+        self._heaps = {group: [] for group in QUEUE_GROUPS}
+        self._ranks = {}
+        for card in cards:
+            self.sync(card)
+
+    @staticmethod
+    def rank(request: RequestCard):
+        machine = request.machine
+        priority = machine.priority if machine and machine.priority is not None else NO_PRIORITY
+        return sla_deadline(request.created_at, machine), priority, request.created_at, request.id
+
+    def sync(self, request: RequestCard):
+        # Вызывается при каждой смене статуса заявки
+        for group, status in (('engineer', request.engineer_status), ('accountant', request.accountant_status)):
+            key = (group, request.id)
+            if status != 'open':
+                self._ranks.pop(key, None)
+                continue
+            rank = self.rank(request)
+            if self._ranks.get(key) != rank:
+                self._ranks[key] = rank
+                heapq.heappush(self._heaps[group], (rank, request.machine_number))
+        self._compact()
+
+    def pop(self, group: str, eligible):
+        # Извлекает лучшую заявку, которую может взять сотрудник: eligible(machine_number).
+        # Пропущенные чужие заявки возвращаются в кучу
+        heap = self._heaps[group]
+        skipped = []
+        request_id = None
+        while heap:
+            rank, machine_number = heapq.heappop(heap)
+            key = (group, rank[-1])
+            if self._ranks.get(key) != rank:
+                continue
+            if not eligible(machine_number):
+                skipped.append((rank, machine_number))
+                continue
+            del self._ranks[key]
+            request_id = rank[-1]
+            break
+        for item in skipped:
+            heapq.heappush(heap, item)
+        return request_id
+
+    def _compact(self):
+        # Пересобираем кучи, если устаревших записей в них больше, чем действующих
+        total = sum(len(heap) for heap in self._heaps.values())
+        if total > 2 * len(self._ranks) + 64:
+            for group, heap in self._heaps.items():
+                self._heaps[group] = [item for item in heap if self._ranks.get((group, item[0][-1])) == item[0]]
+                heapq.heapify(self._heaps[group])
+
+
+work_queue = WorkQueue()